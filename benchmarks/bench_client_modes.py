@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark: async (httpx) vs sync (requests in threads) HTTP client.
+
+Starts a mock Context Broker with a fixed latency and calls the
+fiware_request tool through an in-memory MCP client at increasing
+concurrency, once per HTTP_CLIENT mode.
+
+Usage:
+    python benchmarks/bench_client_modes.py --requests 400 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mock_fiware import start_mock_server
+
+
+async def run_mode(server, mode: str, total: int, concurrency: int) -> float:
+    """Return tool calls per second for one client mode"""
+    from fastmcp import Client
+    
+    server.HTTP_CLIENT = mode
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async with Client(server.mcp) as client:
+        async def call():
+            async with semaphore:
+                await client.call_tool("fiware_request", {"method": "GET", "endpoint": "/v2/entities?limit=10"})
+        
+        start = time.perf_counter()
+        await asyncio.gather(*(call() for _ in range(total)))
+        return total / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400, help="Tool calls per run")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock backend latency in seconds")
+    parser.add_argument("--concurrency", default="1,10,50,200", help="Comma-separated concurrency levels")
+    args = parser.parse_args()
+    
+    httpd = start_mock_server(latency=args.latency)
+    port = httpd.server_address[1]
+    os.environ.update({
+        "AUTH_TYPE": "none",
+        "CB_HOST": "127.0.0.1",
+        "CB_PORT": str(port),
+        "CB_PROTOCOL": "http",
+    })
+    import server
+    
+    print(f"{'concurrency':>12} {'sync req/s':>12} {'async req/s':>12} {'speedup':>8}")
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        total = max(args.requests if concurrency > 1 else args.requests // 10, concurrency)
+        sync_rps = asyncio.run(run_mode(server, "sync", total, concurrency))
+        async_rps = asyncio.run(run_mode(server, "async", total, concurrency))
+        print(f"{concurrency:>12} {sync_rps:>12.1f} {async_rps:>12.1f} {async_rps / sync_rps:>7.1f}x")
+    
+    httpd.shutdown()
+
+
+if __name__ == "__main__":
+    main()
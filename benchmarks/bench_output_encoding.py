@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Output size and serialization time per tool output mode.
+
+Builds tool results from the request bodies in
+resources/fiware-ngsi-v2-examples.json (entities, subscriptions, IoT devices),
+scaled up to realistic list sizes, and serializes them with each mode:
+pretty / compact JSON (stdlib and orjson when installed) and the keyValues /
+columnar entity projections.
+
+Usage:
+    python benchmarks/bench_output_encoding.py --items 1000
+"""
+
+import argparse
+import copy
+import json
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server
+
+
+def load_examples() -> dict:
+    """Collect JSON request bodies from the Postman collection, grouped by kind"""
+    with open(ROOT / "resources" / "fiware-ngsi-v2-examples.json", encoding="utf-8") as f:
+        collection = json.load(f)
+    
+    examples = {"entities": [], "subscriptions": [], "devices": []}
+    
+    def walk(items):
+        for item in items:
+            if "item" in item:
+                walk(item["item"])
+                continue
+            raw = item["request"].get("body", {}).get("raw")
+            try:
+                body = json.loads(raw) if raw else None
+            except ValueError:
+                continue
+            if server._is_entity(body):
+                examples["entities"].append(body)
+            elif isinstance(body, dict) and "subject" in body:
+                examples["subscriptions"].append(body)
+            elif isinstance(body, dict) and "devices" in body:
+                examples["devices"].extend(body["devices"])
+    
+    walk(collection["item"])
+    return examples
+
+
+def scale(templates: list, count: int, id_key: str) -> list:
+    """Repeat templates with unique ids up to count items"""
+    items = []
+    for i in range(count):
+        item = copy.deepcopy(templates[i % len(templates)])
+        if id_key in item:
+            item[id_key] = f"{item[id_key]}:{i}"
+        items.append(item)
+    return items
+
+
+def measure(data, repeat: int, **kwargs):
+    """Return (bytes, milliseconds per serialization)"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        if "projection" in kwargs:
+            output = server.to_json(server.project_entities(data, kwargs["projection"]), "compact")
+        else:
+            output = server.to_json(data, kwargs["output_format"])
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    return len(output.encode()), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=1000, help="Items per payload")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    
+    examples = load_examples()
+    payloads = {
+        "entities": scale(examples["entities"], args.items, "id"),
+        "subscriptions": scale(examples["subscriptions"], args.items, "description"),
+        "devices": scale(examples["devices"], args.items, "device_id"),
+    }
+    
+    orjson_module = server.orjson
+    modes = [("pretty (json)", {"output_format": "pretty"}, None),
+             ("compact (json)", {"output_format": "compact"}, None)]
+    if orjson_module:
+        modes += [("pretty (orjson)", {"output_format": "pretty"}, orjson_module),
+                  ("compact (orjson)", {"output_format": "compact"}, orjson_module)]
+    modes += [("keyValues", {"projection": "keyValues"}, orjson_module),
+              ("columnar", {"projection": "columnar"}, orjson_module)]
+    
+    print(f"{'payload':<14} {'mode':<18} {'bytes':>10} {'vs pretty':>10} {'ms':>8}")
+    for name, data in payloads.items():
+        baseline = None
+        for label, kwargs, serializer in modes:
+            if "projection" in kwargs and name != "entities":
+                continue
+            server.orjson = serializer
+            size, ms = measure(data, args.repeat, **kwargs)
+            baseline = baseline or size
+            print(f"{name:<14} {label:<18} {size:>10} {size / baseline:>9.0%} {ms:>8.2f}")
+    server.orjson = orjson_module
+    
+    if not orjson_module:
+        print("\norjson not installed: pip install orjson to include it")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+End-to-end tool benchmark over the real MCP transports.
+
+Starts one mock per FIWARE backend (Orion, STH-Comet, Perseo, IoT Agent,
+Keystone) and server.py as a subprocess, then calls each tool scenario at
+increasing concurrency over stdio and streamable HTTP. Reports p50/p99
+latency, throughput and the server's resident memory (read from the
+fiware://metrics resource), so runs can be compared against a baseline.
+
+Usage:
+    python benchmarks/bench_tools.py --latency 0.02 --concurrency 1,8,32 --calls 200
+    python benchmarks/bench_tools.py --transports http --scenarios entities_page,sth_last_n --json baseline.json
+    python benchmarks/bench_tools.py --auth oauth --env OUTPUT_FORMAT=compact
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+from mock_fiware import start_mock_server
+
+SERVER = Path(__file__).resolve().parent.parent / "server.py"
+
+SCENARIOS = {
+    "cb_version": ("CB_version", {}),
+    "entity_get": ("fiware_request", {"method": "GET", "endpoint": "/v2/entities/Room:00001"}),
+    "entities_page": ("fiware_request", {"method": "GET", "endpoint": "/v2/entities?type=Room&limit=100"}),
+    "entities_all": ("fiware_request", {"method": "GET", "endpoint": "/v2/entities?type=Room",
+                                        "auto_paginate": True, "projection": "keyValues"}),
+    "sth_last_n": ("sth_get_history", {"entity_type": "Room", "entity_id": "Room:00001",
+                                       "attribute": "temperature", "last_n": 100}),
+    "sth_window": ("sth_get_history", {"entity_type": "Room", "entity_id": "Room:00001", "attribute": "temperature",
+                                       "date_from": "2026-01-01T00:00:00Z", "date_to": "2026-01-02T00:00:00Z",
+                                       "window": "6h"}),
+    "cep_rules": ("cep_list_rules", {}),
+    "iota_devices": ("iota_list_devices", {"limit": 100}),
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    index = min(int(q * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def server_env(args, ports: dict, store_dir: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "AUTH_TYPE": args.auth,
+        "AUTH_HOST": "127.0.0.1",
+        "AUTH_PORT": str(ports["keystone"]),
+        "AUTH_PROTOCOL": "http",
+        "FIWARE_USERNAME": "bench",
+        "FIWARE_PASSWORD": "bench",
+        "SERVICE": "mock",
+        "SUBSERVICE": "/",
+        "CB_HOST": "127.0.0.1",
+        "CB_PORT": str(ports["context_broker"]),
+        "CB_PROTOCOL": "http",
+        "STH_PORT": str(ports["sth_comet"]),
+        "CEP_PORT": str(ports["perseo_cep"]),
+        "IOTA_PORT": str(ports["iot_agent"]),
+        "HISTORY_STORE_PATH": str(Path(store_dir) / "sth_history.sqlite"),
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+async def read_rss(client) -> float:
+    """Server RSS in MB, from the fiware://metrics resource"""
+    contents = await client.read_resource("fiware://metrics")
+    rss = json.loads(contents[0].text).get("process_rss_bytes")
+    return rss / 1e6 if rss else float("nan")
+
+
+async def run_level(client, tool: str, arguments: dict, calls: int, concurrency: int) -> dict:
+    """Call one tool `calls` times with at most `concurrency` calls in flight"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def call():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                result = await client.call_tool(tool, arguments, raise_on_error=False)
+                text = result.content[0].text if result.content else ""
+                if result.is_error or text[:20].lstrip("{ \n").startswith('"error"'):
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(call() for _ in range(calls)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "calls": calls,
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "calls_per_second": round(calls / elapsed, 1),
+    }
+
+
+async def run_transport(transport: str, args, env: dict) -> list:
+    from fastmcp import Client
+    from fastmcp.client.transports import StdioTransport
+
+    process = None
+    if transport == "stdio":
+        target = StdioTransport(sys.executable, [str(SERVER)], env=env, log_file=Path(os.devnull))
+    else:
+        port = free_port()
+        process = subprocess.Popen([sys.executable, str(SERVER), "--http", "--port", str(port)], env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1)
+                break
+            except OSError:
+                time.sleep(0.1)
+        target = f"http://127.0.0.1:{port}/mcp"
+
+    rows = []
+    try:
+        async with Client(target, timeout=120) as client:
+            for name in args.scenarios.split(","):
+                tool, arguments = SCENARIOS[name]
+                await client.call_tool(tool, arguments, raise_on_error=False)  # Warm up pools and tokens
+                for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                    calls = max(args.calls if concurrency > 1 else args.calls // 4, concurrency, 1)
+                    row = {"transport": transport, "scenario": name, "concurrency": concurrency}
+                    row.update(await run_level(client, tool, arguments, calls, concurrency))
+                    row["rss_mb"] = round(await read_rss(client), 1)
+                    rows.append(row)
+                    print(f"{transport:>9} {name:>14} {concurrency:>6} {row['calls']:>6} {row['errors']:>6} "
+                          f"{row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['calls_per_second']:>9.1f} "
+                          f"{row['rss_mb']:>8.1f}", flush=True)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transports", default="stdio,http", help="Comma-separated: stdio, http")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--calls", type=int, default=200, help="Tool calls per level (a quarter at concurrency 1)")
+    parser.add_argument("--latency", type=float, default=0.01, help="Mock backend latency in seconds")
+    parser.add_argument("--entities", type=int, default=2000, help="Entities in the mock Context Broker")
+    parser.add_argument("--attributes", type=int, default=5, help="Attributes per entity (payload size)")
+    parser.add_argument("--devices", type=int, default=500, help="Devices in the mock IoT Agent")
+    parser.add_argument("--auth", default="none", choices=["none", "oauth", "basic"])
+    parser.add_argument("--env", action="append", default=[], help="Extra server setting, KEY=VALUE (repeatable)")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    mocks = {
+        backend: start_mock_server(latency=args.latency, entity_count=args.entities,
+                                   attributes=args.attributes, device_count=args.devices)
+        for backend in ("context_broker", "sth_comet", "perseo_cep", "iot_agent", "keystone")
+    }
+    ports = {backend: httpd.server_address[1] for backend, httpd in mocks.items()}
+
+    print(f"{'transport':>9} {'scenario':>14} {'conc':>6} {'calls':>6} {'errors':>6} "
+          f"{'p50 ms':>9} {'p99 ms':>9} {'calls/s':>9} {'RSS MB':>8}")
+    rows = []
+    with tempfile.TemporaryDirectory() as store_dir:
+        env = server_env(args, ports, store_dir)
+        for transport in args.transports.split(","):
+            rows += asyncio.run(run_transport(transport, args, env))
+
+    for httpd in mocks.values():
+        httpd.shutdown()
+
+    if args.json:
+        settings = {key: value for key, value in vars(args).items() if key != "json"}
+        Path(args.json).write_text(json.dumps({"settings": settings, "results": rows}, indent=2))
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
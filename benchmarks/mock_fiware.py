@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the FIWARE stack, used by the benchmarks.
+
+One server answers for every component, so it can be started once per
+backend port or shared by all of them:
+  - Orion:      /version, /v2/entities (incl. /v2/op/update batches), /v2/types
+  - STH-Comet:  /STH/v1/contextEntities/... synthetic raw history
+  - Perseo:     /rules
+  - IoT Agent:  /iot/devices, /iot/services, /iot/about
+  - Keystone:   POST /v3/auth/tokens
+
+Latency and payload sizes (entities, attributes per entity, devices) are
+configurable, so the MCP tools can be measured without a real platform.
+Faults can be queued per path for the tests: the handler class's faults
+maps a path to a list of {"status", "applied", "delay"} dicts, consumed one
+per POST. With "applied" the request still takes effect before the injected
+status is returned, as when Orion times out behind a proxy.
+
+Usage:
+    python benchmarks/mock_fiware.py --port 1026 --latency 0.05 --entities 1000 --attributes 10
+"""
+
+import argparse
+import json
+import math
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+def make_entities(count: int, entity_type: str = "Room", attributes: int = 2) -> list:
+    """Generate NGSI-v2 normalized entities with temperature, pressure and extra attr<N> attributes"""
+    entities = []
+    for i in range(count):
+        entity = {
+            "id": f"{entity_type}:{i:05d}",
+            "type": entity_type,
+            "temperature": {"type": "Number", "value": 20 + i % 10, "metadata": {}},
+            "pressure": {"type": "Number", "value": 700 + i % 50, "metadata": {}},
+        }
+        for n in range(2, attributes):
+            entity[f"attr{n}"] = {"type": "Number", "value": (i * n) % 100, "metadata": {}}
+        entities.append(entity)
+    return entities
+
+
+def make_devices(count: int) -> dict:
+    """Generate IoT Agent devices mapped to the generated Room entities"""
+    return {
+        f"sensor{i:05d}": {
+            "device_id": f"sensor{i:05d}",
+            "service": "mock",
+            "service_path": "/",
+            "entity_name": f"Room:{i:05d}",
+            "entity_type": "Room",
+            "protocol": "IoTA-UL" if i % 2 else "IoTA-JSON",
+            "transport": "HTTP",
+            "attributes": [
+                {"object_id": "t", "name": "temperature", "type": "Number"},
+                {"object_id": "p", "name": "pressure", "type": "Number"},
+            ],
+        }
+        for i in range(count)
+    }
+
+
+FORBIDDEN_CHARS = "<>\"'=;()"  # Rejected by Orion in ids, types and attribute names
+
+HISTORY_START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _parse_date(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def history_values(query: dict, interval: int, points: int) -> list:
+    """Synthetic raw STH values: one sample every `interval` seconds from HISTORY_START"""
+    first, last = 0, points - 1
+    if "dateFrom" in query:
+        first = max(first, math.ceil((_parse_date(query["dateFrom"][0]) - HISTORY_START).total_seconds() / interval))
+    if "dateTo" in query:
+        last = min(last, math.floor((_parse_date(query["dateTo"][0]) - HISTORY_START).total_seconds() / interval))
+    
+    if "lastN" in query:
+        first = max(first, last - int(query["lastN"][0]) + 1)
+    else:
+        first += int(query.get("hOffset", ["0"])[0])
+        last = min(last, first + int(query.get("hLimit", ["100"])[0]) - 1)
+    
+    values = []
+    for i in range(first, last + 1):
+        recv_time = HISTORY_START + timedelta(seconds=i * interval)
+        values.append({
+            "_id": f"{i:024x}",
+            "recvTime": recv_time.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "attrType": "Number",
+            "attrValue": round(20 + 5 * math.sin(i / 60), 2),
+        })
+    return values
+
+
+class MockFiwareHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+    latency = 0.0
+    entities = []
+    devices = {}
+    rules = {}
+    lock = None
+    faults = {}
+    fault_status = None
+    history_interval = 60
+    history_points = 50000
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _send_json(self, status: int, data, headers: dict = None):
+        status, self.fault_status = self.fault_status or status, None
+        body = json.dumps(data).encode() if data is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else None
+    
+    def _fault(self, path: str):
+        """Pop the next fault queued for path, None if there is none"""
+        with self.lock:
+            queue = self.faults.get(path)
+            return queue.pop(0) if queue else None
+    
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        
+        if url.path.startswith("/iot/"):
+            self._iot_get(url.path, query)
+        elif url.path == "/rules":
+            with self.lock:
+                rules = list(self.rules.values())
+            self._send_json(200, {"error": None, "data": rules})
+        elif url.path == "/version":
+            self._send_json(200, {"orion": {"version": "mock"}})
+        elif url.path == "/v2/entities":
+            entities = self.entities
+            if "type" in query:
+                entities = [e for e in entities if e["type"] == query["type"][0]]
+            if "idPattern" in query:
+                pattern = re.compile(query["idPattern"][0])
+                entities = [e for e in entities if pattern.search(e["id"])]
+            offset = int(query.get("offset", ["0"])[0])
+            limit = int(query.get("limit", ["20"])[0])
+            options = query.get("options", [""])[0].split(",")
+            headers = {}
+            if "count" in options:
+                headers["Fiware-Total-Count"] = str(len(entities))
+            page = entities[offset:offset + limit]
+            if "keyValues" in options:
+                page = [{name: value["value"] if isinstance(value, dict) and "value" in value else value
+                         for name, value in entity.items()} for entity in page]
+            self._send_json(200, page, headers)
+        elif url.path.startswith("/v2/entities/"):
+            entity_id = url.path.split("/")[3]
+            match = [e for e in self.entities if e["id"] == entity_id]
+            if match:
+                self._send_json(200, match[0])
+            else:
+                self._send_json(404, {"error": "NotFound", "description": "The requested entity has not been found"})
+        elif url.path.startswith("/STH/v1/contextEntities/"):
+            # /STH/v1/contextEntities/type/{type}/id/{id}/attributes/{attr}
+            parts = url.path.split("/")
+            values = history_values(query, self.history_interval, self.history_points)
+            self._send_json(200, {"contextResponses": [{
+                "contextElement": {
+                    "attributes": [{"name": parts[-1], "values": values}],
+                    "id": parts[-3],
+                    "isPattern": False,
+                    "type": parts[-5],
+                },
+                "statusCode": {"code": "200", "reasonPhrase": "OK"},
+            }]})
+        elif url.path == "/v2/types":
+            types = sorted({e["type"] for e in self.entities})
+            self._send_json(200, [{"type": t, "count": sum(e["type"] == t for e in self.entities)} for t in types])
+        else:
+            self._send_json(404, {"error": "NotFound"})
+    
+    def do_POST(self):
+        time.sleep(self.latency)
+        url = urlsplit(self.path)
+        body = self._read_body()
+        fault = self._fault(url.path)
+        if fault:
+            time.sleep(fault.get("delay", 0))
+            if not fault.get("applied"):
+                return self._send_json(fault["status"], {"error": "InjectedFault"})
+            self.fault_status = fault["status"]
+        if url.path == "/v2/op/update":
+            key_values = "keyValues" in parse_qs(url.query).get("options", [""])[0].split(",")
+            self._batch_update(body, key_values)
+        elif url.path == "/v3/auth/tokens":
+            expires_at = datetime.now(timezone.utc) + timedelta(hours=1)
+            self._send_json(201, {"token": {"expires_at": expires_at.strftime("%Y-%m-%dT%H:%M:%S.000000Z")}},
+                            {"X-Subject-Token": uuid.uuid4().hex})
+        elif url.path == "/rules":
+            with self.lock:
+                if body["name"] in self.rules:
+                    return self._send_json(400, {"error": f"rule exists {body['name']}", "data": None})
+                self.rules[body["name"]] = body
+            self._send_json(200, {"error": None, "data": body})
+        elif url.path == "/iot/devices":
+            with self.lock:
+                duplicates = [d["device_id"] for d in body["devices"] if d["device_id"] in self.devices]
+                if not duplicates:
+                    self.devices.update((d["device_id"], d) for d in body["devices"])
+            if duplicates:
+                self._send_json(409, {"name": "DUPLICATE_DEVICE_ID",
+                                      "message": f"A device with the same pair (Service, DeviceId) already exists: {duplicates[0]}"})
+            else:
+                self._send_json(201, None)
+        else:
+            self._send_json(201, None)
+    
+    def do_DELETE(self):
+        time.sleep(self.latency)
+        path = urlsplit(self.path).path
+        with self.lock:
+            if path.startswith("/rules/"):
+                found = self.rules.pop(path.split("/")[2], None) is not None
+            elif path.startswith("/iot/devices/"):
+                found = self.devices.pop(path.split("/")[3], None) is not None
+            elif path.startswith("/v2/entities/"):
+                before = len(self.entities)
+                self.entities[:] = [e for e in self.entities if e["id"] != path.split("/")[3]]
+                found = len(self.entities) < before
+            else:
+                found = False
+        if found:
+            self._send_json(204, None)
+        else:
+            self._send_json(404, {"error": "NotFound"})
+    
+    def _iot_get(self, path: str, query: dict):
+        offset = int(query.get("offset", ["0"])[0])
+        limit = int(query.get("limit", ["20"])[0])  # The IoT Agent's default page size
+        if path == "/iot/about":
+            self._send_json(200, {"libVersion": "mock", "version": "mock"})
+        elif path == "/iot/devices":
+            with self.lock:
+                devices = list(self.devices.values())
+            if "protocol" in query:
+                devices = [d for d in devices if d["protocol"] == query["protocol"][0]]
+            self._send_json(200, {"count": len(devices), "devices": devices[offset:offset + limit]})
+        elif path.startswith("/iot/devices/"):
+            device = self.devices.get(path.split("/")[3])
+            if device:
+                self._send_json(200, device)
+            else:
+                self._send_json(404, {"name": "DEVICE_NOT_FOUND"})
+        elif path == "/iot/services":
+            services = [{"apikey": "mockkey", "resource": "/iot/d", "entity_type": "Room", "protocol": "IoTA-UL",
+                         "service": "mock", "subservice": "/"}]
+            self._send_json(200, {"count": len(services), "services": services[offset:offset + limit]})
+        else:
+            self._send_json(404, {"error": "NotFound"})
+    
+    def _batch_update(self, body: dict, key_values: bool):
+        """Apply an /v2/op/update batch to the in-memory entities, like Orion does"""
+        entities = body.get("entities", [])
+        action = body.get("actionType")
+        # Orion validates the whole payload before touching any entity
+        if any(set(str(entity.get("id", ""))) & set(FORBIDDEN_CHARS) for entity in entities):
+            return self._send_json(400, {"error": "BadRequest", "description": "Invalid characters in entity id"})
+        
+        failed = []
+        with self.lock:
+            index = {entity["id"]: i for i, entity in enumerate(self.entities)}
+            for entity in entities:
+                if key_values:
+                    entity = {name: value if name in ("id", "type") else {"type": "Text", "value": value, "metadata": {}}
+                              for name, value in entity.items()}
+                i = index.get(entity["id"])
+                if action == "delete":
+                    if i is None:
+                        failed.append(entity["id"])
+                    else:
+                        self.entities[i] = None
+                        del index[entity["id"]]
+                elif i is None:
+                    if action in ("update", "replace"):
+                        failed.append(entity["id"])
+                    else:
+                        index[entity["id"]] = len(self.entities)
+                        self.entities.append({"type": "Thing", **entity})
+                elif action == "appendStrict":
+                    failed.append(entity["id"])
+                elif action == "replace":
+                    self.entities[i] = {"id": entity["id"], "type": self.entities[i]["type"], **entity}
+                else:
+                    self.entities[i].update(entity)
+            self.entities[:] = [entity for entity in self.entities if entity is not None]
+        
+        if not failed:
+            self._send_json(204, None)
+        elif action == "appendStrict":
+            self._send_json(422, {"error": "Unprocessable", "description": f"Already exist: {', '.join(failed)}"})
+        else:
+            self._send_json(404, {"error": "NotFound", "description": f"Entities do not exist: {', '.join(failed)}"})
+
+
+def start_mock_server(port: int = 0, latency: float = 0.0, entity_count: int = 100,
+                      attributes: int = 2, device_count: int = 100,
+                      history_points: int = 50000) -> ThreadingHTTPServer:
+    """Start the mock in a background thread and return the server (server_address has the port)"""
+    handler = type("Handler", (MockFiwareHandler,), {
+        "latency": latency,
+        "entities": make_entities(entity_count, attributes=attributes),
+        "devices": make_devices(device_count),
+        "rules": {},
+        "faults": {},
+        "history_points": history_points,
+        "lock": threading.Lock(),
+    })
+    httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=1026)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every response")
+    parser.add_argument("--entities", type=int, default=100)
+    parser.add_argument("--attributes", type=int, default=2, help="Attributes per entity (payload size)")
+    parser.add_argument("--devices", type=int, default=100)
+    args = parser.parse_args()
+    
+    httpd = start_mock_server(args.port, args.latency, args.entities, args.attributes, args.devices)
+    print(f"Mock FIWARE listening on http://127.0.0.1:{httpd.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        httpd.shutdown()
@@ -8,16 +8,43 @@ This fork: NGSI-v2 + Multiple authentication methods (OAuth, Basic Auth, None)
 
 import os
 import json
+import random
+import re
 import sys
 import argparse
+import asyncio
+import bisect
+import codecs
+import contextvars
+import csv
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
 from typing import Optional
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit, urlunsplit
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from fastmcp import FastMCP
+from fastmcp.server.middleware import Middleware
 from dotenv import load_dotenv
 from pathlib import Path
 import urllib3
 
+try:
+    import orjson  # Optional: faster JSON serialization
+except ImportError:
+    orjson = None
+
+try:
+    import numpy as np  # Optional: local aggregation of STH history
+except ImportError:
+    np = None
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # Load .env from the MCP's directory
@@ -30,6 +57,7 @@ mcp = FastMCP("FIWARE Context Broker Assistant")
 AUTH_TYPE = os.getenv("AUTH_TYPE", "oauth").lower()  # oauth, basic, or none
 AUTH_HOST = os.getenv("AUTH_HOST", "localhost")
 AUTH_PORT = os.getenv("AUTH_PORT", "15001")
+AUTH_PROTOCOL = os.getenv("AUTH_PROTOCOL", "https")  # Keystone is served over TLS in production
 CB_HOST = os.getenv("CB_HOST", "localhost")
 CB_PORT = os.getenv("CB_PORT", "1026")
 CB_PROTOCOL = os.getenv("CB_PROTOCOL", "https")  # http or https
@@ -51,33 +79,590 @@ CEP_PORT = os.getenv("CEP_PORT", "9090")
 IOTA_HOST = os.getenv("IOTA_HOST", CB_HOST)
 IOTA_PORT = os.getenv("IOTA_PORT", "4041")
 
+# QuantumLeap (time series sink, only used as a subscription target)
+QL_HOST = os.getenv("QL_HOST", CB_HOST)
+QL_PORT = os.getenv("QL_PORT", "8668")
+
+# HTTP connection pooling (one keep-alive pool per backend host:port)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))  # idle connections kept per backend
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "0"))  # hard per-host limit, 0 = unlimited
+HTTP_KEEPALIVE = os.getenv("HTTP_KEEPALIVE", "true").lower() == "true"
+
+# Timeouts in seconds; HTTP_TIMEOUTS overrides them per backend as "name=connect/read,..."
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+HTTP_TIMEOUTS = os.getenv("HTTP_TIMEOUTS", "")
+
+# Retries of idempotent requests (and of requests that never reached the backend), with jittered backoff
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_RETRY_BASE = float(os.getenv("HTTP_RETRY_BASE", "0.2"))  # seconds, doubled on each retry
+HTTP_RETRY_MAX_DELAY = float(os.getenv("HTTP_RETRY_MAX_DELAY", "5"))
+
+# Circuit breaker per host: open after N consecutive failures (0 disables), probe again after M seconds
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+# Seconds before Keystone token expiry at which it is refreshed in the background
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+
+# Auto-pagination (Orion caps limit at 1000)
+PAGINATION_PAGE_SIZE = int(os.getenv("PAGINATION_PAGE_SIZE", "1000"))
+PAGINATION_CONCURRENCY = int(os.getenv("PAGINATION_CONCURRENCY", "4"))  # pages fetched in parallel
+
+# Batch writes through /v2/op/update (Orion rejects bodies over 1 MB by default, see -inReqPayloadMaxSize)
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", "1000000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))  # batches in flight
+BATCH_RETRY_BASE = float(os.getenv("BATCH_RETRY_BASE", "0.5"))  # seconds, doubled on each retry
+
+# Response cache for read-only CB endpoints: "path_prefix=ttl_seconds,..."; max bytes 0 disables it
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+RESPONSE_CACHE_TTLS = os.getenv("RESPONSE_CACHE_TTLS", "/version=300,/v2/types=30,/v2/subscriptions=10")
+
+# STH-Comet raw history paging (hLimit is capped by STH's maxPageSize, 100 by default)
+STH_PAGE_SIZE = int(os.getenv("STH_PAGE_SIZE", "100"))
+STH_CONCURRENCY = int(os.getenv("STH_CONCURRENCY", "4"))  # time windows fetched in parallel
+
+# On-disk store of raw STH history, refreshed with delta fetches; max rows 0 disables it
+HISTORY_STORE_PATH = os.getenv("HISTORY_STORE_PATH", str(Path(__file__).parent / ".cache" / "sth_history.sqlite"))
+HISTORY_STORE_MAX_ROWS = int(os.getenv("HISTORY_STORE_MAX_ROWS", "5000000"))
+
+# Bulk imports: file_path arguments are only read from this directory
+IMPORT_DIR = os.getenv("IMPORT_DIR", str(Path(__file__).parent / "imports"))
+
+# Entity mirror: URL at which Orion reaches this server's /notify/mirror route (--http mode).
+# Without it, mirrors are snapshots refreshed by calling cb_mirror_start again.
+MIRROR_NOTIFY_URL = os.getenv("MIRROR_NOTIFY_URL", "")
+MIRROR_MAX_ENTITIES = int(os.getenv("MIRROR_MAX_ENTITIES", "500000"))  # per tenant
+# Federated queries: named brokers as "name=protocol://host:port,...", per-target timeout and fan-out width
+FEDERATION_BROKERS = os.getenv("FEDERATION_BROKERS", "")
+FEDERATION_TIMEOUT = float(os.getenv("FEDERATION_TIMEOUT", "10"))
+FEDERATION_CONCURRENCY = int(os.getenv("FEDERATION_CONCURRENCY", "16"))
+# Subscription tools: POSTs in flight during bulk creation; a subscription whose notifications
+# arrive faster than this share of its throttling limit is reported as throttle-bound
+SUBSCRIPTION_CONCURRENCY = int(os.getenv("SUBSCRIPTION_CONCURRENCY", "8"))
+SUBSCRIPTION_THROTTLE_RATIO = float(os.getenv("SUBSCRIPTION_THROTTLE_RATIO", "0.8"))
+SPATIAL_CELL_DEGREES = float(os.getenv("SPATIAL_CELL_DEGREES", "0.01"))  # grid cell of the mirror's spatial index
+
+# Raw STH series kept in memory for sth_local_aggregate follow-up questions
+SERIES_CACHE_SIZE = int(os.getenv("SERIES_CACHE_SIZE", "32"))
+
+# Smart Data Models: on-disk schema cache, revalidated with ETag/Last-Modified after SDM_REVALIDATE_AFTER seconds
+SDM_BASE_URL = os.getenv("SDM_BASE_URL", "https://raw.githubusercontent.com/smart-data-models")
+SDM_CACHE_DIR = os.getenv("SDM_CACHE_DIR", str(Path(__file__).parent / ".cache" / "smart-data-models"))
+SDM_REVALIDATE_AFTER = int(os.getenv("SDM_REVALIDATE_AFTER", "86400"))
+SDM_MEMORY_CACHE_SIZE = int(os.getenv("SDM_MEMORY_CACHE_SIZE", "64"))  # processed models kept in memory
+SDM_OFFLINE = os.getenv("SDM_OFFLINE", "false").lower() == "true"  # serve from SDM_CACHE_DIR only
+
+# Streaming (NDJSON) output: read size per chunk, and the byte budget of the /stream/{source} route
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "65536"))
+STREAM_MAX_BYTES = int(os.getenv("STREAM_MAX_BYTES", "100000000"))
+
+# Tool output: "pretty" (indented JSON) or "compact" (minified JSON)
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "pretty").lower()
+
+# Share one backend call between identical concurrent GET requests
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "true").lower() == "true"
+
+# Latency/payload histograms, served at /metrics (--http) and as the fiware://metrics resource
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Max number of service/servicepath pairs with a cached token and headers
+TENANT_CACHE_SIZE = int(os.getenv("TENANT_CACHE_SIZE", "64"))
+
+# HTTP client used by the tools: async (httpx) or sync (requests in worker threads)
+HTTP_CLIENT = os.getenv("HTTP_CLIENT", "async").lower()
+
 # Debug log
 print(f"[FIWARE-MCP] AUTH_TYPE={AUTH_TYPE}, CB_HOST={CB_HOST}:{CB_PORT}, PROTOCOL={CB_PROTOCOL}", file=sys.stderr)
 
-_token_cache = AUTH_TOKEN if AUTH_TOKEN else None
+# =============================================================================
+# HTTP SESSIONS - Pooled keep-alive connections per backend
+# =============================================================================
+
+_sessions = {}
+_sessions_lock = threading.Lock()
 
 
-def refresh_token() -> Optional[str]:
-    global _token_cache
-    _token_cache = None
-    return get_auth_token()
+def _backend_name(netloc: str) -> str:
+    """Map a host:port to the FIWARE component it belongs to"""
+    backends = [
+        ("context_broker", CB_HOST, CB_PORT),
+        ("sth_comet", STH_HOST, STH_PORT),
+        ("perseo_cep", CEP_HOST, CEP_PORT),
+        ("iot_agent", IOTA_HOST, IOTA_PORT),
+        ("keystone", AUTH_HOST, AUTH_PORT),
+    ]
+    for name, host, port in backends:
+        if netloc == f"{host}:{port}":
+            return name
+    return netloc
 
 
-def get_auth_token() -> Optional[str]:
-    """Get OAuth token using OpenStack Keystone password auth"""
-    global _token_cache
-    if _token_cache:
-        return _token_cache
+def get_session(url: str) -> requests.Session:
+    """Get the pooled session for the backend serving this URL"""
+    netloc = urlsplit(url).netloc
+    session = _sessions.get(netloc)
+    if session:
+        return session
+    
+    with _sessions_lock:
+        if netloc not in _sessions:
+            session = requests.Session()
+            # With a hard limit the pool blocks instead of opening extra connections
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=HTTP_MAX_CONNECTIONS or HTTP_POOL_SIZE,
+                pool_block=HTTP_MAX_CONNECTIONS > 0,
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            if not HTTP_KEEPALIVE:
+                session.headers["Connection"] = "close"
+            _sessions[netloc] = session
+        return _sessions[netloc]
+
+
+def get_connection_stats() -> dict:
+    """Connection reuse counters per backend, read from the urllib3 pools"""
+    stats = {}
+    for netloc, session in list(_sessions.items()):
+        requests_sent = 0
+        new_connections = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_sent += pool.num_requests
+                new_connections += pool.num_connections
+        stats[netloc] = {"requests": requests_sent, "new_connections": new_connections}
+    
+    for netloc, counters in list(_async_connection_counters.items()):
+        entry = stats.setdefault(netloc, {"requests": 0, "new_connections": 0})
+        entry["requests"] += counters["requests"]
+        entry["new_connections"] += counters["new_connections"]
+    
+    backends = {}
+    for netloc, entry in stats.items():
+        requests_sent = entry["requests"]
+        new_connections = entry["new_connections"]
+        backends[_backend_name(netloc)] = {
+            "host": netloc,
+            "requests": requests_sent,
+            "new_connections": new_connections,
+            "reused_connections": max(requests_sent - new_connections, 0),
+            "reuse_ratio": round(1 - new_connections / requests_sent, 3) if requests_sent else None,
+        }
+    return {
+        "client": HTTP_CLIENT,
+        "keepalive": HTTP_KEEPALIVE,
+        "pool_size": HTTP_POOL_SIZE,
+        "max_connections_per_host": HTTP_MAX_CONNECTIONS or None,
+        "backends": backends,
+    }
+
+
+# =============================================================================
+# RESILIENCE - Per-backend timeouts, retries and circuit breakers
+# =============================================================================
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+def _parse_timeouts(value: str) -> dict:
+    """Parse "sth_comet=5/60,perseo_cep=3" into {backend: (connect, read)}"""
+    timeouts = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, seconds = item.split("=", 1)
+            connect, _, read = seconds.partition("/")
+            timeouts[name.strip()] = (float(connect), float(read)) if read else (HTTP_CONNECT_TIMEOUT, float(connect))
+    return timeouts
+
+
+_backend_timeouts = _parse_timeouts(HTTP_TIMEOUTS)
+
+
+def timeout_for(url: str) -> tuple:
+    """(connect, read) timeout in seconds for the backend serving this URL"""
+    return _backend_timeouts.get(_backend_name(urlsplit(url).netloc), (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+
+
+class BackendUnavailable(RuntimeError):
+    """Raised without contacting a backend whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Fails fast for a host after `threshold` consecutive failures.
+    
+    Connection errors, timeouts and 5xx responses count as failures. Once open,
+    requests are rejected for `reset_timeout` seconds; then a single probe
+    request is let through (half-open) and its outcome closes or reopens it.
+    """
+    
+    def __init__(self, netloc: str, threshold: int, reset_timeout: float):
+        self.netloc = netloc
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.requests = 0
+        self.retries = 0
+        self.rejected = 0
+        self.times_opened = 0
+        self.last_error = None
+    
+    def retry_in(self) -> float:
+        return max(self.opened_at + self.reset_timeout - time.monotonic(), 0)
+    
+    def allow(self) -> bool:
+        if self.state == "closed" or not self.threshold:
+            return True
+        if self.state == "open":
+            if self.retry_in() > 0:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self.probing = False
+        if self.probing:
+            self.rejected += 1
+            return False
+        self.probing = True
+        return True
+    
+    def record(self, error: str = None):
+        """Record the outcome of a request: None for a healthy response, else the error"""
+        self.probing = False
+        if error is None:
+            self.state = "closed"
+            self.failures = 0
+            return
+        self.failures += 1
+        self.last_error = error
+        if self.threshold and (self.state == "half_open" or self.failures >= self.threshold):
+            if self.state != "open":
+                self.times_opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
     
+    def unavailable(self) -> BackendUnavailable:
+        return BackendUnavailable(
+            f"{_backend_name(self.netloc)} ({self.netloc}) is failing: circuit open after {self.failures} "
+            f"consecutive failures, retrying in {self.retry_in():.0f}s. Last error: {self.last_error}"
+        )
+    
+    def status(self) -> dict:
+        connect, read = timeout_for(f"//{self.netloc}")
+        return {
+            "host": self.netloc,
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "retry_in_seconds": round(self.retry_in(), 1) if self.state == "open" else None,
+            "requests": self.requests,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "times_opened": self.times_opened,
+            "last_error": self.last_error,
+            "timeouts": {"connect": connect, "read": read},
+        }
+
+
+_breakers = {}
+
+
+def get_breaker(url: str) -> CircuitBreaker:
+    netloc = urlsplit(url).netloc
+    breaker = _breakers.get(netloc)
+    if breaker is None:
+        breaker = _breakers[netloc] = CircuitBreaker(netloc, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+    return breaker
+
+
+def _not_sent(error: Exception) -> bool:
+    """True if the request never reached the backend, so retrying it is safe for any method"""
+    if isinstance(error, (BackendUnavailable, httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout,
+                          requests.exceptions.ConnectTimeout)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        # requests also raises it when the connection drops after the request was sent:
+        # only a connection that could not be opened (refused, unresolvable host) is safe
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+def _retry_delay(attempt: int, response=None) -> float:
+    """Full-jitter exponential backoff, or the backend's Retry-After if longer"""
+    delay = random.uniform(0, min(HTTP_RETRY_MAX_DELAY, HTTP_RETRY_BASE * 2 ** attempt))
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, min(float(retry_after), HTTP_RETRY_MAX_DELAY))
+    return delay
+
+
+# =============================================================================
+# METRICS - Latency and payload histograms in Prometheus text format
+# =============================================================================
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SERIALIZATION_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25, 1)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+METRIC_DEFINITIONS = {
+    "fiware_backend_request_seconds": ("histogram", SECONDS_BUCKETS, "Backend request latency per attempt"),
+    "fiware_backend_response_bytes": ("histogram", BYTES_BUCKETS, "Backend response body size"),
+    "fiware_backend_requests_total": ("counter", None, "Backend requests by status code"),
+    "fiware_auth_seconds": ("histogram", SECONDS_BUCKETS, "Keystone token request latency"),
+    "fiware_tool_seconds": ("histogram", SECONDS_BUCKETS, "MCP tool call latency"),
+    "fiware_tool_output_bytes": ("histogram", BYTES_BUCKETS, "MCP tool result size"),
+    "fiware_serialization_seconds": ("histogram", SERIALIZATION_BUCKETS, "Time spent encoding tool results as JSON"),
+    "fiware_mirror_lag_seconds": ("histogram", SECONDS_BUCKETS, "Delay between an entity change and its notification"),
+    "fiware_mirror_notifications_total": ("counter", None, "Entity mirror notifications by alteration type"),
+}
+
+# Collection segments whose next path segment is an identifier, for endpoint templates
+_PATH_PARAMETERS = {
+    "entities": "{id}", "subscriptions": "{id}", "registrations": "{id}", "types": "{type}",
+    "attrs": "{attr}", "devices": "{device_id}", "rules": "{name}",
+    "type": "{type}", "id": "{id}", "attributes": "{attr}",
+}
+
+_current_tool = contextvars.ContextVar("current_tool", default=None)
+
+
+def endpoint_template(path: str) -> str:
+    """Replace ids in a URL path so metrics are grouped per endpoint (/v2/entities/{id}/attrs)"""
+    segments = path.split("/")
+    for i in range(1, len(segments)):
+        placeholder = _PATH_PARAMETERS.get(segments[i - 1])
+        if placeholder and segments[i] and not (i == 2 and segments[1] == "v2" and segments[i] == "op"):
+            segments[i] = placeholder
+    return "/".join(segments)
+
+
+def process_rss_bytes() -> Optional[int]:
+    """Current resident memory of this process (peak RSS where /proc is not available)"""
     try:
-        url = f"https://{AUTH_HOST}:{AUTH_PORT}/v3/auth/tokens"
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        try:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+        except ImportError:
+            return None
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as exposed by Prometheus"""
+    
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile by linear interpolation inside its bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Registry of labelled histograms and counters"""
+    
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._series = {}
+        self._lock = threading.Lock()
+    
+    def _get(self, name: str, labels: dict):
+        key = (name, tuple(sorted(labels.items())))
+        series = self._series.get(key)
+        if series is None:
+            kind, buckets, _ = METRIC_DEFINITIONS[name]
+            series = self._series[key] = Histogram(buckets) if kind == "histogram" else [0]
+        return series
+    
+    def observe(self, name: str, value: float, **labels):
+        if self.enabled:
+            with self._lock:
+                self._get(name, labels).observe(value)
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        if self.enabled:
+            with self._lock:
+                self._get(name, labels)[0] += value
+    
+    def prometheus(self) -> str:
+        """Text exposition format for a /metrics scrape"""
+        lines = []
+        with self._lock:
+            series = sorted(self._series.items(), key=lambda item: item[0])
+        for name, (kind, _, help_text) in METRIC_DEFINITIONS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for (series_name, labels), value in series:
+                if series_name != name:
+                    continue
+                label_text = ",".join(f'{key}="{str(val).replace(chr(34), chr(39))}"' for key, val in labels)
+                if kind == "counter":
+                    lines.append(f"{name}{{{label_text}}} {value[0]}")
+                    continue
+                prefix = f"{label_text}," if label_text else ""
+                cumulative = 0
+                for bucket, count in zip(value.buckets + ("+Inf",), value.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bucket}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{label_text}}} {value.sum:.6f}")
+                lines.append(f"{name}_count{{{label_text}}} {value.count}")
+        rss = process_rss_bytes()
+        if rss is not None:
+            lines += ["# HELP process_resident_memory_bytes Resident memory size",
+                      "# TYPE process_resident_memory_bytes gauge",
+                      f"process_resident_memory_bytes {rss}"]
+        return "\n".join(lines) + "\n"
+    
+    def summary(self) -> dict:
+        """Count, mean and estimated p50/p95/p99 per series, for reading by an agent"""
+        result = {}
+        with self._lock:
+            series = sorted(self._series.items(), key=lambda item: item[0])
+        for (name, labels), value in series:
+            label_text = ",".join(f"{key}={val}" for key, val in labels) or "all"
+            if isinstance(value, Histogram):
+                entry = {
+                    "count": value.count,
+                    "mean": round(value.sum / value.count, 6) if value.count else None,
+                    **{f"p{round(q * 100)}": round(value.quantile(q), 6) for q in (0.5, 0.95, 0.99)},
+                }
+            else:
+                entry = value[0]
+            result.setdefault(name, {})[label_text] = entry
+        return {"enabled": self.enabled, "process_rss_bytes": process_rss_bytes(), "metrics": result}
+
+
+metrics = Metrics(METRICS_ENABLED)
+
+
+class ToolMetricsMiddleware(Middleware):
+    """Times every tool call and measures its result, tagging nested metrics with the tool name"""
+    
+    async def on_call_tool(self, context, call_next):
+        name = context.message.name
+        token = _current_tool.set(name)
+        start = time.perf_counter()
+        try:
+            result = await call_next(context)
+        except Exception:
+            metrics.observe("fiware_tool_seconds", time.perf_counter() - start, tool=name, status="exception")
+            raise
+        finally:
+            _current_tool.reset(token)
+        
+        text = "".join(getattr(block, "text", "") for block in result.content or [])
+        status = "error" if text[:20].lstrip("{ \n").startswith('"error"') else "ok"
+        metrics.observe("fiware_tool_seconds", time.perf_counter() - start, tool=name, status=status)
+        metrics.observe("fiware_tool_output_bytes", len(text.encode()), tool=name)
+        return result
+
+
+mcp.add_middleware(ToolMetricsMiddleware())
+
+
+# =============================================================================
+# KEYSTONE TOKENS - Expiry-aware, single-flight token refresh
+# =============================================================================
+
+class TokenManager:
+    """
+    Keystone token for one service/subservice scope.
+    
+    Reads expires_at from the Keystone response and refreshes in a background
+    timer before expiry. Concurrent refreshes collapse into one Keystone request.
+    """
+    
+    def __init__(self, service: str, subservice: str, token: Optional[str] = None):
+        self.service = service
+        self.subservice = subservice
+        self._token = token or None
+        self._expires_at = None  # epoch seconds, None if unknown
+        self._stale_at = None  # past this point callers refresh synchronously
+        self._lock = threading.Lock()
+        self._timer = None
+        self.refresh_count = 0
+    
+    def _is_expiring(self) -> bool:
+        return self._stale_at is not None and time.time() >= self._stale_at
+    
+    def current(self) -> Optional[str]:
+        """Token if cached and still valid, without any network call"""
+        if self._token and not self._is_expiring():
+            return self._token
+        return None
+    
+    def get_token(self) -> Optional[str]:
+        """Cached token, fetching a new one if missing or about to expire"""
+        token = self.current()
+        if token:
+            return token
+        return self.refresh(stale_token=self._token)
+    
+    def refresh(self, stale_token: Optional[str] = None) -> Optional[str]:
+        """
+        Fetch a new token from Keystone.
+        
+        Callers pass the token they consider stale; if another caller already
+        replaced it while we waited for the lock, that token is reused.
+        """
+        with self._lock:
+            if self._token and self._token != stale_token and not self._is_expiring():
+                return self._token
+            
+            try:
+                token, expires_at = self._request_token()
+            except Exception as e:
+                print(f"Auth error: {e}", file=sys.stderr)
+                return None
+            
+            self._token = token
+            self._expires_at = expires_at
+            self.refresh_count += 1
+            self._schedule_refresh()
+            return token
+    
+    def _refresh_margin(self) -> float:
+        # Short-lived tokens: never spend more than half their lifetime refreshing
+        return min(TOKEN_REFRESH_MARGIN, max(self._expires_at - time.time(), 0) / 2)
+    
+    def _request_token(self):
+        url = f"{AUTH_PROTOCOL}://{AUTH_HOST}:{AUTH_PORT}/v3/auth/tokens"
         payload = {
             "auth": {
                 "identity": {
                     "methods": ["password"],
                     "password": {
                         "user": {
-                            "domain": {"name": SERVICE},
+                            "domain": {"name": self.service},
                             "name": USERNAME,
                             "password": PASSWORD
                         }
@@ -85,161 +670,3229 @@ def get_auth_token() -> Optional[str]:
                 },
                 "scope": {
                     "project": {
-                        "domain": {"name": SERVICE},
-                        "name": SUBSERVICE
+                        "domain": {"name": self.service},
+                        "name": self.subservice
                     }
                 }
             }
         }
-        response = requests.post(url, json=payload, headers={"Content-Type": "application/json"}, timeout=10, verify=False)
+        start = time.perf_counter()
+        response = get_session(url).post(url, json=payload, headers={"Content-Type": "application/json"},
+                                         timeout=timeout_for(url), verify=False)
+        metrics.observe("fiware_auth_seconds", time.perf_counter() - start, status=response.status_code)
         response.raise_for_status()
-        _token_cache = response.headers.get("X-Subject-Token")
-        return _token_cache
-    except Exception as e:
-        print(f"Auth error: {e}", file=sys.stderr)
-        return None
+        
+        expires_at = None
+        try:
+            expires = response.json()["token"]["expires_at"]
+            expires_at = datetime.fromisoformat(expires.replace("Z", "+00:00")).timestamp()
+        except Exception:
+            pass  # No expiry info: rely on the 401 fallback
+        
+        return response.headers.get("X-Subject-Token"), expires_at
+    
+    def _schedule_refresh(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._expires_at is None:
+            self._stale_at = None
+            return
+        
+        margin = self._refresh_margin()
+        self._stale_at = self._expires_at - margin / 2
+        delay = max(self._expires_at - time.time() - margin, 1)
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+    
+    def _background_refresh(self):
+        stale_token = self._token
+        if self.refresh(stale_token=stale_token) is None and self._expires_at and time.time() < self._expires_at:
+            # Keystone unavailable: retry while the current token is still valid
+            self._timer = threading.Timer(min(30, max(self._expires_at - time.time(), 1)), self._background_refresh)
+            self._timer.daemon = True
+            self._timer.start()
+    
+    def close(self):
+        """Stop the background refresh"""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+    
+    def status(self) -> dict:
+        return {
+            "service": self.service,
+            "subservice": self.subservice,
+            "has_token": self._token is not None,
+            "expires_in": round(self._expires_at - time.time()) if self._expires_at else None,
+            "refresh_count": self.refresh_count,
+        }
 
 
-def make_request(method: str, url: str, body: dict = None) -> requests.Response:
-    """Make authenticated request based on AUTH_TYPE"""
-    headers = {
-        "Accept": "application/json",
-        "Fiware-Service": SERVICE,
-        "Fiware-ServicePath": SUBSERVICE,
-    }
+# =============================================================================
+# TENANTS - Per Fiware-Service/ServicePath tokens and headers
+# =============================================================================
+
+class Tenant:
+    """Token manager and prebuilt headers for one service/servicepath pair"""
+    
+    def __init__(self, service: str, subservice: str):
+        self.service = service
+        self.subservice = subservice
+        # A static AUTH_TOKEN from .env is only valid for the configured tenant
+        static_token = AUTH_TOKEN if (service, subservice) == (SERVICE, SUBSERVICE) else None
+        self.tokens = TokenManager(service, subservice, static_token)
+        self.read_headers = {
+            "Accept": "application/json",
+            "Fiware-Service": service,
+            "Fiware-ServicePath": subservice,
+        }
+        self.write_headers = dict(self.read_headers, **{"Content-Type": "application/json"})
     
-    if method.upper() in ["POST", "PUT", "PATCH"]:
-        headers["Content-Type"] = "application/json"
+    def headers(self, method: str) -> dict:
+        """Fresh copy of the headers for this method"""
+        if method.upper() in ["POST", "PUT", "PATCH"]:
+            return dict(self.write_headers)
+        return dict(self.read_headers)
+
+
+_tenants = OrderedDict()
+_tenants_lock = threading.Lock()
+
+
+def get_tenant(service: str = None, servicepath: str = None) -> Tenant:
+    """Cached tenant context, defaulting to SERVICE/SUBSERVICE from .env"""
+    key = (SERVICE if service is None else service, servicepath or SUBSERVICE)
+    with _tenants_lock:
+        tenant = _tenants.get(key)
+        if tenant:
+            _tenants.move_to_end(key)
+            return tenant
+        
+        tenant = Tenant(*key)
+        _tenants[key] = tenant
+        while len(_tenants) > TENANT_CACHE_SIZE:
+            _, evicted = _tenants.popitem(last=False)
+            evicted.tokens.close()
+        return tenant
+
+
+def refresh_token(service: str = None, servicepath: str = None) -> Optional[str]:
+    """Force a new token, unless a concurrent caller just refreshed it"""
+    tokens = get_tenant(service, servicepath).tokens
+    return tokens.refresh(stale_token=tokens.current())
+
+
+def get_auth_token(service: str = None, servicepath: str = None) -> Optional[str]:
+    """Get OAuth token using OpenStack Keystone password auth"""
+    return get_tenant(service, servicepath).tokens.get_token()
+
+
+def make_request(method: str, url: str, body: dict = None,
+                 service: str = None, servicepath: str = None,
+                 extra_headers: dict = None) -> requests.Response:
+    """Make authenticated request based on AUTH_TYPE"""
+    tenant = get_tenant(service, servicepath)
+    headers = tenant.headers(method)
+    if extra_headers:
+        headers.update(extra_headers)
     
     # Determine authentication method
     auth = None
     verify_ssl = False
+    session = get_session(url)
+    timeout = timeout_for(url)
     
     if AUTH_TYPE == "oauth":
         # OAuth with OpenStack Keystone
-        token = get_auth_token()
+        token = tenant.tokens.get_token()
         if token:
             headers["x-auth-token"] = token
-        response = requests.request(method, url, headers=headers, json=body, timeout=10, verify=verify_ssl)
+        response = session.request(method, url, headers=headers, json=body, timeout=timeout, verify=verify_ssl)
         
-        # Auto-refresh token on 401
+        # Fallback for revoked tokens: expiry is normally handled by the background refresh
         if response.status_code == 401:
-            print("Token expired, refreshing...", file=sys.stderr)
-            refresh_token()
-            headers["x-auth-token"] = get_auth_token()
-            response = requests.request(method, url, headers=headers, json=body, timeout=10, verify=verify_ssl)
+            print("Token rejected, refreshing...", file=sys.stderr)
+            fresh_token = tenant.tokens.refresh(stale_token=token)
+            if fresh_token:  # Otherwise the 401 is the answer
+                headers["x-auth-token"] = fresh_token
+                response = session.request(method, url, headers=headers, json=body, timeout=timeout,
+                                           verify=verify_ssl)
         
         return response
     
     elif AUTH_TYPE == "basic":
         # HTTP Basic Authentication
         auth = HTTPBasicAuth(USERNAME, PASSWORD)
-        return requests.request(method, url, headers=headers, json=body, auth=auth, timeout=10, verify=verify_ssl)
+        return session.request(method, url, headers=headers, json=body, auth=auth, timeout=timeout, verify=verify_ssl)
     
     elif AUTH_TYPE == "none":
         # No authentication
-        return requests.request(method, url, headers=headers, json=body, timeout=10, verify=verify_ssl)
+        return session.request(method, url, headers=headers, json=body, timeout=timeout, verify=verify_ssl)
     
     else:
         raise ValueError(f"Invalid AUTH_TYPE: {AUTH_TYPE}. Must be 'oauth', 'basic', or 'none'.")
 
 
-@mcp.resource("fiware://examples")
-def get_api_examples() -> str:
-    """FIWARE NGSI-v2 API example collection (Postman format)"""
-    try:
-        with open("resources/fiware-ngsi-v2-examples.json", "r", encoding="utf-8") as f:
-            return f.read()
-    except FileNotFoundError:
-        return json.dumps({"error": "Example collection not found"})
+# =============================================================================
+# ASYNC HTTP - Non-blocking requests for the MCP tools
+# =============================================================================
+
+class BackendResponse:
+    """Transport-independent response returned by make_request_async"""
+    
+    def __init__(self, status_code: int, reason: str, headers, content: bytes):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+    
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+    
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+    
+    def json(self):
+        return json.loads(self.content)
+    
+    @classmethod
+    def from_requests(cls, response: requests.Response) -> "BackendResponse":
+        return cls(response.status_code, response.reason, response.headers, response.content)
+    
+    @classmethod
+    def from_httpx(cls, response: httpx.Response) -> "BackendResponse":
+        return cls(response.status_code, response.reason_phrase, response.headers, response.content)
 
 
-@mcp.tool()
-def CB_version() -> str:
-    """Check Context Broker version"""
+_async_clients = {}
+_async_connection_counters = {}
+_client_closers = set()  # tasks closing each client when its event loop shuts down
+
+
+async def _close_at_shutdown(client: httpx.AsyncClient):
+    """Wait until the loop cancels this task on shutdown (asyncio.run does), then close the client"""
     try:
-        url = f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/version"
-        response = make_request("GET", url)
-        return json.dumps({"success": True, "version": response.json()}, indent=2)
-    except Exception as e:
-        return json.dumps({"error": str(e)})
+        await asyncio.get_running_loop().create_future()
+    finally:
+        await client.aclose()
 
 
-@mcp.tool()
-def fiware_request(method: str, endpoint: str, body: dict = None) -> str:
-    """
-    Execute any FIWARE NGSI-v2 API request.
+def get_async_client(url: str) -> httpx.AsyncClient:
+    """Get the pooled async client for the backend serving this URL"""
+    netloc = urlsplit(url).netloc
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.get(netloc)
+    # httpx connections are bound to the event loop that opened them
+    if entry and entry[0] is loop:
+        return entry[1]
+    if entry and entry[0].is_running():
+        # Replaced while its loop still runs in another thread: close it there
+        asyncio.run_coroutine_threadsafe(entry[1].aclose(), entry[0])
     
-    Args:
-        method: HTTP method (GET, POST, PATCH, PUT, DELETE)
-        endpoint: API endpoint starting with / (e.g., "/v2/entities")
-        body: Optional request body for POST/PATCH/PUT
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS or None,
+        max_keepalive_connections=HTTP_POOL_SIZE if HTTP_KEEPALIVE else 0,
+    )
+    client = httpx.AsyncClient(limits=limits, verify=False)
+    _async_clients[netloc] = (loop, client)
+    closer = loop.create_task(_close_at_shutdown(client))
+    _client_closers.add(closer)
+    closer.add_done_callback(_client_closers.discard)
+    _async_connection_counters.setdefault(netloc, {"requests": 0, "new_connections": 0})
+    return client
+
+
+async def _send_async(method: str, url: str, headers: dict, body: dict = None, auth=None) -> httpx.Response:
+    """Send one request through the async pool, counting new connections"""
+    counters = _async_connection_counters.setdefault(urlsplit(url).netloc, {"requests": 0, "new_connections": 0})
     
-    Examples:
-        # Query entities
-        GET /v2/entities                           - List all entities
-        GET /v2/entities?type=Room                 - Filter by type
-        GET /v2/entities?limit=10                  - Limit results
-        GET /v2/entities?limit=10&offset=20        - Pagination
-        GET /v2/entities?q=temperature>20          - Query by attribute value
-        GET /v2/entities?attrs=temperature,pressure - Select specific attributes
-        GET /v2/entities?orderBy=temperature       - Order results
-        GET /v2/entities/{id}                      - Get entity by ID
-        GET /v2/entities/{id}?attrs=temperature    - Get specific attributes
-        GET /v2/entities/{id}/attrs/{attrName}     - Get single attribute
-        
-        # Entity types
-        GET /v2/types                              - List all entity types
-        GET /v2/types/{type}                       - Get type details
-        
-        # Create and modify entities
-        POST /v2/entities                          - Create entity (with body)
-        POST /v2/entities?options=keyValues        - Create with simplified format
-        PATCH /v2/entities/{id}/attrs              - Update attributes (with body)
-        PUT /v2/entities/{id}/attrs                - Replace all attributes (with body)
-        PUT /v2/entities/{id}/attrs/{attrName}     - Update single attribute (with body)
-        DELETE /v2/entities/{id}                   - Delete entity
-        DELETE /v2/entities/{id}/attrs/{attrName}  - Delete single attribute
-        
-        # Subscriptions
-        GET /v2/subscriptions                      - List subscriptions
-        GET /v2/subscriptions/{id}                 - Get subscription details
-        POST /v2/subscriptions                     - Create subscription (with body)
-        PATCH /v2/subscriptions/{id}               - Update subscription (with body)
-        DELETE /v2/subscriptions/{id}              - Delete subscription
+    async def trace(event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            counters["new_connections"] += 1
+    
+    counters["requests"] += 1
+    client = get_async_client(url)
+    connect, read = timeout_for(url)
+    return await client.request(method, url, headers=headers, json=body, auth=auth,
+                                timeout=httpx.Timeout(read, connect=connect),
+                                extensions={"trace": trace})
+
+
+async def _send_request(method: str, url: str, body: dict = None,
+                        service: str = None, servicepath: str = None,
+                        extra_headers: dict = None) -> BackendResponse:
+    """Send one authenticated request through the configured HTTP client"""
+    if HTTP_CLIENT == "sync":
+        # Fallback: run the requests-based client in a worker thread
+        response = await asyncio.to_thread(make_request, method, url, body, service, servicepath, extra_headers)
+        return BackendResponse.from_requests(response)
+    
+    tenant = get_tenant(service, servicepath)
+    headers = tenant.headers(method)
+    if extra_headers:
+        headers.update(extra_headers)
+    
+    if AUTH_TYPE == "oauth":
+        token = tenant.tokens.current() or await asyncio.to_thread(tenant.tokens.get_token)
+        if token:
+            headers["x-auth-token"] = token
+        response = await _send_async(method, url, headers, body)
         
-        # Batch operations
-        POST /v2/op/update                         - Batch update (with body)
-        POST /v2/op/query                          - Batch query (with body)
+        # Fallback for revoked tokens: expiry is normally handled by the background refresh
+        if response.status_code == 401:
+            print("Token rejected, refreshing...", file=sys.stderr)
+            fresh_token = await asyncio.to_thread(tenant.tokens.refresh, token)
+            if fresh_token:  # Otherwise the 401 is the answer
+                headers["x-auth-token"] = fresh_token
+                response = await _send_async(method, url, headers, body)
+    
+    elif AUTH_TYPE == "basic":
+        response = await _send_async(method, url, headers, body, auth=httpx.BasicAuth(USERNAME, PASSWORD))
+    
+    elif AUTH_TYPE == "none":
+        response = await _send_async(method, url, headers, body)
+    
+    else:
+        raise ValueError(f"Invalid AUTH_TYPE: {AUTH_TYPE}. Must be 'oauth', 'basic', or 'none'.")
+    
+    return BackendResponse.from_httpx(response)
+
+
+async def _send_with_retries(method: str, url: str, body: dict = None,
+                             service: str = None, servicepath: str = None,
+                             extra_headers: dict = None) -> BackendResponse:
     """
-    try:
-        url = f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}{endpoint}"
-        response = make_request(method.upper(), url, body)
-        
+    _send_request behind the host's circuit breaker, retrying transient failures.
+    
+    Idempotent methods are retried on connection errors, timeouts and
+    429/502/503/504; POST and PATCH only when the request never left the client.
+    """
+    breaker = get_breaker(url)
+    idempotent = method in IDEMPOTENT_METHODS
+    parts = urlsplit(url)
+    labels = {"backend": _backend_name(parts.netloc), "method": method, "endpoint": endpoint_template(parts.path)}
+    for attempt in range(HTTP_RETRIES + 1):
+        if not breaker.allow():
+            metrics.inc("fiware_backend_requests_total", status="circuit_open", **labels)
+            raise breaker.unavailable()
+        breaker.requests += 1
+        start = time.perf_counter()
         try:
-            data = response.json() if response.text else None
-        except:
-            data = response.text
-        
-        result = {
-            "success": response.ok,
-            "status_code": response.status_code,
-        }
-        
-        if response.ok:
-            result["data"] = data
+            response = await _send_request(method, url, body, service, servicepath, extra_headers)
+        except (httpx.TransportError, requests.ConnectionError, requests.Timeout) as e:
+            metrics.observe("fiware_backend_request_seconds", time.perf_counter() - start, **labels)
+            metrics.inc("fiware_backend_requests_total", status=type(e).__name__, **labels)
+            breaker.record(f"{type(e).__name__}: {e}")
+            if attempt == HTTP_RETRIES or not (idempotent or _not_sent(e)):
+                raise
+            delay = _retry_delay(attempt)
+        except BaseException:
+            breaker.probing = False  # Cancelled or unrelated error: let the next request probe
+            raise
+        else:
+            metrics.observe("fiware_backend_request_seconds", time.perf_counter() - start, **labels)
+            metrics.observe("fiware_backend_response_bytes", len(response.content), **labels)
+            metrics.inc("fiware_backend_requests_total", status=response.status_code, **labels)
+            breaker.record(f"HTTP {response.status_code} {response.reason}" if response.status_code >= 500 else None)
+            if attempt == HTTP_RETRIES or not idempotent or response.status_code not in RETRY_STATUS_CODES:
+                return response
+            delay = _retry_delay(attempt, response)
+        breaker.retries += 1
+        await asyncio.sleep(delay)
+
+
+class SingleFlight:
+    """
+    Collapses identical concurrent calls into one: the first caller starts the
+    call as a task and later callers with the same key await the same task.
+    The task is shielded, so a cancelled caller doesn't cancel it for the others.
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+    
+    async def run(self, key, func, *args):
+        key = (asyncio.get_running_loop(), key)
+        task = self._calls.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(func(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+    
+    def _done(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved here in case every caller was cancelled
+    
+    def stats(self) -> dict:
+        return {
+            "enabled": SINGLE_FLIGHT,
+            "in_flight": len(self._calls),
+            "backend_calls": self.calls,
+            "shared_calls": self.shared,
+        }
+
+
+_single_flight = SingleFlight()
+
+
+async def make_request_async(method: str, url: str, body: dict = None,
+                             service: str = None, servicepath: str = None,
+                             extra_headers: dict = None) -> BackendResponse:
+    """Make authenticated request without blocking the event loop"""
+    method = method.upper()
+    if SINGLE_FLIGHT and method in ("GET", "HEAD") and body is None:
+        tenant = get_tenant(service, servicepath)
+        key = (method, url, tenant.service, tenant.subservice, tuple(sorted((extra_headers or {}).items())))
+        return await _single_flight.run(key, _make_request_async, method, url, body,
+                                        service, servicepath, extra_headers)
+    return await _make_request_async(method, url, body, service, servicepath, extra_headers)
+
+
+async def _make_request_async(method: str, url: str, body: dict = None,
+                              service: str = None, servicepath: str = None,
+                              extra_headers: dict = None) -> BackendResponse:
+    tenant = get_tenant(service, servicepath)
+    parts = urlsplit(url)
+    cacheable = parts.netloc == f"{CB_HOST}:{CB_PORT}"
+    
+    if not cacheable or method not in ["GET", "POST", "PUT", "PATCH", "DELETE"]:
+        return await _send_with_retries(method, url, body, service, servicepath, extra_headers)
+    
+    if method != "GET":
+        response = await _send_with_retries(method, url, body, service, servicepath, extra_headers)
+        _response_cache.invalidate(tenant.service, parts.path)
+        return response
+    
+    ttl = _response_cache.ttl_for(parts.path)
+    if ttl is None or extra_headers:
+        return await _send_with_retries(method, url, body, service, servicepath, extra_headers)
+    
+    key = (tenant.service, tenant.subservice, url)
+    entry = _response_cache.get(key)
+    if entry and entry.fresh():
+        return entry.response
+    
+    generation = _response_cache.generation
+    validators = entry.validators() if entry else None
+    response = await _send_with_retries(method, url, body, service, servicepath, validators)
+    
+    if response.status_code == 304 and entry:
+        _response_cache.revalidated(key, ttl)
+        return entry.response
+    if response.ok:
+        _response_cache.put(key, parts.path, response, ttl, generation)
+    return response
+
+
+# =============================================================================
+# RESPONSE CACHE - TTL + revalidation for read-only Context Broker endpoints
+# =============================================================================
+
+class CacheEntry:
+    def __init__(self, path: str, response: BackendResponse, ttl: float):
+        self.path = path
+        self.response = response
+        self.size = len(response.content) + 200  # body plus rough overhead
+        self.expires_at = time.time() + ttl
+    
+    def fresh(self) -> bool:
+        return time.time() < self.expires_at
+    
+    def validators(self) -> Optional[dict]:
+        """Conditional request headers to revalidate an expired entry"""
+        headers = {}
+        if "ETag" in self.response.headers:
+            headers["If-None-Match"] = self.response.headers["ETag"]
+        if "Last-Modified" in self.response.headers:
+            headers["If-Modified-Since"] = self.response.headers["Last-Modified"]
+        return headers or None
+
+
+def _is_under(path: str, prefix: str) -> bool:
+    """True if path is prefix or one of its sub-paths"""
+    return (path.rstrip("/") + "/").startswith(prefix.rstrip("/") + "/")
+
+
+def _overlaps(path_a: str, path_b: str) -> bool:
+    return _is_under(path_a, path_b) or _is_under(path_b, path_a)
+
+
+class ResponseCache:
+    """
+    In-process cache of GET responses with per-endpoint TTLs and LRU eviction
+    by total byte size. Writes invalidate cached paths that overlap them.
+    """
+    
+    def __init__(self, max_bytes: int, ttls: dict):
+        self.max_bytes = max_bytes
+        # Longest prefix wins
+        self.ttls = sorted(ttls.items(), key=lambda item: len(item[0]), reverse=True)
+        self._entries = OrderedDict()
+        self._size = 0
+        self.generation = 0  # bumped by every invalidation, guards in-flight GETs
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def ttl_for(self, path: str) -> Optional[float]:
+        if self.max_bytes <= 0:
+            return None
+        for prefix, ttl in self.ttls:
+            if _is_under(path, prefix):
+                return ttl
+        return None
+    
+    def get(self, key) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry and entry.fresh():
+            self._entries.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+    
+    def put(self, key, path: str, response: BackendResponse, ttl: float, generation: int):
+        if generation != self.generation:
+            return  # A write happened while this GET was in flight
+        entry = CacheEntry(path, response, ttl)
+        if entry.size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = entry
+        self._size += entry.size
+        while self._size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+    
+    def revalidated(self, key, ttl: float):
+        entry = self._entries.get(key)
+        if entry:
+            entry.expires_at = time.time() + ttl
+            self._entries.move_to_end(key)
+            self.revalidations += 1
+    
+    def invalidate(self, service: str, path: str):
+        """Drop entries of this service whose path overlaps a written path"""
+        paths = [path]
+        if path.startswith("/v2/entities") or path.startswith("/v2/op/update"):
+            paths.append("/v2/types")  # Types are derived from entities
+        if path.startswith("/v2/op/update"):
+            paths.append("/v2/entities")
+        
+        self.generation += 1
+        for key in list(self._entries):
+            entry = self._entries[key]
+            if key[0] == service and any(_overlaps(entry.path, p) for p in paths):
+                self._remove(key)
+                self.invalidations += 1
+    
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._size -= entry.size
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.max_bytes > 0,
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "ttls": dict(self.ttls),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            "revalidations": self.revalidations,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+def _parse_ttls(value: str) -> dict:
+    """Parse "/version=300,/v2/types=30" into {path_prefix: seconds}"""
+    ttls = {}
+    for item in value.split(","):
+        if "=" in item:
+            prefix, seconds = item.split("=", 1)
+            ttls[prefix.strip()] = float(seconds)
+    return ttls
+
+
+_response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, _parse_ttls(RESPONSE_CACHE_TTLS))
+
+
+# =============================================================================
+# PAGINATION - Concurrent limit/offset paging
+# =============================================================================
+
+def with_query(url: str, **params) -> str:
+    """Return url with the given query parameters set (None removes them)"""
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query, keep_blank_values=True))
+    for key, value in params.items():
+        if value is None:
+            query.pop(key, None)
+        else:
+            query[key] = str(value)
+    return urlunsplit(parts._replace(query=urlencode(query, safe=",:/;<>=!~*'()", quote_via=quote)))
+
+
+async def iter_ordered(func, args, concurrency: int):
+    """
+    Await func(arg) for each arg with at most `concurrency` calls in flight,
+    yielding results in input order. Closing the generator cancels pending calls.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    args = iter(args)
+    pending = deque()
+    try:
+        for arg in args:
+            pending.append(asyncio.ensure_future(func(arg)))
+            if len(pending) >= concurrency:
+                break
+        while pending:
+            result = await pending.popleft()
+            for arg in args:
+                pending.append(asyncio.ensure_future(func(arg)))
+                break
+            yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class HostRateLimiter:
+    """Spaces requests so each host receives at most `rate` requests per second"""
+    
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate and rate > 0 else 0
+        self._next_slot = {}
+    
+    async def acquire(self, url: str):
+        if not self.interval:
+            return
+        netloc = urlsplit(url).netloc
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_slot.get(netloc, now))
+        self._next_slot[netloc] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def chunked(items: list, max_items: int, max_bytes: int) -> list:
+    """Split items into lists of at most max_items whose JSON encoding stays under max_bytes"""
+    chunks, chunk, size = [], [], 2
+    for item in items:
+        item_size = len(json.dumps(item, separators=(",", ":"))) + 1
+        if chunk and (len(chunk) >= max_items or size + item_size > max_bytes):
+            chunks.append(chunk)
+            chunk, size = [], 2
+        chunk.append(item)
+        size += item_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+async def iter_pages(url: str, items_key: str = None, total_key: str = None,
+                     max_items: int = None, page_size: int = PAGINATION_PAGE_SIZE,
+                     concurrency: int = PAGINATION_CONCURRENCY,
+                     service: str = None, servicepath: str = None, extra_headers: dict = None):
+    """
+    Yield (response, items, total) for each page of a limit/offset endpoint, in order.
+    
+    The first page is fetched alone to learn the total count (Orion's
+    Fiware-Total-Count header, or body[total_key] for the IoT Agent); the rest
+    are fetched ahead with at most `concurrency` requests in flight. Items are
+    the response list, or body[items_key]. Iteration stops after a failed page,
+    and after a first page whose items are not a list (e.g. a single entity),
+    which is yielded unchanged.
+    extra_headers are sent with every page (and bypass the response cache).
+    """
+    query = dict(parse_qsl(urlsplit(url).query))
+    start = int(query.get("offset", 0))
+    options = [o for o in query.get("options", "").split(",") if o]
+    if total_key is None and "count" not in options:
+        options.append("count")
+    
+    async def fetch(offset: int):
+        page_url = with_query(url, offset=offset, limit=page_size, options=",".join(options) or None)
+        response = await make_request_async("GET", page_url, service=service, servicepath=servicepath,
+                                            extra_headers=extra_headers)
+        if not response.ok:
+            return response, None, None
+        data = response.json() if response.content else []
+        items = data.get(items_key, []) if items_key else data
+        total = data.get(total_key) if total_key else response.headers.get("Fiware-Total-Count")
+        return response, items, int(total) if total is not None else None
+    
+    response, items, total = await fetch(start)
+    yield response, items, total
+    if not response.ok or not isinstance(items, list) or len(items) < page_size:
+        return
+    
+    if total is None:
+        # No count available: walk pages one by one until a short page
+        offset = start + page_size
+        while max_items is None or offset < start + max_items:
+            response, items, _ = await fetch(offset)
+            yield response, items, None
+            if not response.ok or len(items) < page_size:
+                return
+            offset += page_size
+        return
+    
+    end = total if max_items is None else min(total, start + max_items)
+    pages = iter_ordered(fetch, range(start + page_size, end, page_size), concurrency)
+    try:
+        async for response, items, _ in pages:
+            yield response, items, total
+            if not response.ok:
+                return
+    finally:
+        await pages.aclose()
+
+
+async def _paginated_request(url: str, max_entities: int, max_bytes: int,
+                             service: str = None, servicepath: str = None) -> dict:
+    """Merge pages of a list endpoint into one result, bounded by entity and byte caps"""
+    start = int(dict(parse_qsl(urlsplit(url).query)).get("offset", 0))
+    entities = []
+    size = 0
+    total = None
+    pages = 0
+    truncated = False
+    
+    page_iter = iter_pages(url, max_items=max_entities, service=service, servicepath=servicepath)
+    try:
+        async for response, items, page_total in page_iter:
+            if not response.ok:
+                try:
+                    error = response.json() if response.text else None
+                except ValueError:
+                    error = response.text
+                if pages == 0:
+                    return {"success": False, "status_code": response.status_code, "error": error or response.reason}
+                # Keep what was merged so far
+                return {
+                    "success": False,
+                    "status_code": response.status_code,
+                    "error": error or response.reason,
+                    "data": entities,
+                    "count": len(entities),
+                    "next_offset": start + len(entities),
+                }
+            
+            if not isinstance(items, list):
+                # Not a list endpoint (e.g. /v2/entities/{id}): return the body as is
+                return {"success": True, "status_code": response.status_code, "data": items}
+            pages += 1
+            total = page_total
+            item_size = len(response.content) / max(len(items), 1)
+            for item in items:
+                if len(entities) >= max_entities or size + item_size > max_bytes:
+                    truncated = True
+                    break
+                entities.append(item)
+                size += item_size
+            if truncated:
+                break
+    finally:
+        await page_iter.aclose()
+    
+    result = {
+        "success": True,
+        "status_code": 200,
+        "data": entities,
+        "count": len(entities),
+        "total_count": total,
+        "pages": pages,
+    }
+    if truncated or (total is not None and start + len(entities) < total):
+        result["truncated"] = True
+        result["next_offset"] = start + len(entities)
+        result["hint"] = f"Result capped by max_entities/max_bytes. Add offset={start + len(entities)} to continue."
+    return result
+
+
+# =============================================================================
+# OUTPUT ENCODING - Tool result serialization and entity projections
+# =============================================================================
+
+def to_json(data, output_format: str = None) -> str:
+    """Serialize a tool result using OUTPUT_FORMAT, with orjson when installed"""
+    start = time.perf_counter()
+    encoded = _encode_json(data, output_format or OUTPUT_FORMAT)
+    metrics.observe("fiware_serialization_seconds", time.perf_counter() - start, tool=_current_tool.get() or "none")
+    return encoded
+
+
+def _encode_json(data, output_format: str) -> str:
+    if orjson is not None:
+        try:
+            option = orjson.OPT_INDENT_2 if output_format == "pretty" else 0
+            return orjson.dumps(data, option=option).decode()
+        except TypeError:
+            pass  # Types orjson rejects (e.g. int subclasses) fall back to json
+    if output_format == "pretty":
+        return json.dumps(data, indent=2)
+    return json.dumps(data, separators=(",", ":"))
+
+
+def _is_entity(item) -> bool:
+    return isinstance(item, dict) and "id" in item and "type" in item
+
+
+def _attribute_value(attr):
+    """Attribute value, keeping metadata only when it is not empty"""
+    if not isinstance(attr, dict) or "value" not in attr:
+        return attr
+    if attr.get("metadata"):
+        return {"value": attr["value"], "metadata": attr["metadata"]}
+    return attr["value"]
+
+
+def project_entities(data, projection: str):
+    """
+    Reduce NGSI-v2 normalized entities to a smaller shape.
+    
+    keyValues: {"id", "type", attr: value} per entity
+    columnar:  {"columns": [...], "attr_types": {...}, "rows": [[...], ...]}
+    Non-entity data is returned unchanged.
+    """
+    if not projection:
+        return data
+    if _is_entity(data):
+        return project_entities([data], "keyValues")[0]
+    if not isinstance(data, list) or not all(_is_entity(item) for item in data):
+        return data
+    
+    if projection == "keyValues":
+        return [
+            {name: (attr if name in ("id", "type") else _attribute_value(attr)) for name, attr in entity.items()}
+            for entity in data
+        ]
+    
+    if projection == "columnar":
+        columns = ["id", "type"]
+        attr_types = {}
+        for entity in data:
+            for name, attr in entity.items():
+                if name not in attr_types and name not in ("id", "type"):
+                    attr_types[name] = attr.get("type") if isinstance(attr, dict) else None
+                    columns.append(name)
+        rows = [
+            [entity["id"], entity["type"]] + [_attribute_value(entity.get(name)) for name in columns[2:]]
+            for entity in data
+        ]
+        return {"columns": columns, "attr_types": attr_types, "rows": rows}
+    
+    raise ValueError(f"Invalid projection: {projection}. Must be 'keyValues' or 'columnar'.")
+
+
+def _sort_value(entity: dict, name: str):
+    """Attribute value of a normalized or keyValues entity, for sorting"""
+    value = _attr_path(entity, name)
+    if isinstance(value, dict) and "value" in value and "type" in value:
+        return value["value"]
+    return value
+
+
+def order_entities(entities: list, order_by: str, value_of=_sort_value) -> list:
+    """Sort by an Orion-style orderBy ("attr,!attr2"); like Orion, entities without the attribute go last"""
+    for field in reversed([f.strip() for f in (order_by or "").split(",") if f.strip()]):
+        descending = field.startswith("!")
+        name = field.lstrip("!")
+        present = [e for e in entities if value_of(e, name) is not None]
+        missing = [e for e in entities if value_of(e, name) is None]
+        try:
+            present.sort(key=lambda e: value_of(e, name), reverse=descending)
+        except TypeError:
+            present.sort(key=lambda e: str(value_of(e, name)), reverse=descending)
+        entities = present + missing
+    return entities
+
+
+async def resolve_entities(entity_type: str = None, id_pattern: str = None, q: str = None,
+                           max_entities: int = None,
+                           service: str = None, servicepath: str = None) -> list:
+    """IDs and types of the entities matching a filter, as [{"id", "type"}], paging through all results"""
+    url = with_query(f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/v2/entities",
+                     type=entity_type, idPattern=id_pattern, q=q,
+                     attrs="dateModified", options="keyValues")  # Smallest payload Orion can return
+    entities = []
+    pages = iter_pages(url, max_items=max_entities, service=service, servicepath=servicepath)
+    try:
+        async for response, items, _ in pages:
+            if not response.ok:
+                raise RuntimeError(f"Entity query failed with {response.status_code}: {response.text[:200]}")
+            entities.extend({"id": item["id"], "type": item["type"]} for item in items)
+    finally:
+        await pages.aclose()
+    return entities[:max_entities] if max_entities else entities
+
+
+# =============================================================================
+# STREAMING - Incremental JSON parsing and NDJSON output for large results
+# =============================================================================
+
+class JsonArrayStream:
+    """
+    Incremental parser for the items of one array inside a JSON document.
+    
+    Bytes are fed in arbitrary chunks; `path` locates the array ([] for a
+    top-level array, ["devices"] or ["contextResponses", 0, ...] inside
+    objects). The structure around the array is scanned token by token, and
+    each item is decoded by the C JSON decoder as soon as it is complete, so
+    only the item being received is buffered.
+    """
+    
+    _TOKENS = re.compile(r'["\[\]{},:]')
+    _STRING_TAIL = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+    _SEPARATORS = re.compile(r"[\s,]*")
+    _decoder = json.JSONDecoder()
+    
+    def __init__(self, path: list = ()):
+        self.path = list(path)
+        self.found = False
+        self.done = False
+        self._text = ""
+        self._stack = []  # [is_object, current key or index, expecting a key]
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+    
+    def feed(self, chunk: bytes) -> list:
+        """Items completed by this chunk"""
+        text = self._text + self._utf8.decode(chunk)
+        pos = 0 if self.found else self._scan(text)
+        items = []
+        while self.found and not self.done:
+            pos = self._SEPARATORS.match(text, pos).end()
+            if pos == len(text):
+                break
+            if text[pos] == "]":
+                self.done = True
+                pos += 1
+                break
+            try:
+                item, end = self._decoder.raw_decode(text, pos)
+            except json.JSONDecodeError:
+                break  # Incomplete item: wait for the next chunk
+            if isinstance(item, (int, float)) and (end == len(text) or text[end] in ".eE+-0123456789"):
+                break  # A number may continue in the next chunk ("12" of "12.5")
+            items.append(item)
+            pos = end
+        self._text = text[pos:]
+        return items
+    
+    def close(self):
+        """Check that the array was found and ended"""
+        if not self.found:
+            raise ValueError(f"Response has no array at {self.path or 'top level'}")
+        if not self.done:
+            raise ValueError("Response ended in the middle of the array (truncated or invalid JSON)")
+    
+    def _scan(self, text: str) -> int:
+        """Walk the structure up to the opening bracket of the target array"""
+        stack = self._stack
+        pos = 0
+        while True:
+            match = self._TOKENS.search(text, pos)
+            if match is None:
+                return len(text)
+            start = match.start()
+            char = text[start]
+            pos = start + 1
+            if char == '"':
+                tail = self._STRING_TAIL.match(text, pos)
+                if tail is None:
+                    return start  # Incomplete string
+                pos = tail.end()
+                if stack and stack[-1][0] and stack[-1][2]:
+                    stack[-1][1] = json.loads(text[start:pos])
+            elif char in "[{":
+                if char == "[" and len(stack) == len(self.path) and [frame[1] for frame in stack] == self.path:
+                    self.found = True
+                    return pos
+                stack.append([char == "{", None if char == "{" else 0, True])
+            elif char in "]}":
+                if stack:
+                    stack.pop()
+            elif char == "," and stack:
+                if stack[-1][0]:
+                    stack[-1][2] = True
+                else:
+                    stack[-1][1] += 1
+            elif char == ":" and stack:
+                stack[-1][2] = False
+
+
+class StreamedResponse:
+    """Status and headers of a backend response whose body is read chunk by chunk"""
+    
+    def __init__(self, status_code: int, reason: str, headers, chunks):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.chunks = chunks
+    
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+    
+    async def read(self) -> bytes:
+        return b"".join([chunk async for chunk in self.chunks])
+
+
+@asynccontextmanager
+async def open_stream(url: str, service: str = None, servicepath: str = None):
+    """
+    Authenticated GET whose body is not buffered, behind the host's circuit breaker.
+    
+    Unlike make_request_async there are no retries, since the body can only be
+    consumed once. Uses httpx (aiter_bytes) or, with HTTP_CLIENT=sync,
+    requests (iter_content) pulled from a worker thread.
+    """
+    breaker = get_breaker(url)
+    if not breaker.allow():
+        raise breaker.unavailable()
+    breaker.requests += 1
+    tenant = get_tenant(service, servicepath)
+    headers = tenant.headers("GET")
+    if AUTH_TYPE not in ("oauth", "basic", "none"):
+        raise ValueError(f"Invalid AUTH_TYPE: {AUTH_TYPE}. Must be 'oauth', 'basic', or 'none'.")
+    token = None
+    if AUTH_TYPE == "oauth":
+        token = tenant.tokens.current() or await asyncio.to_thread(tenant.tokens.get_token)
+        if token:
+            headers["x-auth-token"] = token
+    connect, read = timeout_for(url)
+    parts = urlsplit(url)
+    labels = {"backend": _backend_name(parts.netloc), "method": "GET", "endpoint": endpoint_template(parts.path)}
+    received = 0
+    
+    async def count(chunks):
+        nonlocal received
+        async for chunk in chunks:
+            received += len(chunk)
+            yield chunk
+    
+    start = time.perf_counter()
+    response = None
+    try:
+        if HTTP_CLIENT == "sync":
+            auth = HTTPBasicAuth(USERNAME, PASSWORD) if AUTH_TYPE == "basic" else None
+            
+            def send():
+                return get_session(url).get(url, headers=headers, auth=auth, timeout=(connect, read),
+                                            verify=False, stream=True)
+            
+            response = await asyncio.to_thread(send)
+            fresh_token = response.status_code == 401 and token and \
+                await asyncio.to_thread(tenant.tokens.refresh, token)
+            if fresh_token:
+                response.close()
+                headers["x-auth-token"] = fresh_token
+                response = await asyncio.to_thread(send)
+            iterator = response.iter_content(STREAM_CHUNK_SIZE)
+            
+            async def chunks():
+                while True:
+                    chunk = await asyncio.to_thread(next, iterator, None)
+                    if chunk is None:
+                        return
+                    yield chunk
+            
+            streamed = StreamedResponse(response.status_code, response.reason, response.headers, count(chunks()))
+        else:
+            client = get_async_client(url)
+            auth = httpx.BasicAuth(USERNAME, PASSWORD) if AUTH_TYPE == "basic" else None
+            
+            async def send():
+                request = client.build_request("GET", url, headers=headers,
+                                               timeout=httpx.Timeout(read, connect=connect))
+                return await client.send(request, auth=auth, stream=True)
+            
+            response = await send()
+            fresh_token = response.status_code == 401 and token and \
+                await asyncio.to_thread(tenant.tokens.refresh, token)
+            if fresh_token:
+                await response.aclose()
+                headers["x-auth-token"] = fresh_token
+                response = await send()
+            streamed = StreamedResponse(response.status_code, response.reason_phrase, response.headers,
+                                        count(response.aiter_bytes(STREAM_CHUNK_SIZE)))
+        
+        metrics.observe("fiware_backend_request_seconds", time.perf_counter() - start, **labels)
+        metrics.inc("fiware_backend_requests_total", status=response.status_code, **labels)
+        breaker.record(f"HTTP {response.status_code} {streamed.reason}" if response.status_code >= 500 else None)
+        yield streamed
+    except (httpx.TransportError, requests.ConnectionError, requests.Timeout) as e:
+        metrics.inc("fiware_backend_requests_total", status=type(e).__name__, **labels)
+        breaker.record(f"{type(e).__name__}: {e}")
+        raise
+    except BaseException:
+        breaker.probing = False
+        raise
+    finally:
+        metrics.observe("fiware_backend_response_bytes", received, **labels)
+        if response is not None:
+            if HTTP_CLIENT == "sync":
+                response.close()
+            else:
+                await response.aclose()
+
+
+async def iter_stream_items(url: str, path: list, service: str = None, servicepath: str = None):
+    """Items of the array at `path` in a backend response, parsed while the body arrives"""
+    async with open_stream(url, service, servicepath) as response:
+        if not response.ok:
+            body = (await response.read()).decode("utf-8", errors="replace")
+            raise RuntimeError(f"{urlsplit(url).path} failed with {response.status_code}: {body[:300] or response.reason}")
+        parser = JsonArrayStream(path)
+        async for chunk in response.chunks:
+            for item in parser.feed(chunk):
+                yield item
+            if parser.done:
+                return
+        parser.close()
+
+
+async def stream_entities(endpoint: str, projection: str = None, page_size: int = PAGINATION_PAGE_SIZE,
+                          service: str = None, servicepath: str = None):
+    """
+    (entity, resume cursor) for every entity of a Context Broker list endpoint, page after page.
+    
+    A limit in the endpoint caps the total number of entities, like max_entities
+    in auto_paginate; the pages themselves use page_size.
+    """
+    if projection not in (None, "keyValues"):
+        raise ValueError("Streaming supports projection='keyValues' only")
+    url = f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}{endpoint}"
+    query = dict(parse_qsl(urlsplit(url).query))
+    offset = int(query.get("offset", 0))
+    remaining = int(query["limit"]) if "limit" in query else None
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        received = 0
+        page = iter_stream_items(with_query(url, offset=offset, limit=size), [], service, servicepath)
+        try:
+            async for entity in page:
+                yield project_entities(entity, projection), {"next_offset": offset + received}
+                received += 1
+        finally:
+            await page.aclose()
+        if received < size:
+            return
+        offset += size
+        if remaining is not None:
+            remaining -= size
+
+
+async def stream_history(entity_type: str, entity_id: str, attribute: str, last_n: int = None,
+                         date_from: str = None, date_to: str = None,
+                         service: str = None, servicepath: str = None):
+    """
+    ([recvTime, value], resume cursor) for raw STH values. A date range is paged
+    with hLimit/hOffset; without date_from a single lastN request is made.
+    """
+    url = with_query(sth_url(entity_type, entity_id, attribute), dateFrom=date_from, dateTo=date_to)
+    path = ["contextResponses", 0, "contextElement", "attributes", 0, "values"]
+    if not date_from:
+        values = iter_stream_items(with_query(url, lastN=last_n or 20), path, service, servicepath)
+        try:
+            async for value in values:
+                yield [value.get("recvTime"), value.get("attrValue")], None
+        finally:
+            await values.aclose()
+        return
+    
+    offset = 0
+    while True:
+        received = 0
+        values = iter_stream_items(with_query(url, hLimit=STH_PAGE_SIZE, hOffset=offset), path, service, servicepath)
+        try:
+            async for value in values:
+                received += 1
+                yield [value.get("recvTime"), value.get("attrValue")], {"next_date_from": value.get("recvTime")}
+        finally:
+            await values.aclose()
+        if received < STH_PAGE_SIZE:
+            return
+        offset += STH_PAGE_SIZE
+
+
+async def stream_devices(offset: int = 0, entity_type: str = None, protocol: str = None,
+                         page_size: int = PAGINATION_PAGE_SIZE, service: str = None, servicepath: str = None):
+    """(device, resume cursor) for the IoT Agent's registered devices, page after page"""
+    url = with_query(f"{CB_PROTOCOL}://{IOTA_HOST}:{IOTA_PORT}/iot/devices", protocol=protocol)
+    while True:
+        received = 0
+        page = iter_stream_items(with_query(url, offset=offset, limit=page_size), ["devices"], service, servicepath)
+        try:
+            async for device in page:
+                received += 1
+                if entity_type is None or device.get("entity_type") == entity_type:
+                    yield device, {"next_offset": offset + received - 1}
+        finally:
+            await page.aclose()
+        if received < page_size:
+            return
+        offset += page_size
+
+
+async def ndjson_lines(records, max_bytes: int, max_records: int = None):
+    """
+    Encode (record, resume cursor) pairs as NDJSON lines until the byte budget is spent.
+    
+    The last line is always {"stream_end": {...}} with the number of records and
+    bytes sent and, when the output was cut short, the cursor to resume from
+    (for history, next_date_from is the first value not sent).
+    """
+    sent = 0
+    count = 0
+    end = {"truncated": False}
+    try:
+        async for record, resume in records:
+            line = (_encode_json(record, "compact") + "\n").encode()
+            if sent + len(line) > max_bytes or (max_records is not None and count >= max_records):
+                end = {"truncated": True, **(resume or {})}
+                break
+            sent += len(line)
+            count += 1
+            yield line
+    except Exception as e:
+        end = {"truncated": True, "error": str(e)}
+    finally:
+        await records.aclose()
+    yield (_encode_json({"stream_end": {"records": count, "bytes": sent, **end}}, "compact") + "\n").encode()
+
+
+async def collect_ndjson(records, max_bytes: int, max_records: int = None) -> str:
+    """NDJSON text of a record stream, for tools (memory bounded by max_bytes)"""
+    return b"".join([line async for line in ndjson_lines(records, max_bytes, max_records)]).decode()
+
+
+@mcp.custom_route("/stream/{source}", methods=["GET"])
+async def stream_endpoint(request):
+    """
+    NDJSON stream of entities, history or devices (only served in --http mode).
+    
+    GET /stream/entities?endpoint=/v2/entities?type=Room&projection=keyValues
+    GET /stream/history?entity_type=Room&entity_id=Room:1&attribute=temperature&date_from=...&date_to=...
+    GET /stream/devices?protocol=IoTA-UL&offset=0
+    All take max_bytes (capped at STREAM_MAX_BYTES), and service/servicepath or
+    Fiware-Service/Fiware-ServicePath headers.
+    """
+    from starlette.responses import JSONResponse, StreamingResponse
+    params = request.query_params
+    tenant = {
+        "service": params.get("service", request.headers.get("Fiware-Service")),
+        "servicepath": params.get("servicepath", request.headers.get("Fiware-ServicePath")),
+    }
+    try:
+        max_bytes = min(int(params.get("max_bytes", STREAM_MAX_BYTES)), STREAM_MAX_BYTES)
+        source = request.path_params["source"]
+        if source == "entities":
+            records = stream_entities(params.get("endpoint", "/v2/entities"), params.get("projection"), **tenant)
+        elif source == "history":
+            records = stream_history(params["entity_type"], params["entity_id"], params["attribute"],
+                                     int(params.get("last_n", 20)), params.get("date_from"), params.get("date_to"),
+                                     **tenant)
+        elif source == "devices":
+            records = stream_devices(int(params.get("offset", 0)), params.get("entity_type"),
+                                     params.get("protocol"), **tenant)
+        else:
+            return JSONResponse({"error": f"Unknown source: {source}. Use entities, history or devices."}, 404)
+    except (KeyError, ValueError) as e:
+        return JSONResponse({"error": f"Invalid or missing parameter: {e}"}, 400)
+    return StreamingResponse(ndjson_lines(records, max_bytes), media_type="application/x-ndjson")
+
+
+@mcp.resource("fiware://examples")
+def get_api_examples() -> str:
+    """FIWARE NGSI-v2 API example collection (Postman format)"""
+    try:
+        with open("resources/fiware-ngsi-v2-examples.json", "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return json.dumps({"error": "Example collection not found"})
+
+
+@mcp.resource("fiware://stats/connections")
+def get_connection_pool_stats() -> str:
+    """HTTP connection pool statistics (new vs reused connections per backend)"""
+    return to_json(get_connection_stats())
+
+
+@mcp.resource("fiware://stats/cache")
+def get_cache_stats() -> str:
+    """Response cache hit/miss statistics for read-only Context Broker endpoints, plus shared in-flight GETs"""
+    return to_json({**_response_cache.stats(), "single_flight": _single_flight.stats()})
+
+
+@mcp.resource("fiware://stats/history-store")
+def get_history_store_stats() -> str:
+    """Size of the on-disk STH history store"""
+    return to_json(history_store.stats())
+
+
+@mcp.resource("fiware://metrics")
+def get_metrics() -> str:
+    """Latency and payload metrics: count, mean and p50/p95/p99 per backend endpoint and tool"""
+    return to_json(metrics.summary())
+
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def metrics_endpoint(request):
+    """Prometheus scrape endpoint (only served in --http mode)"""
+    from starlette.responses import PlainTextResponse
+    return PlainTextResponse(metrics.prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@mcp.resource("fiware://stats/mirror")
+def get_mirror_stats() -> str:
+    """Mirrored entity types per tenant, their indexes and staleness"""
+    return to_json({
+        f"{mirror.service}{mirror.servicepath}": {
+            "entities": len(mirror.entities),
+            "indexes": sorted(mirror.indexes),
+            "types": {entity_type: mirror.staleness(entity_type) for entity_type in mirror.types},
+        }
+        for mirror in _mirrors.values()
+    })
+
+
+@mcp.resource("fiware://stats/tenants")
+def get_tenant_stats() -> str:
+    """Cached service/servicepath pairs and the state of their Keystone tokens"""
+    with _tenants_lock:
+        tenants = [tenant.tokens.status() for tenant in _tenants.values()]
+    return to_json({"cache_size": TENANT_CACHE_SIZE, "tenants": tenants})
+
+
+@mcp.tool()
+async def fiware_diagnostics(probe: bool = False, reset_breakers: bool = False) -> str:
+    """
+    Show the health of each FIWARE backend as seen by this server.
+    
+    Args:
+        probe: Also send a lightweight request to each backend and report its latency
+        reset_breakers: Close all circuit breakers (e.g., after fixing a backend)
+    
+    Returns:
+        Per backend: circuit breaker state, consecutive failures, requests, retries,
+        rejected (failed-fast) requests, last error and timeouts, plus the retry policy
+    """
+    try:
+        if reset_breakers:
+            _breakers.clear()
+        
+        probes = {}
+        if probe:
+            endpoints = {
+                "context_broker": f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/version",
+                "sth_comet": f"{CB_PROTOCOL}://{STH_HOST}:{STH_PORT}/version",
+                "perseo_cep": f"{CB_PROTOCOL}://{CEP_HOST}:{CEP_PORT}/version",
+                "iot_agent": f"{CB_PROTOCOL}://{IOTA_HOST}:{IOTA_PORT}/iot/about",
+            }
+            
+            async def check(url):
+                start = time.perf_counter()
+                try:
+                    response = await _send_with_retries("GET", url)
+                    outcome = {"status_code": response.status_code}
+                except Exception as e:
+                    outcome = {"error": f"{type(e).__name__}: {e}"}
+                outcome["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                return outcome
+            
+            results = await asyncio.gather(*(check(url) for url in endpoints.values()))
+            probes = dict(zip(endpoints, results))
+        
+        backends = {_backend_name(netloc): breaker.status() for netloc, breaker in list(_breakers.items())}
+        for name, outcome in probes.items():
+            backends.setdefault(name, {})["probe"] = outcome
+        
+        return to_json({
+            "backends": backends,
+            "retry_policy": {
+                "retries": HTTP_RETRIES,
+                "base_delay": HTTP_RETRY_BASE,
+                "max_delay": HTTP_RETRY_MAX_DELAY,
+                "idempotent_methods": sorted(IDEMPOTENT_METHODS),
+                "retry_status_codes": sorted(RETRY_STATUS_CODES),
+            },
+            "circuit_breaker": {
+                "failure_threshold": BREAKER_FAILURE_THRESHOLD or None,
+                "reset_timeout": BREAKER_RESET_TIMEOUT,
+            },
+        })
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def CB_version() -> str:
+    """Check Context Broker version"""
+    try:
+        url = f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/version"
+        response = await make_request_async("GET", url)
+        return to_json({"success": True, "version": response.json()})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def fiware_request(method: str, endpoint: str, body: dict = None,
+                         auto_paginate: bool = False, max_entities: int = 10000,
+                         max_bytes: int = 10_000_000, projection: str = None, stream: bool = False,
+                         service: str = None, servicepath: str = None) -> str:
+    """
+    Execute any FIWARE NGSI-v2 API request.
+    
+    Args:
+        method: HTTP method (GET, POST, PATCH, PUT, DELETE)
+        endpoint: API endpoint starting with / (e.g., "/v2/entities")
+        body: Optional request body for POST/PATCH/PUT
+        auto_paginate: For GET list endpoints, fetch all pages (past Orion's 1000 limit) concurrently
+        max_entities: Cap on entities returned when auto_paginate is on (default 10000)
+        max_bytes: Cap on response bytes merged when auto_paginate is on (default 10 MB)
+        projection: Compact entity output: "keyValues" (attr: value) or "columnar" (column list + rows)
+        stream: For GET list endpoints, parse pages while they arrive and return NDJSON (one entity
+                per line) up to max_bytes/max_entities; the last line, {"stream_end": ...}, has next_offset
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
+    
+    Examples:
+        # Query entities
+        GET /v2/entities                           - List all entities
+        GET /v2/entities?type=Room                 - Filter by type
+        GET /v2/entities?limit=10                  - Limit results
+        GET /v2/entities?limit=10&offset=20        - Pagination
+        GET /v2/entities?q=temperature>20          - Query by attribute value
+        GET /v2/entities?attrs=temperature,pressure - Select specific attributes
+        GET /v2/entities?orderBy=temperature       - Order results
+        GET /v2/entities/{id}                      - Get entity by ID
+        GET /v2/entities/{id}?attrs=temperature    - Get specific attributes
+        GET /v2/entities/{id}/attrs/{attrName}     - Get single attribute
+        
+        # Entity types
+        GET /v2/types                              - List all entity types
+        GET /v2/types/{type}                       - Get type details
+        
+        # Create and modify entities
+        POST /v2/entities                          - Create entity (with body)
+        POST /v2/entities?options=keyValues        - Create with simplified format
+        PATCH /v2/entities/{id}/attrs              - Update attributes (with body)
+        PUT /v2/entities/{id}/attrs                - Replace all attributes (with body)
+        PUT /v2/entities/{id}/attrs/{attrName}     - Update single attribute (with body)
+        DELETE /v2/entities/{id}                   - Delete entity
+        DELETE /v2/entities/{id}/attrs/{attrName}  - Delete single attribute
+        
+        # Subscriptions
+        GET /v2/subscriptions                      - List subscriptions
+        GET /v2/subscriptions/{id}                 - Get subscription details
+        POST /v2/subscriptions                     - Create subscription (with body)
+        PATCH /v2/subscriptions/{id}               - Update subscription (with body)
+        DELETE /v2/subscriptions/{id}              - Delete subscription
+        
+        # Batch operations
+        POST /v2/op/update                         - Batch update (with body)
+        POST /v2/op/query                          - Batch query (with body)
+        
+        # All entities of a type, across pages
+        fiware_request("GET", "/v2/entities?type=Room", auto_paginate=True)
+        
+        # Compact output for large entity lists
+        fiware_request("GET", "/v2/entities?type=Room", projection="columnar")
+        
+        # Very large lists as NDJSON, bounded to 5 MB
+        fiware_request("GET", "/v2/entities?type=Room", stream=True, max_bytes=5_000_000, projection="keyValues")
+    """
+    try:
+        url = f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}{endpoint}"
+        
+        if stream and method.upper() == "GET":
+            records = stream_entities(endpoint, projection, service=service, servicepath=servicepath)
+            return await collect_ndjson(records, max_bytes, max_entities)
+        
+        if auto_paginate and method.upper() == "GET":
+            result = await _paginated_request(url, max_entities, max_bytes, service, servicepath)
+            if "data" in result:
+                result["data"] = project_entities(result["data"], projection)
+            return to_json(result)
+        
+        response = await make_request_async(method.upper(), url, body, service=service, servicepath=servicepath)
+        
+        try:
+            data = response.json() if response.text else None
+        except:
+            data = response.text
+        
+        result = {
+            "success": response.ok,
+            "status_code": response.status_code,
+        }
+        
+        if response.ok:
+            result["data"] = project_entities(data, projection)
             if isinstance(data, list):
                 result["count"] = len(data)
                 if len(data) > 20:
-                    result["hint"] = "Many results. Try ?limit=10 or ?type=YourType"
+                    result["hint"] = "Many results. Try ?limit=10 or ?type=YourType, or auto_paginate=True to get all pages"
+        else:
+            result["error"] = data or response.reason
+            if response.status_code == 404:
+                result["hint"] = "Not found. Check ID or try GET /v2/entities"
+            elif response.status_code == 400:
+                result["hint"] = "Bad request. Check endpoint and body format."
+        
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+# =============================================================================
+# BATCH OPERATIONS - Bulk upsert and delete through /v2/op/update
+# =============================================================================
+
+def load_entities(file_path: str) -> list:
+    """Read entities from a JSON file (list or {"entities": [...]}) or an NDJSON file (one entity per line)"""
+    path = import_path(file_path)
+    with path.open(encoding="utf-8") as f:
+        if path.suffix.lower() in (".ndjson", ".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        data = json.load(f)
+    return data["entities"] if isinstance(data, dict) else data
+
+
+def _retryable(response) -> bool:
+    return isinstance(response, Exception) or response.status_code == 429 or response.status_code >= 500
+
+
+# Action types whose batches can be resent: a partly applied batch ends up the same
+IDEMPOTENT_ACTIONS = ("append", "update", "replace", "delete")
+
+
+def _named_entities(error, entities: list) -> list:
+    """Entities of a batch whose id Orion names in a partial failure description"""
+    text = error.get("description", "") if isinstance(error, dict) else str(error)
+    return [entity for entity in entities
+            if re.search(rf"(?<![\w.:-]){re.escape(str(entity.get('id')))}(?![\w.-]|:\S)", text)]
+
+
+async def run_batch_op(batches, action_type: str, options: str = None,
+                       concurrency: int = BATCH_CONCURRENCY, max_retries: int = 3,
+                       limiter: HostRateLimiter = None, counters: dict = None,
+                       service: str = None, servicepath: str = None):
+    """
+    POST batches of entities to /v2/op/update, yielding (batch, failures) in order.
+    
+    At most `concurrency` batches are in flight. Timeouts, 429 and 5xx responses
+    are retried with jittered exponential backoff. A batch rejected with another
+    4xx is split in halves until the offending entities are isolated, so
+    failures lists only the entities that actually failed. Orion applies the
+    valid part of a rejected batch, so for appendStrict, where resending would
+    fail, the failed entities are taken from the ids in Orion's error description
+    instead. For the same reason appendStrict is only retried when the request
+    never reached Orion; after a timeout, 429 or 5xx its entities are reported
+    with "outcome": "unknown". For deletes, a 404 on a single entity counts as done.
+    """
+    url = with_query(f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/v2/op/update", options=options)
+    counters = counters if counters is not None else {}
+    counters.setdefault("requests", 0)
+    counters.setdefault("retries", 0)
+    
+    async def send(entities):
+        body = {"actionType": action_type, "entities": entities}
+        for attempt in range(max_retries + 1):
+            if limiter:
+                await limiter.acquire(url)
+            counters["requests"] += 1
+            try:
+                response = await make_request_async("POST", url, body, service=service, servicepath=servicepath)
+            except Exception as e:
+                response = e
+            if not _retryable(response) or attempt == max_retries:
+                return response
+            if not (action_type in IDEMPOTENT_ACTIONS or _not_sent(response)):
+                return response  # May have been applied: a resend would report written entities as failed
+            counters["retries"] += 1
+            await asyncio.sleep(BATCH_RETRY_BASE * 2 ** attempt * random.uniform(0.5, 1.5))
+    
+    async def apply(entities) -> list:
+        response = await send(entities)
+        if not isinstance(response, Exception):
+            if response.ok or (action_type == "delete" and response.status_code == 404 and len(entities) == 1):
+                return []
+            if len(entities) > 1 and not _retryable(response):
+                if action_type in IDEMPOTENT_ACTIONS:
+                    middle = len(entities) // 2
+                    return await apply(entities[:middle]) + await apply(entities[middle:])
+                try:
+                    error = response.json() if response.content else response.reason
+                except ValueError:
+                    error = response.text[:500]
+                entities = _named_entities(error, entities) or entities
+        if isinstance(response, Exception):
+            error, status_code = str(response), None
+        else:
+            try:
+                error = response.json() if response.content else response.reason
+            except ValueError:
+                error = response.text[:500]
+            status_code = response.status_code
+        failure = {"status_code": status_code, "error": error}
+        if _retryable(response) and not (action_type in IDEMPOTENT_ACTIONS or _not_sent(response)):
+            failure["outcome"] = "unknown"
+        return [{"id": entity.get("id"), "type": entity.get("type"), **failure} for entity in entities]
+    
+    async def process(batch):
+        return batch, await apply(batch)
+    
+    results = iter_ordered(process, batches, concurrency)
+    try:
+        async for batch, failures in results:
+            yield batch, failures
+    finally:
+        await results.aclose()
+
+
+@mcp.tool()
+async def cb_batch_upsert(entities: list = None, file_path: str = None, action_type: str = "append",
+                          key_values: bool = False, batch_size: int = 1000,
+                          max_batch_bytes: int = BATCH_MAX_BYTES, concurrency: int = BATCH_CONCURRENCY,
+                          max_retries: int = 3, max_errors: int = 100,
+                          service: str = None, servicepath: str = None) -> str:
+    """
+    Create or update many entities through batched POST /v2/op/update requests.
+    
+    Args:
+        entities: List of NGSI-v2 entities (each with "id" and "type")
+        file_path: Instead of entities, a .json file (list or {"entities": [...]}) or .ndjson file,
+                   relative to IMPORT_DIR
+        action_type: "append" (upsert, default), "appendStrict" (create only), "update" or "replace"
+        key_values: Entities use the keyValues format ({"id", "type", "temperature": 21})
+        batch_size: Max entities per request (default 1000)
+        max_batch_bytes: Max request body size, defaults to BATCH_MAX_BYTES (Orion's 1 MB limit)
+        concurrency: Max batches in flight (default BATCH_CONCURRENCY)
+        max_retries: Retries per batch on timeouts, 429 and 5xx, with exponential backoff (default 3)
+        max_errors: Max per-entity errors listed in the result (default 100)
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
+    
+    Returns:
+        Counts of written and failed entities, throughput (entities per second) and per-entity errors.
+        Entities of appendStrict batches that may or may not have been written are listed under "unknown".
+    
+    Example:
+        cb_batch_upsert(file_path="rooms.ndjson", key_values=True)
+        cb_batch_upsert(entities=[{"id": "Room:001", "type": "Room",
+                                   "temperature": {"value": 21, "type": "Number"}}])
+    """
+    try:
+        if action_type not in ("append", "appendStrict", "update", "replace"):
+            return to_json({"error": f"Invalid action_type: {action_type}",
+                            "hint": "Use append, appendStrict, update or replace"})
+        if file_path:
+            entities = load_entities(file_path)
+        if not entities:
+            return to_json({"error": "No entities to write", "hint": "Pass entities or file_path"})
+        
+        errors = [{"id": entity.get("id") if isinstance(entity, dict) else None, "error": "Entity without id"}
+                  for entity in entities if not isinstance(entity, dict) or not entity.get("id")]
+        valid = [entity for entity in entities if isinstance(entity, dict) and entity.get("id")]
+        
+        # Leave room for the {"actionType": ..., "entities": [...]} envelope
+        batches = chunked(valid, batch_size, max_batch_bytes - 100)
+        counters = {}
+        written = 0
+        unknown = []
+        start = time.perf_counter()
+        results = run_batch_op(batches, action_type, "keyValues" if key_values else None, concurrency,
+                               max_retries, counters=counters, service=service, servicepath=servicepath)
+        try:
+            async for batch, failures in results:
+                written += len(batch) - len(failures)
+                for failure in failures:
+                    (unknown if failure.get("outcome") == "unknown" else errors).append(failure)
+        finally:
+            await results.aclose()
+        elapsed = time.perf_counter() - start
+        
+        result = {
+            "success": not errors and not unknown,
+            "action_type": action_type,
+            "entities_requested": len(entities),
+            "entities_written": written,
+            "entities_failed": len(errors),
+            "batches": len(batches),
+            "requests": counters["requests"],
+            "retries": counters["retries"],
+            "elapsed_seconds": round(elapsed, 3),
+            "entities_per_second": round(written / elapsed, 1) if elapsed else None,
+        }
+        if errors:
+            result["errors"] = errors[:max_errors]
+            if len(errors) > max_errors:
+                result["errors_truncated"] = True
+        if unknown:
+            result["entities_unknown"] = len(unknown)
+            result["unknown"] = unknown[:max_errors]
+            result["hint"] = ("The outcome of some batches is unknown (timeout, 429 or 5xx): they may have been "
+                              "written. Check them with GET /v2/entities before writing them again.")
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def cb_purge_entities(entity_type: str = None, id_pattern: str = None, q: str = None,
+                            dry_run: bool = True, max_entities: int = None, batch_size: int = 1000,
+                            concurrency: int = BATCH_CONCURRENCY, rate_limit: float = None,
+                            max_errors: int = 100,
+                            service: str = None, servicepath: str = None) -> str:
+    """
+    Delete all entities matching a filter through batched /v2/op/update delete requests.
+    
+    Args:
+        entity_type: Entity type to delete (e.g., "Room")
+        id_pattern: idPattern regex (e.g., "^Test:.*"); use ".*" to match every id
+        q: NGSI-v2 q filter (e.g., "status==decommissioned")
+        dry_run: Only count the matching entities and show a sample (default True)
+        max_entities: Delete at most this many entities
+        batch_size: Max entities per delete request (default 1000)
+        concurrency: Max delete requests in flight (default BATCH_CONCURRENCY)
+        rate_limit: Max delete requests per second (default unlimited)
+        max_errors: Max per-entity errors listed in the result (default 100)
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
+    
+    Returns:
+        With dry_run, the number of matching entities and a sample of their ids.
+        Otherwise the number deleted, per-entity errors and entities per second.
+    
+    Example:
+        cb_purge_entities(entity_type="Room", id_pattern="^Test:")                 # count first
+        cb_purge_entities(entity_type="Room", id_pattern="^Test:", dry_run=False)  # then delete
+    """
+    try:
+        if not (entity_type or id_pattern or q):
+            return to_json({"error": "No filter given",
+                            "hint": "Pass entity_type, id_pattern or q (id_pattern='.*' matches everything)"})
+        
+        if dry_run:
+            url = with_query(f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/v2/entities",
+                             type=entity_type, idPattern=id_pattern, q=q, limit=10,
+                             attrs="dateModified", options="count,keyValues")
+            response = await make_request_async("GET", url, service=service, servicepath=servicepath)
+            if not response.ok:
+                return to_json({"success": False, "status_code": response.status_code,
+                                "error": response.text[:500] or response.reason})
+            total = int(response.headers.get("Fiware-Total-Count", 0))
+            return to_json({
+                "success": True,
+                "dry_run": True,
+                "matching_entities": total,
+                "would_delete": min(total, max_entities) if max_entities else total,
+                "sample": [{"id": item["id"], "type": item["type"]} for item in response.json()],
+                "hint": "Call again with dry_run=False to delete them.",
+            })
+        
+        # Resolve every target before deleting, so deletes don't shift the pages being read
+        targets = await resolve_entities(entity_type, id_pattern, q, max_entities, service, servicepath)
+        batches = chunked(targets, batch_size, BATCH_MAX_BYTES - 100)
+        counters = {}
+        deleted = 0
+        errors = []
+        start = time.perf_counter()
+        results = run_batch_op(batches, "delete", concurrency=concurrency, limiter=HostRateLimiter(rate_limit),
+                               counters=counters, service=service, servicepath=servicepath)
+        try:
+            async for batch, failures in results:
+                deleted += len(batch) - len(failures)
+                errors.extend(failures)
+        finally:
+            await results.aclose()
+        elapsed = time.perf_counter() - start
+        
+        result = {
+            "success": not errors,
+            "dry_run": False,
+            "matching_entities": len(targets),
+            "entities_deleted": deleted,
+            "entities_failed": len(errors),
+            "batches": len(batches),
+            "requests": counters.get("requests", 0),
+            "retries": counters.get("retries", 0),
+            "elapsed_seconds": round(elapsed, 3),
+            "entities_per_second": round(deleted / elapsed, 1) if elapsed else None,
+        }
+        if errors:
+            result["errors"] = errors[:max_errors]
+            if len(errors) > max_errors:
+                result["errors_truncated"] = True
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+# =============================================================================
+# ENTITY MIRROR - Local entity snapshot kept current by NGSI-v2 subscriptions
+# =============================================================================
+
+MIRROR_ALTERATION_TYPES = ["entityCreate", "entityChange", "entityDelete"]
+_Q_CONDITION = re.compile(r"^([^=!<>~]+?)(==|!=|>=|<=|>|<|~=)(.+)$")
+
+
+def _q_split(text: str, separator: str) -> list:
+    """Split on separator where it is outside 'quoted' values"""
+    return re.split(rf"{re.escape(separator)}(?=(?:[^']*'[^']*')*[^']*$)", text)
+
+
+def _q_value(text: str):
+    """Literal of a q expression: 'quoted' text, number, boolean or bare text"""
+    text = text.strip()
+    if len(text) > 1 and text[0] == text[-1] == "'":
+        return text[1:-1]
+    if text in ("true", "false"):
+        return text == "true"
+    try:
+        return float(text) if any(c in text for c in ".eE") else int(text)
+    except ValueError:
+        return text
+
+
+def parse_q(q: str) -> list:
+    """
+    Parse the NGSI-v2 simple query language into (attr, op, operand) conditions.
+    
+    Supports ;-separated ==, != (value lists a,b,c and ranges a..b), >, >=, <, <=,
+    ~= (regex), attr (exists) and !attr (doesn't exist).
+    """
+    conditions = []
+    for part in filter(None, (part.strip() for part in _q_split(q or "", ";"))):
+        match = _Q_CONDITION.match(part)
+        if not match:
+            if part.startswith("!"):
+                conditions.append((part[1:], "absent", None))
+            else:
+                conditions.append((part, "present", None))
+            continue
+        attr, op, operand = match.group(1).strip(), match.group(2), match.group(3)
+        if op in ("==", "!=") and ".." in operand and not operand.startswith("'"):
+            low, high = operand.split("..", 1)
+            operand = ("range", _q_value(low), _q_value(high))
+        elif op in ("==", "!="):
+            operand = ("in", [_q_value(value) for value in _q_split(operand, ",")])
+        elif op == "~=":
+            operand = re.compile(operand)
+        else:
+            operand = _q_value(operand)
+        conditions.append((attr, op, operand))
+    return conditions
+
+
+def _attr_path(entity: dict, attr: str):
+    """Value of attr in a keyValues entity, following dotted paths into objects"""
+    value = entity.get(attr)
+    if value is None and "." in attr:
+        value = entity
+        for key in attr.split("."):
+            value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def _comparable(a, b) -> bool:
+    """Both numbers or both text: booleans, objects and lists have no order"""
+    return isinstance(a, str) == isinstance(b, str) and not isinstance(a, (bool, dict, list)) \
+        and not isinstance(b, (bool, dict, list))
+
+
+def _index_key(value):
+    """Dict key of a value in the mirror indexes, keeping true/false apart from 1/0"""
+    return (bool, value) if isinstance(value, bool) else value
+
+
+_Q_ORDER = {
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+}
+
+
+def matches_condition(entity: dict, attr: str, op: str, operand) -> bool:
+    """
+    Whether a keyValues entity meets one parsed q condition.
+    
+    List values match when any element does, and true/false only equal
+    booleans, exactly as the mirror indexes answer the same condition.
+    """
+    value = _attr_path(entity, attr)
+    if op == "present":
+        return value is not None
+    if op == "absent":
+        return value is None
+    if value is None:
+        return False
+    if op == "~=":
+        return isinstance(value, str) and operand.search(value) is not None
+    items = value if isinstance(value, list) else [value]
+    if op in ("==", "!="):
+        if operand[0] == "range":
+            _, low, high = operand
+            found = _comparable(low, high) and any(
+                _comparable(item, low) and low <= item <= high for item in items)
+        else:
+            keys = {_index_key(v) for v in operand[1]}
+            found = any(not isinstance(item, (dict, list)) and _index_key(item) in keys for item in items)
+        return found if op == "==" else not found
+    return any(_comparable(item, operand) and _Q_ORDER[op](item, operand) for item in items)
+
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = EARTH_RADIUS_M * 3.141592653589793 / 180
+MAX_EARTH_DISTANCE_M = EARTH_RADIUS_M * 3.141592653589793
+
+
+def parse_geometry(value) -> Optional[dict]:
+    """
+    Vertices, segments and polygon rings of a keyValues location, as (lon, lat) arrays.
+    
+    Accepts geo:json geometries and geo:point text ("lat, lon"); returns None for
+    anything else. Points are kept as zero-length segments so that one segment
+    test covers point-on-line and point-equals-point.
+    """
+    if isinstance(value, str):
+        try:
+            lat, lon = (float(part) for part in value.split(","))
+        except ValueError:
+            return None
+        value = {"type": "Point", "coordinates": [lon, lat]}
+    if not isinstance(value, dict) or "coordinates" not in value:
+        return None
+    kind, coordinates = value.get("type"), value["coordinates"]
+    points = {"Point": [coordinates], "MultiPoint": coordinates}.get(kind, [])
+    lines = {"LineString": [coordinates], "MultiLineString": coordinates}.get(kind, [])
+    polygons = {"Polygon": [coordinates], "MultiPolygon": coordinates}.get(kind, [])
+    if not (points or lines or polygons):
+        return None
+    
+    segments = [(p[0], p[1], p[0], p[1]) for p in points]
+    for path in lines + [ring for polygon in polygons for ring in polygon]:
+        segments += [(a[0], a[1], b[0], b[1]) for a, b in zip(path, path[1:])]
+    vertices = [p[:2] for p in points] + [p[:2] for path in lines for p in path] \
+        + [p[:2] for polygon in polygons for ring in polygon for p in ring]
+    return {
+        "vertices": np.array(vertices, dtype=np.float64),
+        "segments": np.array(segments, dtype=np.float64).reshape(-1, 4),
+        "polygons": [[np.array(ring, dtype=np.float64)[:, :2] for ring in polygon] for polygon in polygons],
+        "is_point": kind == "Point",
+    }
+
+
+def _location_point(value) -> Optional[tuple]:
+    """(lon, lat) of a geo:json Point or geo:point text, without building arrays"""
+    try:
+        if isinstance(value, str):
+            lat, lon = value.split(",")
+            return float(lon), float(lat)
+        if isinstance(value, dict) and value.get("type") == "Point":
+            return float(value["coordinates"][0]), float(value["coordinates"][1])
+    except (ValueError, TypeError, IndexError, KeyError):
+        pass
+    return None
+
+
+def query_geometry(geometry: str, coords: str) -> dict:
+    """Shape of an Orion-style geometry ("point", "line", "polygon", "box") with "lat,lon;lat,lon" coords"""
+    try:
+        points = [[float(lon), float(lat)] for lat, lon in (pair.split(",") for pair in coords.split(";"))]
+    except ValueError:
+        raise ValueError(f"Invalid coords: {coords}. Use 'lat,lon;lat,lon;...'")
+    if geometry == "point" and len(points) == 1:
+        value = {"type": "Point", "coordinates": points[0]}
+    elif geometry == "line" and len(points) >= 2:
+        value = {"type": "LineString", "coordinates": points}
+    elif geometry == "polygon" and len(points) >= 4 and points[0] == points[-1]:
+        value = {"type": "Polygon", "coordinates": [points]}
+    elif geometry == "box" and len(points) == 2:
+        (x1, y1), (x2, y2) = points
+        value = {"type": "Polygon", "coordinates": [[[x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]]]}
+    else:
+        raise ValueError(f"Invalid geometry: {geometry} with {len(points)} point(s). Use point (1), line (2+), "
+                         f"box (2 corners) or polygon (4+ points, first = last)")
+    return parse_geometry(value)
+
+
+def haversine_m(lon: float, lat: float, lons, lats):
+    """Great-circle distances in meters from one point to arrays of points"""
+    lat1, lats = np.radians(lat), np.radians(lats)
+    a = np.sin((lats - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lats) * np.sin(np.radians(lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def points_in_polygon(points, rings: list):
+    """Even-odd ray casting for an (N, 2) array of points against a polygon with holes"""
+    inside = np.zeros(len(points), dtype=bool)
+    x, y = points[:, 0], points[:, 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for ring in rings:
+            for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+                inside ^= ((y1 > y) != (y2 > y)) & (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+    return inside
+
+
+def segments_intersect(segment, segments):
+    """Whether one (x1, y1, x2, y2) segment touches each row of an (N, 4) array, collinear overlaps included"""
+    ax, ay, bx, by = segment
+    cx, cy, dx, dy = segments.T
+    
+    def orientation(px, py, qx, qy, rx, ry):
+        return np.sign((qx - px) * (ry - py) - (qy - py) * (rx - px))
+    
+    def on_segment(px, py, qx, qy, rx, ry):
+        return (np.minimum(px, qx) <= rx) & (rx <= np.maximum(px, qx)) \
+            & (np.minimum(py, qy) <= ry) & (ry <= np.maximum(py, qy))
+    
+    o1, o2 = orientation(ax, ay, bx, by, cx, cy), orientation(ax, ay, bx, by, dx, dy)
+    o3, o4 = orientation(cx, cy, dx, dy, ax, ay), orientation(cx, cy, dx, dy, bx, by)
+    return (((o1 != o2) & (o3 != o4))
+            | ((o1 == 0) & on_segment(ax, ay, bx, by, cx, cy)) | ((o2 == 0) & on_segment(ax, ay, bx, by, dx, dy))
+            | ((o3 == 0) & on_segment(cx, cy, dx, dy, ax, ay)) | ((o4 == 0) & on_segment(cx, cy, dx, dy, bx, by)))
+
+
+def shapes_intersect(a: dict, b: dict) -> bool:
+    if any(points_in_polygon(b["vertices"], polygon).any() for polygon in a["polygons"]):
+        return True
+    if any(points_in_polygon(a["vertices"], polygon).any() for polygon in b["polygons"]):
+        return True
+    return any(segments_intersect(segment, b["segments"]).any() for segment in a["segments"])
+
+
+class SpatialIndex:
+    """
+    Grid index of entity locations, answering near, kNN, coveredBy and intersects.
+    
+    Points live in growable NumPy arrays, so distances and point-in-polygon tests
+    run vectorized over the candidates of the grid cells a query touches. Lines
+    and polygons are registered in every cell their bounding box covers and
+    tested one by one; their distance is that of their nearest vertex. Shapes
+    spanning more than max_shape_cells cells (a region, a highway) are kept in
+    a separate list that every query checks, so indexing them stays cheap.
+    """
+    
+    max_shape_cells = 64
+    
+    def __init__(self, cell_degrees: float = SPATIAL_CELL_DEGREES):
+        self.cell = cell_degrees
+        self.cell_meters = cell_degrees * METERS_PER_DEGREE
+        self.points = np.zeros((1024, 2))
+        self.keys = [None] * 1024
+        self.slots = {}
+        self._free = []
+        self._cells = {}
+        self._slot_cells = {}
+        self.shapes = {}  # slot -> shape of lines and polygons
+        self._large = set()  # slots of shapes too large for the grid
+    
+    def __len__(self):
+        return len(self.slots)
+    
+    def _cell_range(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> tuple:
+        return (int(min_lon // self.cell), int(min_lat // self.cell),
+                int(max_lon // self.cell), int(max_lat // self.cell))
+    
+    def update(self, key: tuple, location):
+        self.remove(key)
+        point = _location_point(location)
+        shape = None if point else parse_geometry(location)
+        if point is None and shape is None:
+            return
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self.slots)
+            if slot == len(self.keys):
+                self.points = np.concatenate([self.points, np.zeros_like(self.points)])
+                self.keys += [None] * len(self.keys)
+        self.slots[key] = slot
+        self.keys[slot] = key
+        if point:
+            self.points[slot] = point
+            cells = [(int(point[0] // self.cell), int(point[1] // self.cell))]
+        else:
+            vertices = shape["vertices"]
+            self.points[slot] = vertices.mean(axis=0)
+            self.shapes[slot] = shape
+            i0, j0, i1, j1 = self._cell_range(*vertices.min(axis=0), *vertices.max(axis=0))
+            if (i1 - i0 + 1) * (j1 - j0 + 1) > self.max_shape_cells:
+                self._large.add(slot)
+                cells = []
+            else:
+                cells = [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+        for cell in cells:
+            self._cells.setdefault(cell, set()).add(slot)
+        self._slot_cells[slot] = cells
+    
+    def remove(self, key: tuple):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        for cell in self._slot_cells.pop(slot):
+            self._cells[cell].discard(slot)
+            if not self._cells[cell]:
+                del self._cells[cell]
+        self.shapes.pop(slot, None)
+        self._large.discard(slot)
+        self.keys[slot] = None
+        self._free.append(slot)
+    
+    def candidates(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float):
+        """Slots registered in the grid cells overlapping a bounding box, plus all large shapes"""
+        i0, j0, i1, j1 = self._cell_range(min_lon, min_lat, max_lon, max_lat)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self._cells):
+            groups = (slots for (i, j), slots in self._cells.items() if i0 <= i <= i1 and j0 <= j <= j1)
+        else:
+            groups = (self._cells.get((i, j), ()) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1))
+        found = set().union(self._large, *groups)
+        return np.fromiter(found, dtype=np.int64, count=len(found))
+    
+    def near(self, lon: float, lat: float, max_distance: float = None, min_distance: float = None) -> tuple:
+        """Keys within [min_distance, max_distance] meters of a point, and their distances"""
+        if max_distance is None or max_distance >= MAX_EARTH_DISTANCE_M:
+            slots = np.fromiter(self.slots.values(), dtype=np.int64, count=len(self.slots))
+        else:
+            dlat = max_distance / METERS_PER_DEGREE
+            dlon = min(dlat / max(np.cos(np.radians(min(abs(lat) + dlat, 90))), 1e-6), 360)
+            slots = self.candidates(lon - dlon, max(lat - dlat, -90), lon + dlon, min(lat + dlat, 90))
+        distances = haversine_m(lon, lat, self.points[slots, 0], self.points[slots, 1])
+        for i, slot in enumerate(slots.tolist()):
+            shape = self.shapes.get(slot)
+            if shape is not None:
+                distances[i] = haversine_m(lon, lat, shape["vertices"][:, 0], shape["vertices"][:, 1]).min()
+        keep = np.ones(len(slots), dtype=bool)
+        if max_distance is not None:
+            keep &= distances <= max_distance
+        if min_distance is not None:
+            keep &= distances >= min_distance
+        return [self.keys[slot] for slot in slots[keep].tolist()], distances[keep]
+    
+    def relate(self, georel: str, shape: dict) -> list:
+        """Keys whose location is coveredBy, intersects or is disjoint from a shape"""
+        if georel == "disjoint":
+            touching = set(self.relate("intersects", shape))
+            return [key for key in self.slots if key not in touching]
+        
+        slots = self.candidates(*shape["vertices"].min(axis=0), *shape["vertices"].max(axis=0))
+        is_point = np.fromiter((slot not in self.shapes for slot in slots.tolist()), dtype=bool, count=len(slots))
+        point_slots = slots[is_point]
+        points = self.points[point_slots]
+        match = np.zeros(len(point_slots), dtype=bool)
+        for polygon in shape["polygons"]:
+            match |= points_in_polygon(points, polygon)
+        if georel == "intersects":
+            as_segments = np.hstack([points, points])
+            for segment in shape["segments"]:
+                match |= segments_intersect(segment, as_segments)
+        keys = [self.keys[slot] for slot in point_slots[match].tolist()]
+        
+        for slot in slots[~is_point].tolist():
+            other = self.shapes[slot]
+            if georel == "coveredBy":
+                # Vertices inside the query polygon (exact for convex query polygons)
+                inside = np.zeros(len(other["vertices"]), dtype=bool)
+                for polygon in shape["polygons"]:
+                    inside |= points_in_polygon(other["vertices"], polygon)
+                if inside.all():
+                    keys.append(self.keys[slot])
+            elif shapes_intersect(shape, other):
+                keys.append(self.keys[slot])
+        return keys
+
+
+def parse_georel(georel: str) -> tuple:
+    """("near", max_distance, min_distance) or (relation, None, None) from an Orion georel"""
+    relation, *modifiers = georel.split(";")
+    options = {}
+    for modifier in modifiers:
+        name, _, value = modifier.partition(":")
+        options[name] = float(value)
+    relation = {"within": "coveredBy"}.get(relation, relation)
+    if relation not in ("near", "coveredBy", "intersects", "disjoint"):
+        raise ValueError(f"Unsupported georel: {relation}. Use near, coveredBy, intersects or disjoint.")
+    return relation, options.get("maxDistance"), options.get("minDistance")
+
+
+class EntityMirror:
+    """
+    keyValues copy of some entity types of one tenant, with secondary indexes.
+    
+    Entities are keyed by (type, id). Each indexed attribute maps value -> keys
+    for == lookups, plus a lazily built sorted list of numeric and text values
+    for ranges and orderBy. Writes only apply if the entity's dateModified is
+    not older than the stored copy, so a bulk load can't undo a notification.
+    """
+    
+    def __init__(self, service: str, servicepath: str):
+        self.service = service
+        self.servicepath = servicepath
+        self.entities = {}
+        self.by_type = {}
+        self.indexes = {}
+        self._sorted = {}
+        self.types = {}  # entity_type -> sync state
+        self.geo_attributes = {}  # entity_type -> location attribute in the spatial index
+        self.spatial = SpatialIndex() if np is not None else None
+    
+    def set_geo_attribute(self, entity_type: str, attr: str):
+        if self.spatial is None or self.geo_attributes.get(entity_type) == attr:
+            return
+        self.geo_attributes[entity_type] = attr
+        for key in self.by_type.get(entity_type, ()):
+            self.spatial.update(key, self.entities[key].get(attr))
+    
+    def add_index(self, attr: str):
+        if attr in self.indexes:
+            return
+        self.indexes[attr] = {}
+        for key, entity in self.entities.items():
+            self._index(attr, key, entity, add=True)
+    
+    def _index(self, attr: str, key: tuple, entity: dict, add: bool):
+        value = _attr_path(entity, attr)
+        index = self.indexes[attr]
+        for item in (value if isinstance(value, list) else [value]):
+            if item is None or isinstance(item, (dict, list)):
+                continue
+            item = _index_key(item)
+            if add:
+                index.setdefault(item, set()).add(key)
+            elif item in index:
+                index[item].discard(key)
+                if not index[item]:
+                    del index[item]
+        self._sorted.pop(attr, None)
+    
+    def upsert(self, entity: dict) -> bool:
+        key = (entity["type"], entity["id"])
+        current = self.entities.get(key)
+        if current is not None:
+            if str(entity.get("dateModified", "")) < str(current.get("dateModified", "")):
+                return False
+            self.remove(key)
+        self.entities[key] = entity
+        self.by_type.setdefault(key[0], set()).add(key)
+        for attr in self.indexes:
+            self._index(attr, key, entity, add=True)
+        geo_attribute = self.geo_attributes.get(key[0])
+        if geo_attribute:
+            self.spatial.update(key, entity.get(geo_attribute))
+        return True
+    
+    def remove(self, key: tuple):
+        entity = self.entities.pop(key, None)
+        if entity is None:
+            return
+        self.by_type.get(key[0], set()).discard(key)
+        for attr in self.indexes:
+            self._index(attr, key, entity, add=False)
+        if self.spatial is not None:
+            self.spatial.remove(key)
+    
+    def drop_type(self, entity_type: str):
+        for key in list(self.by_type.pop(entity_type, ())):
+            self.remove(key)
+        self.types.pop(entity_type, None)
+        self.geo_attributes.pop(entity_type, None)
+    
+    def _sorted_values(self, attr: str) -> tuple:
+        """(numbers, texts) as sorted [(value, key)] lists for one indexed attribute"""
+        cached = self._sorted.get(attr)
+        if cached is None:
+            numbers, texts = [], []
+            for value, keys in self.indexes[attr].items():
+                target = texts if isinstance(value, str) else numbers if not isinstance(value, tuple) else None
+                if target is not None:
+                    target.extend((value, key) for key in keys)
+            cached = self._sorted[attr] = (sorted(numbers), sorted(texts))
+        return cached
+    
+    def _index_lookup(self, attr: str, op: str, operand) -> Optional[set]:
+        """Keys matching one condition through an index, None if the index can't answer it"""
+        index = self.indexes.get(attr)
+        if index is None or op in ("!=", "~=", "present", "absent"):
+            return None
+        if op == "==" and operand[0] == "in":
+            return set().union(*(index.get(_index_key(value), ()) for value in operand[1]))
+        low, high = (operand[1], operand[2]) if op == "==" else (operand, operand)
+        if not _comparable(low, high):
+            return set()
+        numbers, texts = self._sorted_values(attr)
+        values = texts if isinstance(low, str) else numbers
+        if op == "==":
+            start = bisect.bisect_left(values, (low,))
+            end = bisect.bisect_right(values, (high, (chr(0x10FFFF),)))
+        elif op in (">", ">="):
+            start = bisect.bisect_right(values, (low, (chr(0x10FFFF),))) if op == ">" else bisect.bisect_left(values, (low,))
+            end = len(values)
+        else:
+            start = 0
+            end = bisect.bisect_left(values, (high,)) if op == "<" else bisect.bisect_right(values, (high, (chr(0x10FFFF),)))
+        return {key for _, key in values[start:end]}
+    
+    def query(self, entity_type: str = None, id_pattern: str = None, q: str = None,
+              georel: str = None, shape: dict = None, want: int = 0) -> tuple:
+        """
+        Matching entities, the number of conditions answered by an index, and
+        the distance in meters per key for "near" queries (else None).
+        
+        "near" without maxDistance is a nearest-neighbour search: the radius
+        grows until at least `want` entities match the other conditions.
+        """
+        candidates = None
+        if entity_type:
+            candidates = set(self.by_type.get(entity_type, ()))
+        remaining = []
+        indexed = 0
+        for attr, op, operand in parse_q(q):
+            keys = self._index_lookup(attr, op, operand)
+            if keys is None:
+                remaining.append((attr, op, operand))
+                continue
+            indexed += 1
+            candidates = keys if candidates is None else candidates & keys
+        
+        pattern = re.compile(id_pattern) if id_pattern else None
+        
+        def select(keys) -> list:
+            if keys is None:
+                keys = candidates if candidates is not None else self.entities
+            elif candidates is not None:
+                keys = [key for key in keys if key in candidates]
+            return [
+                entity for entity in (self.entities[key] for key in keys)
+                if (pattern is None or pattern.search(entity["id"]))
+                and all(matches_condition(entity, *condition) for condition in remaining)
+            ]
+        
+        if not georel:
+            return select(None), indexed, None
+        relation, max_distance, min_distance = parse_georel(georel)
+        if relation == "coveredBy" and not shape["polygons"]:
+            raise ValueError("georel coveredBy needs geometry='polygon' or 'box'")
+        if relation != "near":
+            return select(self.spatial.relate(relation, shape)), indexed + 1, None
+        if not shape["is_point"]:
+            raise ValueError("georel near needs geometry='point'")
+        
+        lon, lat = shape["vertices"][0]
+        radius = max_distance or self.spatial.cell_meters
+        while True:
+            keys, distances = self.spatial.near(lon, lat, radius, min_distance)
+            found = select(keys)
+            if max_distance or len(found) >= want or radius >= MAX_EARTH_DISTANCE_M:
+                return found, indexed + 1, dict(zip(keys, distances.tolist()))
+            radius *= 4
+    
+    def staleness(self, entity_type: str) -> dict:
+        state = self.types.get(entity_type)
+        if state is None:
+            return None
+        now = time.time()
+        result = {
+            "mode": "subscription" if state["subscription_id"] else "snapshot",
+            "entities": len(self.by_type.get(entity_type, ())),
+            "loaded_seconds_ago": round(now - state["loaded_at"], 1) if state["loaded_at"] else None,
+            "notifications": state["notifications"],
+        }
+        if state["subscription_id"]:
+            result["subscription_id"] = state["subscription_id"]
+            result["last_notification_seconds_ago"] = (round(now - state["last_notification"], 1)
+                                                       if state["last_notification"] else None)
+            result["last_lag_seconds"] = state["last_lag"]
+            result["max_lag_seconds"] = state["max_lag"]
+        return result
+
+
+_mirrors = {}
+_mirror_routes = {}  # notification token -> (mirror, entity_type)
+
+
+def get_mirror(service: str = None, servicepath: str = None, create: bool = False) -> Optional[EntityMirror]:
+    tenant = get_tenant(service, servicepath)
+    key = (tenant.service, tenant.subservice)
+    if key not in _mirrors and create:
+        _mirrors[key] = EntityMirror(*key)
+    return _mirrors.get(key)
+
+
+def apply_notification(mirror: EntityMirror, entity_type: str, data: list):
+    """Apply the entities of one subscription notification to a mirror"""
+    state = mirror.types.get(entity_type)
+    if state is None:
+        return
+    now = time.time()
+    state["last_notification"] = now
+    for entity in data:
+        alteration = entity.pop("alterationType", None) or "entityChange"
+        state["notifications"] += 1
+        metrics.inc("fiware_mirror_notifications_total", entity_type=entity_type, alteration=alteration)
+        if state["loading"]:
+            state["notified_while_loading"].add(entity["id"])
+        if alteration == "entityDelete":
+            mirror.remove((entity.get("type", entity_type), entity["id"]))
+            continue
+        if entity.get("dateModified"):
+            try:
+                lag = max(now - parse_date(entity["dateModified"]).timestamp(), 0)
+                state["last_lag"] = round(lag, 3)
+                state["max_lag"] = max(state["max_lag"] or 0, state["last_lag"])
+                metrics.observe("fiware_mirror_lag_seconds", lag, entity_type=entity_type)
+            except ValueError:
+                pass
+        entity.setdefault("type", entity_type)
+        mirror.upsert(entity)
+
+
+async def _subscribe_mirror(entity_type: str, token: str, service: str = None, servicepath: str = None) -> str:
+    """Create the change subscription feeding a mirror and return its id"""
+    url = f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/v2/subscriptions"
+    body = {
+        "description": f"fiware-mcp entity mirror of {entity_type}",
+        "subject": {
+            "entities": [{"idPattern": ".*", "type": entity_type}],
+            "condition": {"attrs": [], "alterationTypes": MIRROR_ALTERATION_TYPES},
+        },
+        "notification": {
+            "http": {"url": f"{MIRROR_NOTIFY_URL.rstrip('/')}/{token}"},
+            "attrs": ["*", "dateModified", "alterationType"],
+            "attrsFormat": "keyValues",
+        },
+    }
+    response = await make_request_async("POST", url, body, service=service, servicepath=servicepath)
+    if response.status_code == 400:
+        # Orion before 3.2 doesn't know alterationTypes: deletions then only show on the next reload
+        del body["subject"]["condition"]["alterationTypes"]
+        body["notification"]["attrs"] = ["*", "dateModified"]
+        response = await make_request_async("POST", url, body, service=service, servicepath=servicepath)
+    if not response.ok:
+        raise RuntimeError(f"Subscription failed with {response.status_code}: {response.text[:200]}")
+    return response.headers.get("Location", "").rsplit("/", 1)[-1]
+
+
+@mcp.custom_route("/notify/mirror/{token}", methods=["POST"])
+async def mirror_notification_endpoint(request):
+    """Orion notifications for the entity mirrors (only served in --http mode)"""
+    from starlette.responses import Response
+    target = _mirror_routes.get(request.path_params["token"])
+    if target is None:
+        return Response(status_code=404)
+    try:
+        payload = json.loads(await request.body())
+    except ValueError:
+        return Response(status_code=400)
+    apply_notification(*target, payload.get("data", []))
+    return Response(status_code=204)
+
+
+@mcp.tool()
+async def cb_mirror_start(entity_type: str, index_attributes: list = None, geo_attribute: str = "location",
+                          service: str = None, servicepath: str = None) -> str:
+    """
+    Load all entities of a type into a local mirror, so cb_mirror_query can filter, count and sort them locally.
+    
+    With MIRROR_NOTIFY_URL set (server running with --http), a subscription keeps
+    the mirror current. Otherwise the mirror is a snapshot: call this again to refresh it.
+    
+    Args:
+        entity_type: Entity type to mirror (e.g., "Room")
+        index_attributes: Attributes to index for fast ==, range and orderBy (e.g., ["temperature", "floor"])
+        geo_attribute: geo:json or geo:point attribute for the spatial index (default "location", None to skip)
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
+    
+    Returns:
+        Entities loaded, load time and sync mode
+    
+    Example:
+        cb_mirror_start("Room", index_attributes=["temperature"])
+    """
+    try:
+        mirror = get_mirror(service, servicepath, create=True)
+        for attr in index_attributes or []:
+            mirror.add_index(attr)
+        if geo_attribute:
+            mirror.set_geo_attribute(entity_type, geo_attribute)
+        
+        state = mirror.types.get(entity_type)
+        if state is None:
+            state = mirror.types[entity_type] = {
+                "subscription_id": None, "token": None, "loaded_at": None, "notifications": 0,
+                "last_notification": None, "last_lag": None, "max_lag": None,
+                "loading": False, "notified_while_loading": set(),
+            }
+        # Subscribe before loading, so no change falls between the snapshot and the first notification
+        if MIRROR_NOTIFY_URL and not state["subscription_id"]:
+            state["token"] = state["token"] or os.urandom(12).hex()
+            _mirror_routes[state["token"]] = (mirror, entity_type)
+            state["subscription_id"] = await _subscribe_mirror(entity_type, state["token"], service, servicepath)
+        
+        start = time.perf_counter()
+        state["loading"] = True
+        state["notified_while_loading"] = set()
+        loaded = set()
+        url = with_query(f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/v2/entities",
+                         type=entity_type, attrs="*,dateModified", options="keyValues")
+        pages = iter_pages(url, service=service, servicepath=servicepath)
+        notified = state["notified_while_loading"]
+        try:
+            async for response, items, total in pages:
+                if not response.ok:
+                    raise RuntimeError(f"Entity query failed with {response.status_code}: {response.text[:200]}")
+                if total is not None and len(mirror.entities) - len(mirror.by_type.get(entity_type, ())) \
+                        + total > MIRROR_MAX_ENTITIES:
+                    mirror.drop_type(entity_type)
+                    return to_json({"error": f"{total} {entity_type} entities exceed MIRROR_MAX_ENTITIES "
+                                             f"({MIRROR_MAX_ENTITIES}) for this tenant"})
+                for entity in items:
+                    # A notification during the load is newer than the page (and may be a deletion)
+                    if entity["id"] not in notified:
+                        mirror.upsert(entity)
+                    loaded.add((entity["type"], entity["id"]))
+        finally:
+            state["loading"] = False
+            await pages.aclose()
+        
+        # Entities deleted in the broker since the previous load
+        for key in mirror.by_type.get(entity_type, set()) - loaded:
+            if key[1] not in notified:
+                mirror.remove(key)
+        state["notified_while_loading"] = set()
+        state["loaded_at"] = time.time()
+        
+        result = {
+            "success": True,
+            "entity_type": entity_type,
+            "entities": len(mirror.by_type.get(entity_type, ())),
+            "load_seconds": round(time.perf_counter() - start, 3),
+            "indexes": sorted(mirror.indexes),
+            "mode": "subscription" if state["subscription_id"] else "snapshot",
+        }
+        if mirror.geo_attributes.get(entity_type):
+            result["geo_attribute"] = mirror.geo_attributes[entity_type]
+            result["located_entities"] = sum(key in mirror.spatial.slots for key in mirror.by_type.get(entity_type, ()))
+        if state["subscription_id"]:
+            result["subscription_id"] = state["subscription_id"]
         else:
-            result["error"] = data or response.reason
-            if response.status_code == 404:
-                result["hint"] = "Not found. Check ID or try GET /v2/entities"
-            elif response.status_code == 400:
-                result["hint"] = "Bad request. Check endpoint and body format."
+            result["hint"] = "Set MIRROR_NOTIFY_URL and run with --http to keep the mirror current"
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def cb_mirror_query(entity_type: str = None, q: str = None, id_pattern: str = None,
+                          attrs: list = None, order_by: str = None, limit: int = 20, offset: int = 0,
+                          count_only: bool = False, georel: str = None, geometry: str = None, coords: str = None,
+                          service: str = None, servicepath: str = None) -> str:
+    """
+    Filter, count and sort mirrored entities locally (see cb_mirror_start), without querying Orion.
+    
+    Args:
+        entity_type: Mirrored entity type (None = all mirrored types)
+        q: NGSI-v2 simple query (e.g., "temperature>30;status==on", "floor==1..3", "name~=^Lab")
+        id_pattern: Regex on entity ids
+        attrs: Attributes to return (default all)
+        order_by: Comma-separated attributes, "!" for descending (e.g., "!temperature,id"), or "geo:distance"
+        limit: Max entities returned (default 20)
+        offset: Skip this many matches
+        count_only: Only return the number of matches
+        georel: Orion-style geo relation: "near;maxDistance:1000", "near;minDistance:10", "coveredBy",
+                "intersects" or "disjoint". "near" alone returns the `limit` nearest entities.
+        geometry: "point", "line", "box" or "polygon" (required with georel)
+        coords: Geometry coordinates as "lat,lon;lat,lon" (e.g., "40.41,-3.70")
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
+    
+    Returns:
+        keyValues entities (with distance_m for near), total count and how stale the mirror is
+    
+    Examples:
+        cb_mirror_query("Room", q="temperature>30", order_by="!temperature", limit=5)
+        cb_mirror_query("AirQualityObserved", georel="near", geometry="point", coords="40.41,-3.70", limit=10)
+        cb_mirror_query("Streetlight", georel="coveredBy", geometry="box", coords="40.40,-3.71;40.42,-3.69", count_only=True)
+    """
+    try:
+        mirror = get_mirror(service, servicepath)
+        if mirror is None or (entity_type and entity_type not in mirror.types):
+            return to_json({"error": f"No mirror of {entity_type or 'any type'} for this tenant",
+                            "hint": "Call cb_mirror_start(entity_type) first"})
+        
+        shape = None
+        if georel:
+            if mirror.spatial is None:
+                return to_json({"error": "NumPy is required for geo queries", "hint": "pip install numpy"})
+            if not (geometry and coords):
+                return to_json({"error": "georel needs geometry and coords",
+                                "hint": "e.g. georel='near;maxDistance:500', geometry='point', coords='40.41,-3.70'"})
+            shape = query_geometry(geometry, coords)
+        
+        start = time.perf_counter()
+        found, indexed, distances = mirror.query(entity_type, id_pattern, q, georel, shape,
+                                                 want=1 if count_only else offset + limit)
+        result = {"success": True, "source": "mirror", "count": len(found)}
+        if distances is not None and not order_by:
+            order_by = "geo:distance"
+        if not count_only:
+            def value_of(entity: dict, name: str):
+                if name == "geo:distance" and distances is not None:
+                    return distances[(entity["type"], entity["id"])]
+                return _attr_path(entity, name)
+            
+            found = order_entities(found, order_by, value_of)
+            page = found[offset:offset + limit]
+            if attrs:
+                keep = {"id", "type", *attrs}
+                page = [{k: v for k, v in entity.items() if k in keep} for entity in page]
+            if distances is not None:
+                page = [{**entity, "distance_m": round(distances[(entity["type"], entity["id"])], 1)}
+                        for entity in page]
+            result["data"] = page
+            if offset + limit < len(found):
+                result["next_offset"] = offset + limit
+        result["query_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        result["indexed_conditions"] = indexed
+        types = [entity_type] if entity_type else sorted(mirror.types)
+        result["staleness"] = {t: mirror.staleness(t) for t in types}
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def cb_mirror_status(verify: bool = False, service: str = None, servicepath: str = None) -> str:
+    """
+    Show mirrored entity types, their indexes and how far each lags the Context Broker.
+    
+    Args:
+        verify: Also compare entity counts with Orion and read each subscription's delivery status
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
+    
+    Returns:
+        Per type: entities, sync mode, seconds since load and last notification, notification lag
+    """
+    try:
+        mirror = get_mirror(service, servicepath)
+        if mirror is None:
+            return to_json({"success": True, "types": {}, "hint": "No mirror for this tenant"})
+        
+        types = {entity_type: mirror.staleness(entity_type) for entity_type in mirror.types}
+        if verify:
+            async def check(entity_type: str):
+                status = types[entity_type]
+                url = with_query(f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/v2/entities", type=entity_type,
+                                 limit=1, attrs="dateModified", options="count,keyValues")
+                response = await make_request_async("GET", url, service=service, servicepath=servicepath)
+                if response.ok:
+                    status["broker_entities"] = int(response.headers.get("Fiware-Total-Count", 0))
+                    status["count_drift"] = status["entities"] - status["broker_entities"]
+                if status.get("subscription_id"):
+                    response = await make_request_async(
+                        "GET", f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/v2/subscriptions/{status['subscription_id']}",
+                        service=service, servicepath=servicepath)
+                    if response.ok:
+                        notification = response.json().get("notification", {})
+                        status["subscription"] = {
+                            "status": response.json().get("status"),
+                            **{k: notification.get(k) for k in ("timesSent", "lastSuccess", "lastFailure")},
+                        }
+            
+            await asyncio.gather(*(check(entity_type) for entity_type in types))
+        
+        return to_json({
+            "success": True,
+            "service": mirror.service,
+            "servicepath": mirror.servicepath,
+            "total_entities": len(mirror.entities),
+            "indexes": sorted(mirror.indexes),
+            "types": types,
+        })
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def cb_mirror_stop(entity_type: str, service: str = None, servicepath: str = None) -> str:
+    """
+    Drop the local mirror of an entity type and delete its subscription.
+    
+    Args:
+        entity_type: Mirrored entity type
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
+    """
+    try:
+        mirror = get_mirror(service, servicepath)
+        state = mirror.types.get(entity_type) if mirror else None
+        if state is None:
+            return to_json({"error": f"No mirror of {entity_type} for this tenant"})
+        
+        result = {"success": True, "entity_type": entity_type,
+                  "entities_dropped": len(mirror.by_type.get(entity_type, ()))}
+        if state["subscription_id"]:
+            response = await make_request_async(
+                "DELETE", f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/v2/subscriptions/{state['subscription_id']}",
+                service=service, servicepath=servicepath)
+            result["subscription_deleted"] = response.ok or response.status_code == 404
+        _mirror_routes.pop(state["token"], None)
+        mirror.drop_type(entity_type)
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+# =============================================================================
+# FEDERATION - One query across several Context Brokers and service paths
+# =============================================================================
+
+def _parse_brokers(value: str) -> dict:
+    """{"eu": "https://orion-eu:1026", ...} from "eu=https://orion-eu:1026,..." """
+    brokers = {}
+    for item in value.split(","):
+        name, _, url = item.strip().partition("=")
+        if name and url:
+            brokers[name.strip()] = url.strip().rstrip("/")
+    return brokers
+
+
+_brokers = _parse_brokers(FEDERATION_BROKERS)
+
+
+def broker_url(broker: str = None) -> str:
+    """
+    Base URL of a broker given by FEDERATION_BROKERS name (default CB_HOST).
+    
+    Arbitrary URLs are refused: requests carry the tenant's x-auth-token,
+    which must only reach configured brokers.
+    """
+    if not broker or broker == "default":
+        return f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}"
+    if broker in _brokers:
+        return _brokers[broker]
+    raise ValueError(f"Unknown broker {broker!r}: use a name from FEDERATION_BROKERS "
+                     f"({', '.join(_brokers) or 'none configured'})")
+
+
+async def query_target(target: dict, endpoint: str, auto_paginate: bool, max_entities: int,
+                       max_bytes: int, timeout: float) -> tuple:
+    """Run one query against a (broker, service, servicepath) target: (status dict, entities)"""
+    service, servicepath = target.get("service"), target.get("servicepath")
+    tenant = get_tenant(service, servicepath)
+    status = {
+        "broker": target.get("broker") or "default",
+        "service": tenant.service,
+        "servicepath": tenant.subservice,
+    }
+    start = time.perf_counter()
+    try:
+        url = broker_url(target.get("broker")) + endpoint
+        if auto_paginate:
+            result = await asyncio.wait_for(
+                _paginated_request(url, max_entities, max_bytes, service, servicepath),
+                target.get("timeout", timeout))
+            if not result["success"] and not result.get("data"):
+                raise RuntimeError(f"HTTP {result['status_code']}: {str(result['error'])[:200]}")
+            entities = result.get("data", [])
+            if isinstance(entities, dict):
+                entities = [entities]
+            if result.get("truncated") or not result["success"]:
+                status["truncated"] = True
+        else:
+            response = await asyncio.wait_for(
+                make_request_async("GET", url, service=service, servicepath=servicepath),
+                target.get("timeout", timeout))
+            if not response.ok:
+                raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200] or response.reason}")
+            entities = response.json() if response.content else []
+            if isinstance(entities, dict):
+                entities = [entities]
+            total = response.headers.get("Fiware-Total-Count")
+            if total is not None:
+                status["total_count"] = int(total)
+        status.update(status="ok", count=len(entities))
+    except asyncio.TimeoutError:
+        status.update(status="timeout", error=f"No response within {target.get('timeout', timeout)}s")
+        entities = []
+    except Exception as e:
+        status.update(status="error", error=str(e))
+        entities = []
+    status["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return status, entities
+
+
+@mcp.tool()
+async def cb_federated_query(endpoint: str, targets: list, order_by: str = None, dedupe: bool = True,
+                             max_entities: int = 1000, auto_paginate: bool = False, max_bytes: int = 10_000_000,
+                             timeout: float = FEDERATION_TIMEOUT, projection: str = None,
+                             tag_source: bool = False) -> str:
+    """
+    Run the same NGSI-v2 GET query against several brokers / service paths at once and merge the results.
+    
+    Args:
+        endpoint: Query endpoint, as for fiware_request (e.g., "/v2/entities?type=Room&q=temperature>30")
+        targets: List of {"broker", "service", "servicepath", "timeout"} (all optional). broker is a
+                 name from FEDERATION_BROKERS; defaults are CB_HOST, SERVICE, SUBSERVICE
+        order_by: Sort the merged entities, Orion style (e.g., "!temperature,id")
+        dedupe: Keep one copy of entities (same id and type) found in several targets, the most
+                recently modified when dateModified is available, otherwise the first target's
+        max_entities: Cap on merged entities returned (default 1000)
+        auto_paginate: Fetch all pages from each target (up to max_entities and max_bytes each)
+        max_bytes: Cap on response bytes merged per target when auto_paginate is on (default 10 MB)
+        timeout: Seconds to wait for each target (default FEDERATION_TIMEOUT)
+        projection: Compact entity output: "keyValues" or "columnar"
+        tag_source: Add "_source": "broker|service|servicepath" to each entity
+    
+    Returns:
+        Merged entities plus per-target status (ok / timeout / error, count, elapsed_ms).
+        Failed or slow targets make the result partial instead of failing the call.
+    
+    Example:
+        cb_federated_query("/v2/entities?type=Room&q=temperature>30",
+                           targets=[{"broker": "eu", "servicepath": "/madrid"},
+                                    {"broker": "eu", "servicepath": "/paris"},
+                                    {"broker": "us", "servicepath": "/boston", "timeout": 20}],
+                           order_by="!temperature", tag_source=True)
+    """
+    try:
+        if not endpoint.startswith("/"):
+            return to_json({"error": "endpoint must start with /", "hint": "e.g. /v2/entities?type=Room"})
+        if not targets:
+            return to_json({"error": "No targets given",
+                            "hint": "targets=[{'broker': 'eu', 'servicepath': '/madrid'}, ...]",
+                            "configured_brokers": _brokers})
+        
+        semaphore = asyncio.Semaphore(FEDERATION_CONCURRENCY)
+        
+        async def run(target):
+            async with semaphore:
+                return await query_target(target, endpoint, auto_paginate, max_entities, max_bytes, timeout)
+        
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(run(target) for target in targets))
+        
+        merged = {}
+        unkeyed = []
+        duplicates = 0
+        for status, entities in outcomes:
+            source = f"{status['broker']}|{status['service']}|{status['servicepath']}"
+            for entity in entities:
+                if tag_source and isinstance(entity, dict):
+                    entity["_source"] = source
+                if not (dedupe and _is_entity(entity)):
+                    unkeyed.append(entity)
+                    continue
+                key = (entity["id"], entity["type"])
+                current = merged.get(key)
+                if current is None:
+                    merged[key] = entity
+                    continue
+                duplicates += 1
+                if str(_sort_value(entity, "dateModified") or "") > str(_sort_value(current, "dateModified") or ""):
+                    merged[key] = entity
+        
+        entities = order_entities(list(merged.values()) + unkeyed, order_by)
+        statuses = [status for status, _ in outcomes]
+        failed = [status for status in statuses if status["status"] != "ok"]
+        result = {
+            "success": len(failed) < len(statuses),
+            "partial": bool(failed) or any(status.get("truncated") for status in statuses),
+            "count": min(len(entities), max_entities),
+            "merged_count": len(entities),
+            "duplicates_removed": duplicates,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+            "targets": statuses,
+            "data": project_entities(entities[:max_entities], projection),
+        }
+        if len(entities) > max_entities:
+            result["truncated"] = True
+        if failed:
+            result["hint"] = f"{len(failed)} of {len(statuses)} targets failed or timed out; data is partial."
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+# =============================================================================
+# SUBSCRIPTIONS - Listing, bulk creation and notification health
+# =============================================================================
+
+# Notification format each sink parses (STH-Comet only understands the legacy NGSI-v1 format)
+SUBSCRIPTION_SINKS = {
+    "sth": {"attrsFormat": "legacy"},
+    "perseo": {"attrsFormat": "normalized"},
+    "quantumleap": {"attrsFormat": "normalized", "metadata": ["dateCreated", "dateModified"]},
+}
+
+# Counters of the last health check per tenant: (service, subservice) -> (time, {id: timesSent})
+_subscription_samples = {}
+
+
+def sink_url(sink: str) -> str:
+    """Notification URL of a FIWARE sink, as the Context Broker reaches it"""
+    if sink == "sth":
+        return f"{CB_PROTOCOL}://{STH_HOST}:{STH_PORT}/notify"
+    if sink == "perseo":
+        return f"{CB_PROTOCOL}://{CEP_HOST}:{CEP_PORT}/notices"
+    return f"{CB_PROTOCOL}://{QL_HOST}:{QL_PORT}/v2/notify"
+
+
+def _notify_url(subscription: dict) -> Optional[str]:
+    notification = subscription.get("notification", {})
+    for kind in ("http", "httpCustom", "mqtt", "mqttCustom"):
+        if kind in notification:
+            return notification[kind].get("url")
+    return None
+
+
+def _subscription_types(subscription: dict) -> list:
+    return [entity.get("type") or entity.get("typePattern") or "*"
+            for entity in subscription.get("subject", {}).get("entities", [])]
+
+
+def subscription_summary(subscription: dict) -> dict:
+    """What a subscription watches, where it notifies and how delivery is going, without the boilerplate"""
+    subject = subscription.get("subject", {})
+    notification = subscription.get("notification", {})
+    summary = {
+        "id": subscription.get("id"),
+        "description": subscription.get("description"),
+        "status": subscription.get("status"),
+        "entities": [f"{entity.get('type') or entity.get('typePattern') or '*'}:"
+                     f"{entity.get('id') or entity.get('idPattern') or '*'}"
+                     for entity in subject.get("entities", [])],
+        "condition_attrs": subject.get("condition", {}).get("attrs") or None,
+        "notify_url": _notify_url(subscription),
+        "attrsFormat": notification.get("attrsFormat"),
+        "throttling": subscription.get("throttling"),
+        "expires": subscription.get("expires"),
+    }
+    for key in ("timesSent", "lastNotification", "lastSuccess", "lastSuccessCode",
+                "lastFailure", "lastFailureReason", "failsCounter"):
+        summary[key] = notification.get(key)
+    return {key: value for key, value in summary.items() if value is not None}
+
+
+# Raised by a subscription with an invalid typePattern or an unexpected date
+UNPARSEABLE_ERRORS = (re.error, ValueError, TypeError, AttributeError)
+
+
+def _watches_type(subscription: dict, entity_type: str) -> bool:
+    for entity in subscription.get("subject", {}).get("entities", []):
+        if entity.get("type") == entity_type:
+            return True
+        if entity.get("typePattern") and re.fullmatch(entity["typePattern"], entity_type):
+            return True
+    return False
+
+
+def subscription_state(summary: dict) -> str:
+    """ok, failing (last delivery failed), never_notified, or Orion's status when not active"""
+    status = summary.get("status", "active")
+    if status not in ("active", "oneshot"):
+        return status
+    last_success, last_failure = summary.get("lastSuccess"), summary.get("lastFailure")
+    if last_failure and (not last_success or parse_date(last_failure) > parse_date(last_success)):
+        return "failing"
+    if not summary.get("timesSent"):
+        return "never_notified"
+    return "ok"
+
+
+async def fetch_subscriptions(service: str = None, servicepath: str = None, fresh: bool = False) -> list:
+    """All subscriptions of a tenant, pages fetched concurrently (fresh skips the response cache)"""
+    url = f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/v2/subscriptions"
+    subscriptions = []
+    pages = iter_pages(url, page_size=min(PAGINATION_PAGE_SIZE, 1000), service=service, servicepath=servicepath,
+                       extra_headers={"Cache-Control": "no-cache"} if fresh else None)
+    try:
+        async for response, items, _ in pages:
+            if not response.ok:
+                raise RuntimeError(f"Listing subscriptions failed with {response.status_code}: {response.text[:200]}")
+            subscriptions.extend(items)
+    finally:
+        await pages.aclose()
+    return subscriptions
+
+
+@mcp.tool()
+async def cb_list_subscriptions(entity_type: str = None, status: str = None, notify_url: str = None,
+                                limit: int = 100, offset: int = 0,
+                                service: str = None, servicepath: str = None) -> str:
+    """
+    List Context Broker subscriptions as compact summaries, with delivery counters.
+    
+    All pages are fetched concurrently, so filters apply to every subscription of the tenant.
+    
+    Args:
+        entity_type: Only subscriptions on this entity type (exact type or matching typePattern)
+        status: Only this status: active, inactive, expired, failed or oneshot
+        notify_url: Only subscriptions whose notification URL contains this text (e.g., ":8666")
+        limit: Summaries returned (default 100)
+        offset: Summaries skipped, for paging through the filtered list
+        service: Fiware-Service header (optional)
+        servicepath: Fiware-ServicePath header (optional)
+    
+    Returns:
+        id, description, status, watched entities, notify_url, throttling, timesSent,
+        lastSuccess / lastFailure (with reason) of each subscription, plus counts by state
+    
+    Example:
+        cb_list_subscriptions(entity_type="Room", notify_url="/notify")
+    """
+    try:
+        subscriptions = await fetch_subscriptions(service, servicepath)
+        matches = []
+        states = Counter()
+        for subscription in subscriptions:
+            if status and subscription.get("status", "active") != status:
+                continue
+            if notify_url and notify_url not in (_notify_url(subscription) or ""):
+                continue
+            summary = subscription_summary(subscription)
+            try:
+                if entity_type and not _watches_type(subscription, entity_type):
+                    continue
+                states[subscription_state(summary)] += 1
+            except UNPARSEABLE_ERRORS as e:
+                # Listed (whatever the filter) so that it can be fixed, instead of failing the whole listing
+                summary["unparseable"] = str(e)
+                states["unparseable"] += 1
+            matches.append(summary)
+        
+        page = matches[offset:offset + limit]
+        result = {
+            "success": True,
+            "total_count": len(subscriptions),
+            "matched": len(matches),
+            "count": len(page),
+            "states": dict(states),
+            "data": page,
+        }
+        if offset + limit < len(matches):
+            result["next_offset"] = offset + limit
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def cb_create_subscriptions(entity_types: list, sink: str = "sth", attrs: list = None,
+                                  condition_attrs: list = None, id_pattern: str = ".*", throttling: int = None,
+                                  expires: str = None, notify_url: str = None, skip_existing: bool = True,
+                                  service: str = None, servicepath: str = None) -> str:
+    """
+    Subscribe a FIWARE sink (STH-Comet, Perseo or QuantumLeap) to many entity types in one call.
+    
+    One subscription is created per type, SUBSCRIPTION_CONCURRENCY at a time, with the
+    notification format the sink expects (legacy for STH-Comet).
+    
+    Args:
+        entity_types: Entity types to subscribe (e.g., ["Room", "Streetlight", "AirQualityObserved"])
+        sink: "sth" (historical data), "perseo" (CEP rules) or "quantumleap" (time series)
+        attrs: Attributes sent in notifications (default all)
+        condition_attrs: Attributes whose change triggers a notification (default any)
+        id_pattern: Entity id pattern watched (default ".*")
+        throttling: Minimum seconds between notifications of each subscription (optional)
+        expires: Expiration date, ISO 8601 (optional)
+        notify_url: Notification URL as the Context Broker reaches the sink, when it differs
+                    from the STH_HOST / CEP_HOST / QL_HOST settings (e.g., a Docker service name)
+        skip_existing: Skip types that already have a subscription to the same notify URL
+        service: Fiware-Service header (optional)
+        servicepath: Fiware-ServicePath header (optional)
+    
+    Returns:
+        Created subscription ids per type, skipped types (with the existing id) and failures
+    
+    Example:
+        cb_create_subscriptions(["Room", "Streetlight"], sink="sth", throttling=5)
+    """
+    try:
+        if sink not in SUBSCRIPTION_SINKS:
+            return to_json({"error": f"Unknown sink: {sink}", "hint": f"Use one of {', '.join(SUBSCRIPTION_SINKS)}"})
+        if not entity_types:
+            return to_json({"error": "No entity_types given", "hint": "entity_types=['Room', 'Streetlight']"})
+        
+        url = notify_url or sink_url(sink)
+        existing = {}
+        if skip_existing:
+            for subscription in await fetch_subscriptions(service, servicepath, fresh=True):
+                if _notify_url(subscription) == url:
+                    for entity_type in _subscription_types(subscription):
+                        existing.setdefault(entity_type, subscription.get("id"))
+        
+        endpoint = f"{CB_PROTOCOL}://{CB_HOST}:{CB_PORT}/v2/subscriptions"
+        notification = {"http": {"url": url}, "attrs": attrs or [], **SUBSCRIPTION_SINKS[sink]}
+        
+        async def create(entity_type: str) -> dict:
+            body = {
+                "description": f"{sink} subscription for {entity_type}",
+                "subject": {
+                    "entities": [{"idPattern": id_pattern, "type": entity_type}],
+                    "condition": {"attrs": condition_attrs or []},
+                },
+                "notification": dict(notification),
+            }
+            if throttling:
+                body["throttling"] = throttling
+            if expires:
+                body["expires"] = expires
+            try:
+                response = await make_request_async("POST", endpoint, body, service=service, servicepath=servicepath)
+            except Exception as e:
+                return {"type": entity_type, "error": str(e)}
+            if not response.ok:
+                return {"type": entity_type, "error": f"HTTP {response.status_code}: {response.text[:200]}"}
+            return {"type": entity_type, "id": response.headers.get("Location", "").rsplit("/", 1)[-1]}
+        
+        todo = [entity_type for entity_type in dict.fromkeys(entity_types) if entity_type not in existing]
+        created, failed = [], []
+        async for outcome in iter_ordered(create, todo, SUBSCRIPTION_CONCURRENCY):
+            (failed if "error" in outcome else created).append(outcome)
+        
+        result = {
+            "success": not failed,
+            "sink": sink,
+            "notify_url": url,
+            "created": created,
+            "skipped": [{"type": entity_type, "existing_id": existing[entity_type]}
+                        for entity_type in dict.fromkeys(entity_types) if entity_type in existing],
+        }
+        if failed:
+            result["failed"] = failed
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def cb_subscription_health(sample_seconds: float = 0, top: int = 10,
+                                 service: str = None, servicepath: str = None) -> str:
+    """
+    Diagnose notification delivery: failing, silent, throttle-bound and busiest subscriptions, and load per sink.
+    
+    Throughput is the growth of each subscription's timesSent, either over a sample taken
+    now (sample_seconds > 0) or since the previous call for the same tenant. Orion may
+    flush counters in batches (subscription cache interval), so sample at least that long.
+    
+    Args:
+        sample_seconds: Read the counters twice this many seconds apart (default 0: compare
+                        with the previous call, or report no rates on the first one)
+        top: Subscriptions listed per category (default 10)
+        service: Fiware-Service header (optional)
+        servicepath: Fiware-ServicePath header (optional)
+    
+    Returns:
+        Counts by state (ok, failing, never_notified, inactive, expired, failed, unparseable), per-sink
+        totals (subscriptions, failing, notifications/s), and the top subscriptions that are
+        failing (with lastFailureReason), throttle-bound (rate near 1/throttling) or busiest
+    
+    Example:
+        cb_subscription_health(sample_seconds=30)
+    """
+    try:
+        tenant = get_tenant(service, servicepath)
+        key = (tenant.service, tenant.subservice)
+        baseline = _subscription_samples.get(key)
+        if sample_seconds > 0:
+            first = await fetch_subscriptions(service, servicepath, fresh=True)
+            baseline = (time.time(), {s.get("id"): s.get("notification", {}).get("timesSent", 0) for s in first})
+            await asyncio.sleep(sample_seconds)
+        subscriptions = await fetch_subscriptions(service, servicepath, fresh=True)
+        now = time.time()
+        counts = {s.get("id"): s.get("notification", {}).get("timesSent", 0) for s in subscriptions}
+        _subscription_samples[key] = (now, counts)
+        elapsed = now - baseline[0] if baseline else 0
+        
+        rows = []
+        sinks = {}
+        for subscription in subscriptions:
+            summary = subscription_summary(subscription)
+            row = {
+                "id": summary.get("id"),
+                "description": summary.get("description"),
+                "entities": summary.get("entities"),
+                "notify_url": summary.get("notify_url"),
+                "timesSent": summary.get("timesSent", 0),
+            }
+            try:
+                row["state"] = subscription_state(summary)
+                for field in ("lastSuccess", "lastFailure", "lastNotification"):
+                    if field in summary:
+                        row[f"{field}_age_s"] = round(now - parse_date(summary[field]).timestamp(), 1)
+            except UNPARSEABLE_ERRORS as e:
+                row["state"] = "unparseable"
+                row["unparseable"] = str(e)
+            for field in ("lastFailureReason", "failsCounter", "throttling"):
+                if field in summary:
+                    row[field] = summary[field]
+            if elapsed > 0 and row["id"] in baseline[1]:
+                row["rate_per_s"] = round(max(row["timesSent"] - baseline[1][row["id"]], 0) / elapsed, 3)
+                if summary.get("throttling"):
+                    # Orion sends at most one notification per throttling period
+                    row["throttle_utilization"] = round(row["rate_per_s"] * summary["throttling"], 2)
+            rows.append(row)
+            
+            host = urlsplit(row["notify_url"] or "").netloc or "unknown"
+            totals = sinks.setdefault(host, {"sink": host, "subscriptions": 0, "failing": 0, "timesSent": 0})
+            totals["subscriptions"] += 1
+            totals["failing"] += row["state"] == "failing"
+            totals["timesSent"] += row["timesSent"]
+            if "rate_per_s" in row:
+                totals["rate_per_s"] = round(totals.get("rate_per_s", 0) + row["rate_per_s"], 3)
         
-        return json.dumps(result, indent=2)
+        load = "rate_per_s" if elapsed > 0 else "timesSent"
+        failing = sorted((row for row in rows if row["state"] == "failing"),
+                         key=lambda row: row.get("lastFailure_age_s", float("inf")))
+        throttled = sorted((row for row in rows if row.get("throttle_utilization", 0) >= SUBSCRIPTION_THROTTLE_RATIO),
+                           key=lambda row: -row["throttle_utilization"])
+        busiest = sorted((row for row in rows if row.get(load)), key=lambda row: -row[load])
+        result = {
+            "success": True,
+            "count": len(rows),
+            "states": dict(Counter(row["state"] for row in rows)),
+            "sample_seconds": round(elapsed, 1) if elapsed else None,
+            "sinks": sorted(sinks.values(), key=lambda totals: -totals.get(load, 0)),
+            "failing": failing[:top],
+            "throttle_bound": throttled[:top],
+            "busiest": busiest[:top],
+            "never_notified": [row["id"] for row in rows if row["state"] == "never_notified"][:top],
+        }
+        unparseable = [{"id": row["id"], "error": row["unparseable"]} for row in rows if "unparseable" in row]
+        if unparseable:
+            result["unparseable"] = unparseable[:top]
+        if not elapsed:
+            result["hint"] = ("No notification rates yet: busiest is ranked by lifetime timesSent. "
+                              "Call again later, or pass sample_seconds=30, to measure throughput.")
+        return to_json(result)
     except Exception as e:
         return json.dumps({"error": str(e)})
 
@@ -248,9 +3901,349 @@ def fiware_request(method: str, endpoint: str, body: dict = None) -> str:
 # STH-COMET - Historical Data
 # =============================================================================
 
+NO_HISTORY_NOTE = "No historical data found. This is normal if: (1) No data has been collected yet, (2) Subscriptions to STH-Comet are not configured, or (3) The time range has no data. Create them with cb_create_subscriptions(entity_types=[...], sink='sth') to start collecting historical data."
+
+
+def sth_url(entity_type: str, entity_id: str, attribute: str) -> str:
+    return f"{CB_PROTOCOL}://{STH_HOST}:{STH_PORT}/STH/v1/contextEntities/type/{entity_type}/id/{entity_id}/attributes/{attribute}"
+
+
+def sth_values(data) -> list:
+    """Values list from the nested STH-Comet response, [] if absent"""
+    try:
+        return data["contextResponses"][0]["contextElement"]["attributes"][0]["values"]
+    except (KeyError, IndexError, TypeError):
+        return []
+
+
+def parse_duration(value: str) -> float:
+    """Seconds in a duration like "30s", "15m", "6h", "1d" or "1w" """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    value = value.strip().lower()
+    if not value or value[-1] not in units:
+        raise ValueError(f"Invalid duration: {value}. Use a number plus s, m, h, d or w (e.g. '6h').")
+    seconds = float(value[:-1]) * units[value[-1]]
+    if not 0 < seconds < float("inf"):
+        raise ValueError(f"Invalid duration: {value}. It must be positive.")
+    return seconds
+
+
+def parse_date(value: str) -> datetime:
+    """Parse an ISO 8601 date, assuming UTC when no offset is given"""
+    date = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+
+def format_date(date: datetime) -> str:
+    """ISO 8601 UTC with milliseconds, as STH-Comet expects"""
+    date = date.astimezone(timezone.utc)
+    return date.strftime("%Y-%m-%dT%H:%M:%S.") + f"{date.microsecond // 1000:03d}Z"
+
+
+MAX_WINDOWS = 10000  # windows per split range, so a tiny window over years fails fast
+
+
+def split_range(date_from: str, date_to: str, window_seconds: float) -> list:
+    """Split [date_from, date_to] into consecutive, non-overlapping (from, to) windows"""
+    start, end = parse_date(date_from), parse_date(date_to)
+    if not window_seconds > 0:
+        raise ValueError("Window must be positive")
+    if (end - start).total_seconds() / window_seconds >= MAX_WINDOWS:
+        raise ValueError(f"Range split into more than {MAX_WINDOWS} windows: use a larger window")
+    step = timedelta(seconds=window_seconds)
+    windows = []
+    while start <= end:
+        window_end = min(start + step - timedelta(milliseconds=1), end)
+        windows.append((format_date(start), format_date(window_end)))
+        start += step
+    return windows
+
+
+async def fetch_sth_window(url: str, date_from: str, date_to: str, page_size: int = STH_PAGE_SIZE,
+                           limiter: HostRateLimiter = None,
+                           service: str = None, servicepath: str = None) -> list:
+    """All raw values in one time window as [recvTime, attrValue] pairs, paging with hLimit/hOffset"""
+    values = []
+    offset = 0
+    while True:
+        page_url = with_query(url, lastN=None, hLimit=page_size, hOffset=offset, dateFrom=date_from, dateTo=date_to)
+        if limiter:
+            await limiter.acquire(page_url)
+        response = await make_request_async("GET", page_url, service=service, servicepath=servicepath)
+        if not response.ok:
+            raise RuntimeError(f"STH-Comet returned {response.status_code} for {date_from}..{date_to}: {response.text[:200]}")
+        page = sth_values(response.json() if response.content else None)
+        values.extend([value["recvTime"], value["attrValue"]] for value in page)
+        if len(page) < page_size:
+            break
+        offset += page_size
+    values.sort(key=lambda value: value[0])
+    return values
+
+
+async def iter_history(entity_type: str, entity_id: str, attribute: str,
+                       date_from: str, date_to: str, window: str,
+                       concurrency: int = STH_CONCURRENCY, limiter: HostRateLimiter = None,
+                       service: str = None, servicepath: str = None):
+    """Yield the [recvTime, value] pairs of each time window, in timestamp order"""
+    url = sth_url(entity_type, entity_id, attribute)
+    
+    async def fetch(bounds):
+        return await fetch_sth_window(url, bounds[0], bounds[1], limiter=limiter,
+                                      service=service, servicepath=servicepath)
+    
+    windows = iter_ordered(fetch, split_range(date_from, date_to, parse_duration(window)), concurrency)
+    try:
+        async for values in windows:
+            yield values
+    finally:
+        await windows.aclose()
+
+
+class HistoryStore:
+    """
+    SQLite store of raw STH values keyed by (service, servicepath, type, id, attribute).
+    
+    Each series records the time ranges already downloaded from STH-Comet, so
+    repeat queries only fetch what lies outside them. When the total row count
+    exceeds max_rows, the least recently used series are evicted.
+    """
+    
+    def __init__(self, path: str, max_rows: int):
+        self.path = path
+        self.max_rows = max_rows
+        self._db = None
+        self._lock = threading.Lock()
+        self.evictions = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_rows > 0
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.executescript("""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS series (
+                    id INTEGER PRIMARY KEY,
+                    service TEXT, servicepath TEXT, entity_type TEXT, entity_id TEXT, attribute TEXT,
+                    row_count INTEGER DEFAULT 0, last_access REAL,
+                    UNIQUE (service, servicepath, entity_type, entity_id, attribute)
+                );
+                CREATE TABLE IF NOT EXISTS ranges (
+                    series_id INTEGER, covered_from TEXT, covered_to TEXT
+                );
+                CREATE INDEX IF NOT EXISTS ranges_series ON ranges (series_id);
+                CREATE TABLE IF NOT EXISTS samples (
+                    series_id INTEGER, recv_time TEXT, value TEXT,
+                    PRIMARY KEY (series_id, recv_time)
+                ) WITHOUT ROWID;
+            """)
+        return self._db
+    
+    def _series_id(self, db: sqlite3.Connection, key: tuple) -> Optional[int]:
+        row = db.execute("SELECT id FROM series WHERE service=? AND servicepath=? AND entity_type=? "
+                         "AND entity_id=? AND attribute=?", key).fetchone()
+        return row[0] if row else None
+    
+    def missing(self, key: tuple, date_from: str, date_to: str) -> list:
+        """Sub-ranges of [date_from, date_to] not downloaded yet"""
+        with self._lock:
+            db = self._connect()
+            series_id = self._series_id(db, key)
+            covered = [] if series_id is None else db.execute(
+                "SELECT covered_from, covered_to FROM ranges WHERE series_id=? AND covered_to >= ? "
+                "AND covered_from <= ? ORDER BY covered_from", (series_id, date_from, date_to)).fetchall()
+        one_ms = timedelta(milliseconds=1)
+        gaps = []
+        cursor = date_from
+        for covered_from, covered_to in covered:
+            if covered_from > cursor:
+                gaps.append((cursor, format_date(parse_date(covered_from) - one_ms)))
+            cursor = max(cursor, format_date(parse_date(covered_to) + one_ms))
+        if cursor <= date_to:
+            gaps.append((cursor, date_to))
+        return gaps
+    
+    def save(self, key: tuple, values: list, covered_from: str, covered_to: str):
+        """Store values fetched for [covered_from, covered_to] and merge that range into the coverage"""
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute("INSERT OR IGNORE INTO series (service, servicepath, entity_type, entity_id, attribute) "
+                           "VALUES (?, ?, ?, ?, ?)", key)
+                series_id = self._series_id(db, key)
+                db.executemany("INSERT OR IGNORE INTO samples VALUES (?, ?, ?)",
+                               ((series_id, recv_time, json.dumps(value)) for recv_time, value in values))
+                
+                ranges = db.execute("SELECT covered_from, covered_to FROM ranges WHERE series_id=?",
+                                    (series_id,)).fetchall() + [(covered_from, covered_to)]
+                merged = []
+                for start, end in sorted(ranges):
+                    if merged and parse_date(start) - parse_date(merged[-1][1]) <= timedelta(milliseconds=1):
+                        merged[-1][1] = max(merged[-1][1], end)
+                    else:
+                        merged.append([start, end])
+                db.execute("DELETE FROM ranges WHERE series_id=?", (series_id,))
+                db.executemany("INSERT INTO ranges VALUES (?, ?, ?)", ((series_id, *r) for r in merged))
+                
+                row_count = db.execute("SELECT COUNT(*) FROM samples WHERE series_id=?", (series_id,)).fetchone()[0]
+                db.execute("UPDATE series SET row_count=?, last_access=? WHERE id=?",
+                           (row_count, time.time(), series_id))
+                self._evict(db, keep=series_id)
+    
+    def read(self, key: tuple, date_from: str, date_to: str, limit: int) -> Optional[list]:
+        """Stored values in [date_from, date_to], or None if the series is not stored"""
+        with self._lock:
+            db = self._connect()
+            series_id = self._series_id(db, key)
+            if series_id is None:
+                return None
+            with db:
+                db.execute("UPDATE series SET last_access=? WHERE id=?", (time.time(), series_id))
+            rows = db.execute("SELECT recv_time, value FROM samples WHERE series_id=? AND recv_time BETWEEN ? AND ? "
+                              "ORDER BY recv_time LIMIT ?", (series_id, date_from, date_to, limit)).fetchall()
+        return [[recv_time, json.loads(value)] for recv_time, value in rows]
+    
+    def _evict(self, db: sqlite3.Connection, keep: int):
+        total = db.execute("SELECT COALESCE(SUM(row_count), 0) FROM series").fetchone()[0]
+        for series_id, row_count in db.execute("SELECT id, row_count FROM series WHERE id != ? "
+                                               "ORDER BY last_access", (keep,)).fetchall():
+            if total <= self.max_rows:
+                break
+            for table in ("samples", "ranges"):
+                db.execute(f"DELETE FROM {table} WHERE series_id=?", (series_id,))
+            db.execute("DELETE FROM series WHERE id=?", (series_id,))
+            total -= row_count
+            self.evictions += 1
+    
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        with self._lock:
+            series, rows = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(row_count), 0) FROM series").fetchone()
+        return {
+            "enabled": True,
+            "path": self.path,
+            "series": series,
+            "rows": rows,
+            "max_rows": self.max_rows,
+            "evictions": self.evictions,
+        }
+
+
+history_store = HistoryStore(HISTORY_STORE_PATH, HISTORY_STORE_MAX_ROWS)
+
+
+async def fetch_stored_range(entity_type: str, entity_id: str, attribute: str,
+                             date_from: str, date_to: str, window: str, limit: int,
+                             limiter: HostRateLimiter = None,
+                             service: str = None, servicepath: str = None) -> tuple:
+    """
+    Raw values in [date_from, date_to] served from the history store, fetching
+    from STH-Comet only the ranges not stored yet.
+    
+    Windows are fetched in order and fetching stops once a missing range has
+    yielded limit values: only the windows actually fetched are marked covered.
+    
+    Returns ([recvTime, value] pairs up to limit, number of values fetched from STH).
+    """
+    tenant = get_tenant(service, servicepath)
+    key = (tenant.service, tenant.subservice, entity_type, entity_id, attribute)
+    start = format_date(parse_date(date_from))
+    # Never mark the future as covered: values may still arrive for it
+    now = format_date(datetime.now(timezone.utc))
+    end = min(format_date(parse_date(date_to)), now) if date_to else now
+    
+    fetched = 0
+    for gap_from, gap_to in await asyncio.to_thread(history_store.missing, key, start, end):
+        values = []
+        covered_to = gap_to
+        windows = iter(split_range(gap_from, gap_to, parse_duration(window)))
+        history = iter_history(entity_type, entity_id, attribute, gap_from, gap_to, window,
+                               limiter=limiter, service=service, servicepath=servicepath)
+        try:
+            async for page in history:
+                values.extend(page)
+                covered_to = next(windows)[1]
+                if len(values) >= limit:
+                    break
+        finally:
+            await history.aclose()
+        await asyncio.to_thread(history_store.save, key, values, gap_from, covered_to)
+        fetched += len(values)
+        if len(values) >= limit:
+            break  # The first limit values of the range are all stored now
+    
+    values = await asyncio.to_thread(history_store.read, key, start, end, limit)
+    if values is None:
+        raise RuntimeError("History series evicted while reading: raise HISTORY_STORE_MAX_ROWS")
+    return values, fetched
+
+
+async def _windowed_history(entity_type: str, entity_id: str, attribute: str,
+                            date_from: str, date_to: str, window: str, max_values: int,
+                            service: str = None, servicepath: str = None) -> dict:
+    """Fan out a date range over concurrent STH windows and merge into a compact series"""
+    if not date_from:
+        return {"error": "window requires date_from", "hint": "Pass date_from (and optionally date_to, default now)"}
+    date_to = date_to or format_date(datetime.now(timezone.utc))
+    
+    series = []
+    truncated = False
+    source = {}
+    if history_store.enabled:
+        series, fetched = await fetch_stored_range(entity_type, entity_id, attribute, date_from, date_to,
+                                                   window, max_values + 1, service=service, servicepath=servicepath)
+        truncated = len(series) > max_values
+        series = series[:max_values]
+        source = {"fetched_from_sth": fetched}
+    else:
+        windows = 0
+        history = iter_history(entity_type, entity_id, attribute, date_from, date_to, window,
+                               service=service, servicepath=servicepath)
+        try:
+            async for values in history:
+                windows += 1
+                if len(series) + len(values) > max_values:
+                    series.extend(values[:max_values - len(series)])
+                    truncated = True
+                    break
+                series.extend(values)
+        finally:
+            await history.aclose()
+        source = {"windows_fetched": windows}
+    
+    result = {
+        "success": True,
+        "entity_type": entity_type,
+        "entity_id": entity_id,
+        "attribute": attribute,
+        "date_from": date_from,
+        "date_to": date_to,
+        "window": window,
+        **source,
+        "values_count": len(series),
+        "series": {"columns": ["recvTime", "value"], "values": series},
+    }
+    if truncated:
+        next_date_from = format_date(parse_date(series[-1][0]) + timedelta(milliseconds=1))
+        result["truncated"] = True
+        result["next_date_from"] = next_date_from
+        result["hint"] = f"Capped at max_values. Call again with date_from={next_date_from} to continue."
+    if not series:
+        result["note"] = NO_HISTORY_NOTE
+    return result
+
+
 @mcp.tool()
-def sth_get_history(entity_type: str, entity_id: str, attribute: str,
-                    last_n: int = 20, date_from: str = None, date_to: str = None) -> str:
+async def sth_get_history(entity_type: str, entity_id: str, attribute: str,
+                          last_n: int = 20, date_from: str = None, date_to: str = None,
+                          window: str = None, max_values: int = 100000,
+                          stream: bool = False, max_bytes: int = 10_000_000,
+                          service: str = None, servicepath: str = None) -> str:
     """
     Get historical raw values for an entity attribute from STH-Comet.
     
@@ -261,15 +4254,37 @@ def sth_get_history(entity_type: str, entity_id: str, attribute: str,
         last_n: Number of last values to retrieve (default 20)
         date_from: Start date ISO format (e.g., "2026-01-01T00:00:00.000Z")
         date_to: End date ISO format (e.g., "2026-01-17T23:59:59.999Z")
+        window: Fetch ALL values in [date_from, date_to] by splitting it into windows
+                of this size (e.g., "6h", "1d") fetched in parallel. Ignores last_n.
+        max_values: Cap on values returned in window or stream mode (default 100000)
+        stream: Return NDJSON, one [recvTime, value] per line, parsed while STH-Comet responds.
+                With date_from, all values in the range are paged until max_values/max_bytes.
+        max_bytes: Byte budget of stream mode (default 10 MB)
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
     
     Returns:
-        Historical values with timestamps
+        Historical values with timestamps. In window mode, a compact series:
+        {"columns": ["recvTime", "value"], "values": [[t, v], ...]}
+        In stream mode, NDJSON ending with {"stream_end": ...} (next_date_from when truncated).
     
     Example:
         sth_get_history("AirQualityObserved", "sensor:001", "pm25", last_n=100)
+        sth_get_history("Room", "Room:001", "temperature", date_from="2026-01-01T00:00:00Z",
+                        date_to="2026-01-31T23:59:59Z", window="1d")
     """
     try:
-        url = f"{CB_PROTOCOL}://{STH_HOST}:{STH_PORT}/STH/v1/contextEntities/type/{entity_type}/id/{entity_id}/attributes/{attribute}"
+        if stream:
+            records = stream_history(entity_type, entity_id, attribute, last_n, date_from, date_to,
+                                     service, servicepath)
+            return await collect_ndjson(records, max_bytes, max_values)
+        
+        if window:
+            result = await _windowed_history(entity_type, entity_id, attribute, date_from, date_to,
+                                             window, max_values, service, servicepath)
+            return to_json(result)
+        
+        url = sth_url(entity_type, entity_id, attribute)
         
         params = []
         if date_from:
@@ -281,7 +4296,7 @@ def sth_get_history(entity_type: str, entity_id: str, attribute: str,
         if params:
             url += "?" + "&".join(params)
         
-        response = make_request("GET", url)
+        response = await make_request_async("GET", url, service=service, servicepath=servicepath)
         
         try:
             data = response.json() if response.text else None
@@ -310,19 +4325,177 @@ def sth_get_history(entity_type: str, entity_id: str, attribute: str,
             
             # Add helpful note when no data found
             if values_count == 0:
-                result["note"] = "No historical data found. This is normal if: (1) No data has been collected yet, (2) Subscriptions to STH-Comet are not configured, or (3) The time range has no data. Create subscriptions to start collecting historical data."
+                result["note"] = NO_HISTORY_NOTE
         else:
             result["error"] = data or response.reason
         
-        return json.dumps(result, indent=2)
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+async def fetch_series(entity_type: str, entity_id: str, attribute: str,
+                       last_n: int = 20, date_from: str = None, date_to: str = None,
+                       window: str = None, max_values: int = 100000,
+                       limiter: HostRateLimiter = None,
+                       service: str = None, servicepath: str = None) -> list:
+    """Raw history of one attribute as [recvTime, value] pairs (all of the range in window mode)"""
+    if window:
+        if not date_from:
+            raise ValueError("window requires date_from")
+        if history_store.enabled:
+            values, _ = await fetch_stored_range(entity_type, entity_id, attribute, date_from, date_to, window,
+                                                 max_values, limiter=limiter, service=service, servicepath=servicepath)
+            return values
+        series = []
+        history = iter_history(entity_type, entity_id, attribute, date_from,
+                               date_to or format_date(datetime.now(timezone.utc)), window,
+                               limiter=limiter, service=service, servicepath=servicepath)
+        try:
+            async for values in history:
+                series.extend(values)
+                if len(series) >= max_values:
+                    break
+        finally:
+            await history.aclose()
+        return series[:max_values]
+    
+    url = with_query(sth_url(entity_type, entity_id, attribute), lastN=last_n, dateFrom=date_from, dateTo=date_to)
+    if limiter:
+        await limiter.acquire(url)
+    response = await make_request_async("GET", url, service=service, servicepath=servicepath)
+    if not response.ok:
+        raise RuntimeError(f"STH-Comet returned {response.status_code}: {response.text[:200]}")
+    values = sth_values(response.json() if response.content else None)
+    return [[value["recvTime"], value["attrValue"]] for value in values]
+
+
+def align_series(labels: list, series: list, resolution: str = None) -> dict:
+    """
+    Join several [recvTime, value] series on a common time index.
+    
+    With a resolution (e.g. "15m") timestamps are floored to that bucket and the
+    last value in each bucket is kept; otherwise exact timestamps are joined.
+    Missing values are null.
+    """
+    bucket = parse_duration(resolution) if resolution else None
+    table = {}
+    for column, values in enumerate(series):
+        for recv_time, value in values:
+            if bucket:
+                epoch = parse_date(recv_time).timestamp()
+                recv_time = format_date(datetime.fromtimestamp(epoch - epoch % bucket, timezone.utc))
+            row = table.get(recv_time)
+            if row is None:
+                row = table[recv_time] = [None] * len(series)
+            row[column] = value
+    
+    return {
+        "columns": ["time"] + labels,
+        "rows": [[recv_time] + table[recv_time] for recv_time in sorted(table)],
+    }
+
+
+@mcp.tool()
+async def sth_get_history_batch(series: list = None, entity_type: str = None, id_pattern: str = None,
+                                q: str = None, attributes: list = None, max_entities: int = 500,
+                                last_n: int = 20, date_from: str = None, date_to: str = None,
+                                window: str = None, resolution: str = None,
+                                concurrency: int = 8, rate_limit: float = None,
+                                max_values: int = 100000,
+                                service: str = None, servicepath: str = None) -> str:
+    """
+    Get raw history for many entities/attributes at once, aligned on a common time index.
+    
+    Args:
+        series: List of {"entity_type", "entity_id", "attribute"} (or [type, id, attribute]) to fetch
+        entity_type: Instead of series, resolve entities of this type from the Context Broker
+        id_pattern: Optional idPattern regex for the Context Broker query
+        q: Optional NGSI-v2 q filter for the Context Broker query (e.g., "pm25>50")
+        attributes: Attribute names to fetch for each resolved entity (required with entity_type)
+        max_entities: Cap on entities resolved from the Context Broker (default 500)
+        last_n: Number of last values per series (default 20)
+        date_from: Start date ISO format
+        date_to: End date ISO format
+        window: Fetch all values in the range in parallel windows of this size (see sth_get_history)
+        resolution: Bucket size to align timestamps on (e.g., "15m", "1h"); exact timestamps if omitted
+        concurrency: Max series fetched at the same time (default 8)
+        rate_limit: Max STH-Comet requests per second per host (default unlimited)
+        max_values: Cap on values per series in window mode (default 100000)
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
+    
+    Returns:
+        Table with columns ["time", "<entity_id>/<attribute>", ...] and one row per timestamp,
+        plus the series that failed
+    
+    Examples:
+        sth_get_history_batch(entity_type="AirQualityObserved", attributes=["pm25", "no2"],
+                              date_from="2026-01-01T00:00:00Z", resolution="1h", last_n=200)
+        sth_get_history_batch(series=[["Room", "Room:001", "temperature"], ["Room", "Room:002", "temperature"]])
+    """
+    try:
+        if concurrency < 1:
+            return to_json({"error": "concurrency must be at least 1"})
+        targets = []
+        for item in series or []:
+            if isinstance(item, dict):
+                targets.append((item["entity_type"], item["entity_id"], item["attribute"]))
+            else:
+                targets.append(tuple(item))
+        
+        if entity_type:
+            if not attributes:
+                return to_json({"error": "attributes is required with entity_type", "hint": "e.g. attributes=['temperature']"})
+            entities = await resolve_entities(entity_type, id_pattern, q, max_entities, service, servicepath)
+            targets += [(entity["type"], entity["id"], attribute) for entity in entities for attribute in attributes]
+        
+        if not targets:
+            return to_json({"error": "No series to fetch", "hint": "Pass series or entity_type + attributes"})
+        
+        limiter = HostRateLimiter(rate_limit)
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def fetch(target):
+            async with semaphore:
+                return await fetch_series(*target, last_n=last_n, date_from=date_from, date_to=date_to,
+                                          window=window, max_values=max_values, limiter=limiter,
+                                          service=service, servicepath=servicepath)
+        
+        results = await asyncio.gather(*(fetch(target) for target in targets), return_exceptions=True)
+        
+        labels, fetched, failed = [], [], []
+        for (target_type, target_id, attribute), values in zip(targets, results):
+            label = f"{target_id}/{attribute}"
+            if isinstance(values, Exception):
+                failed.append({"series": label, "entity_type": target_type, "error": str(values)})
+            else:
+                labels.append(label)
+                fetched.append(values)
+        
+        table = align_series(labels, fetched, resolution)
+        result = {
+            "success": bool(fetched),
+            "series_requested": len(targets),
+            "series_fetched": len(fetched),
+            "values_count": sum(len(values) for values in fetched),
+            "resolution": resolution,
+            "table": table,
+        }
+        if failed:
+            result["failed"] = failed
+        if fetched and not result["values_count"]:
+            result["note"] = NO_HISTORY_NOTE
+        return to_json(result)
     except Exception as e:
         return json.dumps({"error": str(e)})
 
 
 @mcp.tool()
-def sth_get_aggregation(entity_type: str, entity_id: str, attribute: str,
-                        aggr_method: str, aggr_period: str,
-                        date_from: str = None, date_to: str = None) -> str:
+async def sth_get_aggregation(entity_type: str, entity_id: str, attribute: str,
+                              aggr_method: str, aggr_period: str,
+                              date_from: str = None, date_to: str = None,
+                              service: str = None, servicepath: str = None) -> str:
     """
     Get aggregated historical data from STH-Comet.
     
@@ -334,6 +4507,8 @@ def sth_get_aggregation(entity_type: str, entity_id: str, attribute: str,
         aggr_period: Aggregation period: "hour", "day", "month"
         date_from: Start date ISO format
         date_to: End date ISO format
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
     
     Returns:
         Aggregated values by period
@@ -342,7 +4517,7 @@ def sth_get_aggregation(entity_type: str, entity_id: str, attribute: str,
         sth_get_aggregation("WeatherObserved", "sensor:001", "temperature", "max", "hour")
     """
     try:
-        url = f"{CB_PROTOCOL}://{STH_HOST}:{STH_PORT}/STH/v1/contextEntities/type/{entity_type}/id/{entity_id}/attributes/{attribute}"
+        url = sth_url(entity_type, entity_id, attribute)
         
         params = [f"aggrMethod={aggr_method}", f"aggrPeriod={aggr_period}"]
         if date_from:
@@ -352,7 +4527,7 @@ def sth_get_aggregation(entity_type: str, entity_id: str, attribute: str,
         
         url += "?" + "&".join(params)
         
-        response = make_request("GET", url)
+        response = await make_request_async("GET", url, service=service, servicepath=servicepath)
         
         try:
             data = response.json() if response.text else None
@@ -375,13 +4550,199 @@ def sth_get_aggregation(entity_type: str, entity_id: str, attribute: str,
                 try:
                     values = data["contextResponses"][0]["contextElement"]["attributes"][0]["values"]
                     if len(values) == 0:
-                        result["note"] = "No aggregated data found. This is normal if: (1) No data has been collected yet, (2) Subscriptions to STH-Comet are not configured, or (3) The time range has no data. Create subscriptions to start collecting historical data."
+                        result["note"] = "No aggregated data found. This is normal if: (1) No data has been collected yet, (2) Subscriptions to STH-Comet are not configured, or (3) The time range has no data. Create them with cb_create_subscriptions(entity_types=[...], sink='sth') to start collecting historical data."
                 except:
                     pass
         else:
             result["error"] = data or response.reason
         
-        return json.dumps(result, indent=2)
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+# =============================================================================
+# LOCAL AGGREGATION - Vectorized analytics over raw STH history (NumPy)
+# =============================================================================
+
+_series_cache = OrderedDict()
+
+
+async def load_series_arrays(entity_type: str, entity_id: str, attribute: str,
+                             date_from: str, date_to: str = None, window: str = "1d",
+                             refresh: bool = False,
+                             service: str = None, servicepath: str = None):
+    """
+    Raw history as (epoch seconds, float values) NumPy arrays, sorted by time.
+    
+    Cached per series and range so follow-up questions skip the network;
+    open-ended ranges (no date_to) grow with time and are never cached.
+    Returns (timestamps, values, from_cache). Non-numeric values are dropped.
+    """
+    tenant = get_tenant(service, servicepath)
+    key = (tenant.service, tenant.subservice, entity_type, entity_id, attribute, date_from, date_to)
+    if not refresh and date_to and key in _series_cache:
+        _series_cache.move_to_end(key)
+        return (*_series_cache[key], True)
+    
+    series = await fetch_series(entity_type, entity_id, attribute, date_from=date_from, date_to=date_to,
+                                window=window, max_values=10_000_000, service=service, servicepath=servicepath)
+    timestamps = np.fromiter((parse_date(t).timestamp() for t, _ in series), dtype=np.float64, count=len(series))
+    values = np.fromiter((_to_float(v) for _, v in series), dtype=np.float64, count=len(series))
+    valid = ~np.isnan(values)
+    timestamps, values = timestamps[valid], values[valid]
+    order = np.argsort(timestamps, kind="stable")
+    timestamps, values = timestamps[order], values[order]
+    
+    if not date_to:
+        return timestamps, values, False
+    _series_cache[key] = (timestamps, values)
+    while len(_series_cache) > SERIES_CACHE_SIZE:
+        _series_cache.popitem(last=False)
+    return timestamps, values, False
+
+
+def _to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def aggregate_series(timestamps, values, period_seconds: float, methods: list,
+                     quantiles: list = None, fill: str = None, rolling: int = None) -> dict:
+    """
+    Bucket a sorted series into fixed periods and aggregate each bucket.
+    
+    count/sum/sum2 come from np.bincount; mean and std are derived from them the
+    way STH does (std = sqrt(sum2/n - mean^2)). min/max use reduceat over the
+    contiguous buckets. fill resamples onto a regular grid ("null", "ffill",
+    "linear") and rolling adds a moving mean over that many buckets.
+    """
+    if not period_seconds > 0:
+        raise ValueError("period must be positive")
+    bucket_ids = np.floor(timestamps / period_seconds).astype(np.int64)
+    buckets, starts, inverse = np.unique(bucket_ids, return_index=True, return_inverse=True)
+    
+    count = np.bincount(inverse).astype(np.float64)
+    total = np.bincount(inverse, weights=values)
+    total2 = np.bincount(inverse, weights=values * values)
+    mean = total / count
+    columns = {
+        "count": count,
+        "sum": total,
+        "sum2": total2,
+        "mean": mean,
+        "std": np.sqrt(np.maximum(total2 / count - mean * mean, 0)),
+        "min": np.minimum.reduceat(values, starts),
+        "max": np.maximum.reduceat(values, starts),
+    }
+    for q in quantiles or []:
+        # Buckets are contiguous in the sorted series
+        columns[f"p{q * 100:g}"] = np.array([np.quantile(chunk, q) for chunk in np.split(values, starts[1:])])
+    
+    unknown = [m for m in methods if m not in columns]
+    if unknown:
+        raise ValueError(f"Unknown methods: {unknown}. Use count, sum, sum2, mean, std, min, max.")
+    selected = list(methods) + [f"p{q * 100:g}" for q in quantiles or []]
+    rolling = rolling if rolling and rolling > 1 else None
+    
+    if fill:
+        grid = np.arange(buckets[0], buckets[-1] + 1)
+        positions = buckets - buckets[0]
+        # The rolling mean reads the mean column, so it must be on the grid too
+        for name in selected + (["mean"] if rolling and "mean" not in selected else []):
+            regular = np.full(len(grid), np.nan)
+            regular[positions] = columns[name]
+            if name == "count":
+                regular = np.nan_to_num(regular)
+            elif fill == "ffill":
+                last_seen = np.maximum.accumulate(np.where(np.isnan(regular), 0, np.arange(len(grid))))
+                regular = regular[last_seen]
+            elif fill == "linear":
+                regular = np.interp(grid, buckets, columns[name])
+            elif fill != "null":
+                raise ValueError(f"Invalid fill: {fill}. Must be 'null', 'ffill' or 'linear'.")
+            columns[name] = regular
+        buckets = grid
+    
+    if rolling:
+        means = np.nan_to_num(columns["mean"])
+        present = (~np.isnan(columns["mean"])).astype(np.float64)
+        kernel = np.ones(rolling)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            columns[f"rolling_mean_{rolling}"] = np.convolve(means, kernel)[:len(means)] / np.convolve(present, kernel)[:len(means)]
+        selected.append(f"rolling_mean_{rolling}")
+    
+    times = [format_date(datetime.fromtimestamp(b * period_seconds, timezone.utc)) for b in buckets.tolist()]
+    data = np.column_stack([columns[name] for name in selected]).round(6)
+    rows = [[t] + [None if np.isnan(v) else v for v in row] for t, row in zip(times, data.tolist())]
+    if "count" in selected:
+        position = selected.index("count") + 1
+        for row in rows:
+            row[position] = int(row[position])
+    return {"columns": ["time"] + selected, "rows": rows}
+
+
+@mcp.tool()
+async def sth_local_aggregate(entity_type: str, entity_id: str, attribute: str,
+                              date_from: str, date_to: str = None, period: str = "1h",
+                              methods: list = None, quantiles: list = None,
+                              fill: str = None, rolling: int = None, refresh: bool = False,
+                              service: str = None, servicepath: str = None) -> str:
+    """
+    Aggregate raw STH-Comet history locally, for periods and statistics STH does not offer.
+    
+    Raw values are downloaded once (in parallel daily windows) and cached, so
+    follow-up questions on the same series and range run without network calls.
+    Ranges without date_to are reloaded on every call, since they keep growing.
+    
+    Args:
+        entity_type: Entity type (e.g., "AirQualityObserved")
+        entity_id: Entity ID
+        attribute: Attribute name (numeric values only)
+        date_from: Start date ISO format
+        date_to: End date ISO format (default now)
+        period: Bucket size, any duration (e.g., "15m", "1h", "1d", "1w")
+        methods: Statistics per bucket: count, sum, sum2, mean, std, min, max (default mean, min, max, count)
+        quantiles: Quantiles per bucket, e.g. [0.5, 0.95] -> p50, p95 columns
+        fill: Resample onto a regular grid: "null" (gaps as null), "ffill" or "linear"
+        rolling: Add a moving mean over this many buckets
+        refresh: Reload the raw series instead of using the cached copy
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
+    
+    Returns:
+        Table with columns ["time", <methods>...] and one row per bucket
+    
+    Example:
+        sth_local_aggregate("Room", "Room:001", "temperature", "2026-01-01T00:00:00Z",
+                            period="15m", methods=["mean", "std"], quantiles=[0.95])
+    """
+    if np is None:
+        return to_json({"error": "NumPy is required for local aggregation", "hint": "pip install numpy"})
+    try:
+        period_seconds = parse_duration(period)
+        timestamps, values, cached = await load_series_arrays(entity_type, entity_id, attribute, date_from, date_to,
+                                                              refresh=refresh, service=service, servicepath=servicepath)
+        result = {
+            "success": True,
+            "entity_type": entity_type,
+            "entity_id": entity_id,
+            "attribute": attribute,
+            "period": period,
+            "values_count": int(len(values)),
+            "from_cache": cached,
+        }
+        if not len(values):
+            result["note"] = NO_HISTORY_NOTE
+            return to_json(result)
+        
+        table = aggregate_series(timestamps, values, period_seconds, methods or ["mean", "min", "max", "count"],
+                                 quantiles, fill, rolling)
+        result["buckets"] = len(table["rows"])
+        result["table"] = table
+        return to_json(result)
     except Exception as e:
         return json.dumps({"error": str(e)})
 
@@ -391,16 +4752,20 @@ def sth_get_aggregation(entity_type: str, entity_id: str, attribute: str,
 # =============================================================================
 
 @mcp.tool()
-def cep_list_rules() -> str:
+async def cep_list_rules(service: str = None, servicepath: str = None) -> str:
     """
     List all CEP rules in Perseo.
     
+    Args:
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
+    
     Returns:
         List of configured rules with their definitions
     """
     try:
         url = f"{CB_PROTOCOL}://{CEP_HOST}:{CEP_PORT}/rules"
-        response = make_request("GET", url)
+        response = await make_request_async("GET", url, service=service, servicepath=servicepath)
         
         try:
             data = response.json() if response.text else None
@@ -419,13 +4784,14 @@ def cep_list_rules() -> str:
         else:
             result["error"] = data or response.reason
         
-        return json.dumps(result, indent=2)
+        return to_json(result)
     except Exception as e:
         return json.dumps({"error": str(e)})
 
 
 @mcp.tool()
-def cep_create_rule(name: str, epl_text: str, action_type: str, action_params: dict) -> str:
+async def cep_create_rule(name: str, epl_text: str, action_type: str, action_params: dict,
+                          service: str = None, servicepath: str = None) -> str:
     """
     Create a new CEP rule in Perseo.
     
@@ -434,6 +4800,8 @@ def cep_create_rule(name: str, epl_text: str, action_type: str, action_params: d
         epl_text: EPL (Event Processing Language) query
         action_type: Action type: "email", "update", "post", "sms"
         action_params: Action parameters (depends on action_type)
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
     
     Action parameters by type:
         email: {"to": "email@example.com", "from": "noreply@...", "subject": "..."}
@@ -465,7 +4833,7 @@ def cep_create_rule(name: str, epl_text: str, action_type: str, action_params: d
         if "template" in action_params:
             body["action"]["template"] = action_params.pop("template")
         
-        response = make_request("POST", url, body)
+        response = await make_request_async("POST", url, body, service=service, servicepath=servicepath)
         
         try:
             data = response.json() if response.text else None
@@ -486,32 +4854,34 @@ def cep_create_rule(name: str, epl_text: str, action_type: str, action_params: d
             if "rule exists" in error_str or "already exists" in error_str:
                 result["hint"] = f"Rule '{name}' already exists. This may indicate a shared Perseo CEP backend. Use cep_list_rules() to see all rules, or cep_delete_rule('{name}') to remove it first."
         
-        return json.dumps(result, indent=2)
+        return to_json(result)
     except Exception as e:
         return json.dumps({"error": str(e)})
 
 
 @mcp.tool()
-def cep_delete_rule(rule_name: str) -> str:
+async def cep_delete_rule(rule_name: str, service: str = None, servicepath: str = None) -> str:
     """
     Delete a CEP rule from Perseo.
     
     Args:
         rule_name: Name of the rule to delete
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
     
     Returns:
         Deletion confirmation
     """
     try:
         url = f"{CB_PROTOCOL}://{CEP_HOST}:{CEP_PORT}/rules/{rule_name}"
-        response = make_request("DELETE", url)
+        response = await make_request_async("DELETE", url, service=service, servicepath=servicepath)
         
-        return json.dumps({
+        return to_json({
             "success": response.ok,
             "status_code": response.status_code,
             "deleted_rule": rule_name if response.ok else None,
             "error": response.text if not response.ok else None
-        }, indent=2)
+        })
     except Exception as e:
         return json.dumps({"error": str(e)})
 
@@ -520,44 +4890,153 @@ def cep_delete_rule(rule_name: str) -> str:
 # IOT AGENTS - Device Management
 # =============================================================================
 
+IOTA_GROUP_FIELDS = {
+    "devices": ("entity_type", "protocol", "transport"),
+    "services": ("entity_type", "resource", "protocol"),
+}
+
+
+def _iota_attribute_names(item: dict, object_ids: bool = True) -> set:
+    """Attribute names of a device or service group, plus their object_ids unless disabled"""
+    fields = ("name", "object_id") if object_ids else ("name",)
+    names = set()
+    for key in ("attributes", "lazy", "static_attributes", "commands"):
+        for attr in item.get(key) or []:
+            if isinstance(attr, dict):
+                names.update(filter(None, (attr.get(field) for field in fields)))
+    return names
+
+
+async def _list_iota(kind: str, limit: int, offset: int, entity_type: str, protocol: str,
+                     attribute: str, summary: bool, service: str = None, servicepath: str = None) -> dict:
+    """
+    Page through /iot/devices or /iot/services, filtering each page as it arrives.
+    
+    Without filters only the requested page is fetched. With filters, pages are
+    prefetched concurrently until `limit` matches are found. In summary mode all
+    pages are scanned and only grouped counts are kept.
+    """
+    if limit < 1:
+        return {"success": False, "error": f"Invalid limit: {limit}. Must be at least 1."}
+    url = with_query(f"{CB_PROTOCOL}://{IOTA_HOST}:{IOTA_PORT}/iot/{kind}", offset=offset, protocol=protocol)
+    filtered = bool(entity_type or protocol or attribute)
+    scan_all = summary or filtered
+    
+    matched = []
+    groups = {field: Counter() for field in IOTA_GROUP_FIELDS[kind]}
+    attributes = Counter()
+    matched_count = 0
+    scanned = 0
+    total = None
+    pages = 0
+    result = {"success": True, "status_code": 200}
+    
+    page_iter = iter_pages(url, items_key=kind, total_key="count",
+                           max_items=None if scan_all else limit,
+                           page_size=PAGINATION_PAGE_SIZE if scan_all else min(limit, PAGINATION_PAGE_SIZE),
+                           service=service, servicepath=servicepath)
+    try:
+        async for response, items, page_total in page_iter:
+            if not response.ok:
+                try:
+                    error = response.json() if response.text else None
+                except ValueError:
+                    error = response.text
+                result = {"success": False, "status_code": response.status_code, "error": error or response.reason}
+                if pages == 0:
+                    return result
+                # Keep what was scanned so far
+                break
+            
+            pages += 1
+            total = page_total
+            for item in items:
+                scanned += 1
+                if ((entity_type and item.get("entity_type") != entity_type)
+                        or (protocol and item.get("protocol") != protocol)
+                        or (attribute and attribute not in _iota_attribute_names(item))):
+                    continue
+                matched_count += 1
+                if summary:
+                    for field, counter in groups.items():
+                        counter[item.get(field)] += 1
+                    attributes.update(_iota_attribute_names(item, object_ids=False))
+                else:
+                    matched.append(item)
+                    if len(matched) >= limit:
+                        break
+            if not summary and len(matched) >= limit:
+                break
+    finally:
+        await page_iter.aclose()
+    
+    result["total_count"] = total
+    result["scanned"] = scanned
+    if summary:
+        result[f"{kind}_count"] = matched_count
+        for field, counter in groups.items():
+            result[f"by_{field}"] = {str(key): count for key, count in counter.most_common()}
+        result["attributes"] = dict(attributes.most_common(50))
+    else:
+        result[f"{kind}_count"] = len(matched)
+        result[kind] = matched
+    
+    if not summary and total is not None and offset + scanned < total:
+        result["truncated"] = True
+        result["next_offset"] = offset + scanned
+        result["hint"] = f"More {kind} available. Call again with offset={offset + scanned} to continue."
+    return result
+
+
 @mcp.tool()
-def iota_list_devices() -> str:
+async def iota_list_devices(limit: int = 100, offset: int = 0, entity_type: str = None,
+                            protocol: str = None, attribute: str = None, summary: bool = False,
+                            stream: bool = False, max_bytes: int = 10_000_000,
+                            service: str = None, servicepath: str = None) -> str:
     """
-    List all registered IoT devices.
+    List registered IoT devices, one page at a time.
+    
+    Args:
+        limit: Max devices returned (default 100)
+        offset: Number of devices to skip (use next_offset from a previous call)
+        entity_type: Only devices mapped to this entity type
+        protocol: Only devices using this protocol (e.g., "IoTA-UL", "IoTA-JSON")
+        attribute: Only devices with this attribute name or object_id
+        summary: Return only counts grouped by entity_type, protocol, transport and attribute
+        stream: Return NDJSON, one device per line, parsed while the IoT Agent responds, up to
+                limit devices or max_bytes (attribute filter not supported)
+        max_bytes: Byte budget of stream mode (default 10 MB)
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
     
     Returns:
-        List of devices with their configurations
+        Devices with their configurations, total_count and next_offset when more are available,
+        or grouped counts in summary mode. In stream mode, NDJSON ending with {"stream_end": ...}.
+    
+    Examples:
+        iota_list_devices(entity_type="Room", limit=50)
+        iota_list_devices(summary=True)
     """
     try:
-        url = f"{CB_PROTOCOL}://{IOTA_HOST}:{IOTA_PORT}/iot/devices"
-        response = make_request("GET", url)
-        
-        try:
-            data = response.json() if response.text else None
-        except:
-            data = response.text
-        
-        result = {
-            "success": response.ok,
-            "status_code": response.status_code,
-        }
-        
-        if response.ok:
-            result["data"] = data
-            if isinstance(data, dict) and "devices" in data:
-                result["devices_count"] = len(data.get("devices", []))
-        else:
-            result["error"] = data or response.reason
+        if stream:
+            if attribute or summary:
+                return to_json({"error": "stream can't be combined with attribute or summary",
+                                "hint": "Filter by entity_type or protocol, or call without stream"})
+            records = stream_devices(offset, entity_type, protocol, service=service, servicepath=servicepath)
+            return await collect_ndjson(records, max_bytes, limit)
         
-        return json.dumps(result, indent=2)
+        result = await _list_iota("devices", limit, offset, entity_type, protocol, attribute, summary,
+                                  service, servicepath)
+        return to_json(result)
     except Exception as e:
         return json.dumps({"error": str(e)})
 
 
 @mcp.tool()
-def iota_register_device(device_id: str, entity_name: str, entity_type: str,
-                         attributes: list, protocol: str = "IoTA-UL",
-                         transport: str = "HTTP") -> str:
+async def iota_register_device(device_id: str, entity_name: str, entity_type: str,
+                               attributes: list, protocol: str = "IoTA-UL",
+                               transport: str = "HTTP",
+                               service: str = None, servicepath: str = None) -> str:
     """
     Register a new IoT device.
     
@@ -568,6 +5047,8 @@ def iota_register_device(device_id: str, entity_name: str, entity_type: str,
         attributes: List of attribute mappings [{"object_id": "t", "name": "temperature", "type": "float"}]
         protocol: "IoTA-UL" (UltraLight) or "IoTA-JSON"
         transport: "HTTP" or "MQTT"
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
     
     Returns:
         Registration confirmation
@@ -597,14 +5078,14 @@ def iota_register_device(device_id: str, entity_name: str, entity_type: str,
         
         body = {"devices": [device]}
         
-        response = make_request("POST", url, body)
+        response = await make_request_async("POST", url, body, service=service, servicepath=servicepath)
         
         try:
             data = response.json() if response.text else None
         except:
             data = response.text
         
-        return json.dumps({
+        result = {
             "success": response.ok,
             "status_code": response.status_code,
             "device_id": device_id,
@@ -618,67 +5099,220 @@ def iota_register_device(device_id: str, entity_name: str, entity_type: str,
             if "already exists" in error_str:
                 result["hint"] = f"Device '{device_id}' already exists. This may indicate a shared IoT Agent backend. Use iota_list_devices() to see all devices, or iota_delete_device('{device_id}') to remove it first."
         
-        return json.dumps(result, indent=2)
+        return to_json(result)
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+def import_path(file_path: str) -> Path:
+    """Resolve a tool's file_path inside IMPORT_DIR, refusing anything outside it"""
+    directory = Path(IMPORT_DIR).expanduser().resolve()
+    path = (directory / file_path).resolve()
+    if not path.is_relative_to(directory):
+        raise ValueError(f"file_path must be inside IMPORT_DIR ({directory})")
+    return path
+
+
+def load_devices(file_path: str) -> list:
+    """
+    Read device definitions from a JSON file (list or {"devices": [...]}) or a CSV file.
+    
+    CSV columns map to device fields; cells starting with [ or { are parsed as JSON,
+    and "attributes" also accepts "object_id:name:type" entries separated by ";".
+    """
+    path = import_path(file_path)
+    if path.suffix.lower() == ".json":
+        data = json.loads(path.read_text(encoding="utf-8"))
+        return data["devices"] if isinstance(data, dict) else data
+    
+    devices = []
+    with path.open(newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            device = {}
+            for column, cell in row.items():
+                cell = (cell or "").strip()
+                if not column or not cell:
+                    continue
+                if cell[0] in "[{":
+                    device[column] = json.loads(cell)
+                elif column == "attributes":
+                    device[column] = [dict(zip(("object_id", "name", "type"), entry.split(":")))
+                                      for entry in cell.split(";") if entry]
+                else:
+                    device[column] = cell
+            devices.append(device)
+    return devices
+
+
+@mcp.tool()
+async def iota_register_devices(devices: list = None, file_path: str = None,
+                                protocol: str = "IoTA-UL", transport: str = "HTTP",
+                                chunk_size: int = 100, max_chunk_bytes: int = 500_000,
+                                concurrency: int = 4,
+                                service: str = None, servicepath: str = None) -> str:
+    """
+    Register many IoT devices in chunked, concurrent requests.
+    
+    Args:
+        devices: List of device objects as in iota_register_device (device_id, entity_name, entity_type, attributes...)
+        file_path: Instead of devices, a .json file (list or {"devices": [...]}) or a .csv file with one device
+                   per row, relative to IMPORT_DIR
+        protocol: Default protocol for devices that don't set one ("IoTA-UL" or "IoTA-JSON")
+        transport: Default transport for devices that don't set one ("HTTP" or "MQTT")
+        chunk_size: Max devices per request (default 100)
+        max_chunk_bytes: Max request body size in bytes (default 500000)
+        concurrency: Max requests in flight (default 4)
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
+    
+    Returns:
+        Counts plus the device_ids registered, already existing, and failed (with their errors).
+        Devices of a chunk rejected with a 4xx are retried one by one, so one bad device doesn't fail
+        the rest. Devices of a chunk that timed out or got a 5xx may have been created: they are
+        listed under "unknown" instead.
+    
+    Example:
+        iota_register_devices(file_path="sensors.csv", chunk_size=200)
+        
+        with sensors.csv:
+            device_id,entity_name,entity_type,attributes
+            sensor001,Room:001,Room,t:temperature:Number;h:humidity:Number
+    """
+    try:
+        if file_path:
+            devices = load_devices(file_path)
+        if not devices:
+            return to_json({"error": "No devices to register", "hint": "Pass devices or file_path"})
+        
+        url = f"{CB_PROTOCOL}://{IOTA_HOST}:{IOTA_PORT}/iot/devices"
+        registered, existing, failed, unknown = [], [], [], []
+        valid, seen = [], set()
+        for row, device in enumerate(devices, 1):
+            device_id = device.get("device_id")
+            if not device_id:
+                failed.append({"device_id": None, "row": row, "error": "device_id is missing"})
+            elif device_id in seen:
+                failed.append({"device_id": device_id, "error": "Duplicate device_id in input"})
+            else:
+                seen.add(device_id)
+                valid.append({"protocol": protocol, "transport": transport, **device})
+        
+        async def post(chunk):
+            try:
+                return chunk, await make_request_async("POST", url, {"devices": chunk},
+                                                       service=service, servicepath=servicepath)
+            except Exception as e:
+                return chunk, e
+        
+        def record(device, response):
+            if isinstance(response, Exception):
+                # A request that reached the agent before failing may still have created the device
+                (failed if _not_sent(response) else unknown).append({"device_id": device["device_id"],
+                                                                     "error": str(response)})
+            elif response.ok:
+                registered.append(device["device_id"])
+            elif response.status_code == 409 or "already exists" in response.text.lower():
+                existing.append(device["device_id"])
+            else:
+                (unknown if response.status_code >= 500 else failed).append({
+                    "device_id": device["device_id"], "status_code": response.status_code,
+                    "error": response.text[:500] or response.reason})
+        
+        start = time.perf_counter()
+        chunks = chunked(valid, chunk_size, max_chunk_bytes)
+        retry = []
+        async for chunk, response in iter_ordered(post, chunks, concurrency):
+            if (len(chunk) > 1 and not isinstance(response, Exception)
+                    and 400 <= response.status_code < 500 and response.status_code != 429):
+                # The IoT Agent rejects the whole array for one bad device: find it device by device
+                retry.extend(chunk)
+            else:
+                for device in chunk:
+                    record(device, response)
+        
+        async for chunk, response in iter_ordered(post, ([device] for device in retry), concurrency):
+            record(chunk[0], response)
+        elapsed = time.perf_counter() - start
+        
+        result = {
+            "success": not failed and not unknown,
+            "devices_requested": len(devices),
+            "registered_count": len(registered),
+            "existing_count": len(existing),
+            "failed_count": len(failed),
+            "unknown_count": len(unknown),
+            "requests": len(chunks) + len(retry),
+            "elapsed_seconds": round(elapsed, 3),
+            "devices_per_second": round(len(registered) / elapsed, 1) if elapsed else None,
+            "registered": registered,
+        }
+        if existing:
+            result["existing"] = existing
+            result["hint"] = "Existing devices were left unchanged. Use iota_delete_device() first to re-register them."
+        if failed:
+            result["failed"] = failed
+        if unknown:
+            result["unknown"] = unknown
+            result["unknown_hint"] = ("These devices may have been registered before the request failed. "
+                                      "Check them with iota_list_devices() before registering them again.")
+        return to_json(result)
     except Exception as e:
         return json.dumps({"error": str(e)})
 
 
 @mcp.tool()
-def iota_delete_device(device_id: str, protocol: str = "IoTA-UL") -> str:
+async def iota_delete_device(device_id: str, protocol: str = "IoTA-UL",
+                             service: str = None, servicepath: str = None) -> str:
     """
     Delete/deregister an IoT device.
     
     Args:
         device_id: Device identifier to delete
         protocol: Protocol type ("IoTA-UL" or "IoTA-JSON")
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
     
     Returns:
         Deletion confirmation
     """
     try:
         url = f"{CB_PROTOCOL}://{IOTA_HOST}:{IOTA_PORT}/iot/devices/{device_id}?protocol={protocol}"
-        response = make_request("DELETE", url)
+        response = await make_request_async("DELETE", url, service=service, servicepath=servicepath)
         
-        return json.dumps({
+        return to_json({
             "success": response.ok,
             "status_code": response.status_code,
             "deleted_device": device_id if response.ok else None,
             "error": response.text if not response.ok else None
-        }, indent=2)
+        })
     except Exception as e:
         return json.dumps({"error": str(e)})
 
 
 @mcp.tool()
-def iota_list_services() -> str:
+async def iota_list_services(limit: int = 100, offset: int = 0, entity_type: str = None,
+                             protocol: str = None, attribute: str = None, summary: bool = False,
+                             service: str = None, servicepath: str = None) -> str:
     """
-    List all provisioned IoT Agent service configurations.
+    List provisioned IoT Agent service configurations, one page at a time.
+    
+    Args:
+        limit: Max service groups returned (default 100)
+        offset: Number of service groups to skip (use next_offset from a previous call)
+        entity_type: Only groups for this entity type
+        protocol: Only groups for this protocol
+        attribute: Only groups with this attribute name or object_id
+        summary: Return only counts grouped by entity_type, resource, protocol and attribute
+        service: Fiware-Service (tenant) for this call, defaults to SERVICE from .env
+        servicepath: Fiware-ServicePath for this call, defaults to SUBSERVICE from .env
     
     Returns:
-        List of service groups with their API keys and configurations
+        Service groups with their API keys and configurations, or grouped counts in summary mode
     """
     try:
-        url = f"{CB_PROTOCOL}://{IOTA_HOST}:{IOTA_PORT}/iot/services"
-        response = make_request("GET", url)
-        
-        try:
-            data = response.json() if response.text else None
-        except:
-            data = response.text
-        
-        result = {
-            "success": response.ok,
-            "status_code": response.status_code,
-        }
-        
-        if response.ok:
-            result["data"] = data
-            if isinstance(data, dict) and "services" in data:
-                result["services_count"] = len(data.get("services", []))
-        else:
-            result["error"] = data or response.reason
-        
-        return json.dumps(result, indent=2)
+        result = await _list_iota("services", limit, offset, entity_type, protocol, attribute, summary,
+                                  service, servicepath)
+        return to_json(result)
     except Exception as e:
         return json.dumps({"error": str(e)})
 
@@ -687,6 +5321,247 @@ def iota_list_services() -> str:
 # SMART DATA MODELS
 # =============================================================================
 
+SMART_DATA_MODELS = {
+    "Environment": ["AirQualityObserved", "NoiseLevelObserved", "WaterQualityObserved"],
+    "Weather": ["WeatherObserved", "WeatherForecast", "WeatherAlert"],
+    "Alert": ["Alert", "Anomaly"],
+    "Building": ["Building", "BuildingOperation"],
+    "Transportation": ["TrafficFlowObserved", "Road", "Vehicle"],
+    "UrbanMobility": ["GtfsStop", "GtfsRoute", "PublicTransportStop"],
+    "WasteManagement": ["WasteContainer", "WasteContainerIsle"],
+    "Streetlighting": ["Streetlight", "StreetlightGroup", "StreetlightControlCabinet"],
+    "Energy": ["Device", "ThreePhaseAcMeasurement"],
+    "ParksAndGardens": ["Garden", "GreenspaceRecord"],
+    "PointOfInterest": ["PointOfInterest", "Beach", "Museum"],
+    "Parking": ["ParkingSpot", "ParkingGroup", "OffStreetParking"],
+    "Device": ["Device", "DeviceModel"],
+    "AgriFood": ["AgriCrop", "AgriParcel", "AgriGreenhouse"],
+    "WaterNetwork": ["WaterQualityObserved", "WaterConsumptionObserved"]
+}
+
+
+SDM_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]+")  # domain and model names, used as cache path components
+
+
+class SmartDataModelCache:
+    """
+    On-disk copy of Smart Data Models files plus an LRU of processed models.
+    
+    Files are stored under directory/dataModel.<domain>/<model>/ with a .meta
+    sidecar holding ETag, Last-Modified and the last check time. Within
+    revalidate_after seconds the disk copy is used as is; after that a
+    conditional GET refreshes it, and the stale copy is served if GitHub is
+    unreachable. In offline mode only the disk copy is used.
+    """
+    
+    def __init__(self, directory: str, revalidate_after: int, memory_size: int, offline: bool = False):
+        self.directory = Path(directory)
+        self.revalidate_after = revalidate_after
+        self.memory_size = memory_size
+        self.offline = offline
+        self._processed = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def url(domain: str, model: str, filename: str) -> str:
+        return f"{SDM_BASE_URL}/dataModel.{domain}/master/{model}/{filename}"
+    
+    def fetch(self, domain: str, model: str, filename: str, timeout: float, force: bool = False):
+        """Parsed JSON file, or None if it doesn't exist upstream"""
+        for name in (domain, model):
+            if not SDM_NAME_PATTERN.fullmatch(name or ""):
+                raise ValueError(f"Invalid domain or model name: {name!r}")
+        path = self.directory / f"dataModel.{domain}" / model / filename
+        meta_path = path.with_name(path.name + ".meta")
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            meta = None
+        
+        def cached():
+            return json.loads(path.read_text(encoding="utf-8")) if meta["status"] == 200 else None
+        
+        if self.offline:
+            if meta is None:
+                raise LookupError(f"{domain}/{model}/{filename} is not in {self.directory} (SDM_OFFLINE). "
+                                  f"Pre-download models with: python server.py --warm-models")
+            return cached()
+        if meta and not force and time.time() - meta["checked_at"] < self.revalidate_after:
+            return cached()
+        
+        url = self.url(domain, model, filename)
+        headers = {}
+        if meta and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            response = get_session(url).get(url, headers=headers, timeout=(HTTP_CONNECT_TIMEOUT, timeout))
+        except requests.RequestException:
+            if meta:
+                return cached()  # GitHub unreachable: the stale copy is better than nothing
+            raise
+        
+        if response.status_code == 304 and meta:
+            data = cached()
+        elif response.status_code == 404:
+            data = None
+        else:
+            response.raise_for_status()
+            data = response.json()
+            self._write(path, response.content)
+        self._write(meta_path, json.dumps({
+            "url": url,
+            "status": 200 if data is not None else 404,
+            "etag": response.headers.get("ETag") or (meta or {}).get("etag"),
+            "last_modified": response.headers.get("Last-Modified") or (meta or {}).get("last_modified"),
+            "checked_at": time.time(),
+        }).encode())
+        return data
+    
+    @staticmethod
+    def _write(path: Path, content: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(content)
+        tmp.replace(path)
+    
+    def get_processed(self, key: tuple) -> Optional[dict]:
+        with self._lock:
+            entry = self._processed.get(key)
+            if entry is None or (not self.offline and time.time() - entry[1] >= self.revalidate_after):
+                return None
+            self._processed.move_to_end(key)
+            return entry[0]
+    
+    def put_processed(self, key: tuple, result: dict):
+        if self.memory_size <= 0:
+            return
+        with self._lock:
+            self._processed[key] = (result, time.time())
+            self._processed.move_to_end(key)
+            while len(self._processed) > self.memory_size:
+                self._processed.popitem(last=False)
+
+
+sdm_cache = SmartDataModelCache(SDM_CACHE_DIR, SDM_REVALIDATE_AFTER, SDM_MEMORY_CACHE_SIZE, SDM_OFFLINE)
+
+
+def describe_smart_data_model(domain: str, model: str, schema: dict, example) -> dict:
+    """Property list with NGSI-v2 types and a conversion example for a Smart Data Model schema"""
+    # Get property details (Smart Data Models use allOf structure)
+    properties = {}
+    if "allOf" in schema and len(schema["allOf"]) > 1:
+        properties = schema["allOf"][1].get("properties", {})
+    else:
+        properties = schema.get("properties", {})
+    
+    # Build comprehensive property list with NGSI-v2 type mapping
+    property_list = []
+    type_mapping = {
+        "string": "Text",
+        "number": "Number",
+        "integer": "Number",
+        "boolean": "Boolean",
+        "array": "StructuredValue",
+        "object": "StructuredValue"
+    }
+    
+    for prop_name, prop_def in properties.items():
+        prop_type = prop_def.get("type", "unknown")
+        ngsi_type = type_mapping.get(prop_type, "Text")
+        
+        # Special handling for geo properties
+        if "geo" in prop_name.lower() or prop_name in ["location", "address"]:
+            ngsi_type = "geo:json" if prop_type == "object" else "Text"
+        
+        property_list.append({
+            "name": prop_name,
+            "schema_type": prop_type,
+            "ngsi_v2_type": ngsi_type,
+            "description": prop_def.get("description", "")[:100]
+        })
+    
+    # Generate NGSI-v2 conversion example
+    required_fields = schema.get("required", [])
+    conversion_example = {
+        "id": f"urn:ngsi-ld:{model}:001",
+        "type": model
+    }
+    
+    # Add a few example attributes
+    for prop in property_list[:3]:
+        if prop["name"] not in ["id", "type"]:
+            conversion_example[prop["name"]] = {
+                "type": prop["ngsi_v2_type"],
+                "value": "<your_value_here>"
+            }
+    
+    return {
+        "success": True,
+        "domain": domain,
+        "model": model,
+        "schema": {
+            "title": schema.get("title", ""),
+            "description": schema.get("description", ""),
+            "required": required_fields,
+            "total_properties": len(property_list),
+            "properties": property_list
+        },
+        "ngsi_v2_conversion": {
+            "note": "Convert each property to NGSI-v2 attribute format",
+            "example": conversion_example,
+            "required_fields": required_fields
+        },
+        "official_example": example,
+        "links": {
+            "schema": SmartDataModelCache.url(domain, model, "schema.json"),
+            "github": f"https://github.com/smart-data-models/dataModel.{domain}/tree/master/{model}",
+            "spec": f"https://github.com/smart-data-models/dataModel.{domain}/blob/master/{model}/doc/spec.md"
+        }
+    }
+
+
+async def load_smart_data_model(domain: str, model: str, force: bool = False) -> Optional[dict]:
+    """Processed model from memory, disk or GitHub; None if the model doesn't exist"""
+    result = None if force else sdm_cache.get_processed((domain, model))
+    if result is not None:
+        return result
+    
+    schema = await asyncio.to_thread(sdm_cache.fetch, domain, model, "schema.json", 30, force)
+    if schema is None:
+        return None
+    try:
+        example = await asyncio.to_thread(sdm_cache.fetch, domain, model, "examples/example.json", 5, force)
+    except Exception:
+        example = None  # The example is optional
+    
+    result = describe_smart_data_model(domain, model, schema, example)
+    sdm_cache.put_processed((domain, model), result)
+    return result
+
+
+async def warm_smart_data_models(concurrency: int = 8) -> dict:
+    """Download (or revalidate) every model in SMART_DATA_MODELS into the disk cache"""
+    models = [(domain, model) for domain, names in SMART_DATA_MODELS.items() for model in names]
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def warm(target):
+        async with semaphore:
+            try:
+                return "cached" if await load_smart_data_model(*target, force=True) else "not found"
+            except Exception as e:
+                return f"error: {e}"
+    
+    outcomes = await asyncio.gather(*(warm(target) for target in models))
+    return {
+        "directory": str(sdm_cache.directory),
+        "models": {f"{domain}/{model}": outcome for (domain, model), outcome in zip(models, outcomes)},
+        "cached": outcomes.count("cached"),
+        "failed": len(outcomes) - outcomes.count("cached"),
+    }
+
+
 @mcp.tool()
 def list_smart_data_model_domains() -> str:
     """
@@ -697,36 +5572,18 @@ def list_smart_data_model_domains() -> str:
     
     Use this to discover what domains and models are available before calling get_smart_data_model()
     """
-    domains = {
-        "Environment": ["AirQualityObserved", "NoiseLevelObserved", "WaterQualityObserved"],
-        "Weather": ["WeatherObserved", "WeatherForecast", "WeatherAlert"],
-        "Alert": ["Alert", "Anomaly"],
-        "Building": ["Building", "BuildingOperation"],
-        "Transportation": ["TrafficFlowObserved", "Road", "Vehicle"],
-        "UrbanMobility": ["GtfsStop", "GtfsRoute", "PublicTransportStop"],
-        "WasteManagement": ["WasteContainer", "WasteContainerIsle"],
-        "Streetlighting": ["Streetlight", "StreetlightGroup", "StreetlightControlCabinet"],
-        "Energy": ["Device", "ThreePhaseAcMeasurement"],
-        "ParksAndGardens": ["Garden", "GreenspaceRecord"],
-        "PointOfInterest": ["PointOfInterest", "Beach", "Museum"],
-        "Parking": ["ParkingSpot", "ParkingGroup", "OffStreetParking"],
-        "Device": ["Device", "DeviceModel"],
-        "AgriFood": ["AgriCrop", "AgriParcel", "AgriGreenhouse"],
-        "WaterNetwork": ["WaterQualityObserved", "WaterConsumptionObserved"]
-    }
-    
-    return json.dumps({
+    return to_json({
         "success": True,
-        "total_domains": len(domains),
-        "domains": domains,
+        "total_domains": len(SMART_DATA_MODELS),
+        "domains": SMART_DATA_MODELS,
         "usage": "Use get_smart_data_model(domain, model) to get full schema",
         "example": "get_smart_data_model('Environment', 'AirQualityObserved')",
         "browse_all": "https://github.com/smart-data-models"
-    }, indent=2)
+    })
 
 
 @mcp.tool()
-def get_smart_data_model(domain: str, model: str) -> str:
+async def get_smart_data_model(domain: str, model: str) -> str:
     """
     Get FIWARE Smart Data Model schema with NGSI-v2 conversion examples.
     
@@ -744,101 +5601,17 @@ def get_smart_data_model(domain: str, model: str) -> str:
     Tip: Use list_smart_data_model_domains() first to see available options
     """
     try:
-        # Fetch schema from GitHub
-        schema_url = f"https://raw.githubusercontent.com/smart-data-models/dataModel.{domain}/master/{model}/schema.json"
-        response = requests.get(schema_url, timeout=30)
-        
-        if response.status_code == 404:
-            return json.dumps({
+        result = await load_smart_data_model(domain, model)
+        if result is None:
+            return to_json({
                 "error": "Model not found",
                 "hint": f"Domain '{domain}' or model '{model}' doesn't exist",
                 "suggestion": "Use list_smart_data_model_domains() to see available options",
                 "browse": "https://github.com/smart-data-models"
-            }, indent=2)
-        
-        response.raise_for_status()
-        schema = response.json()
-        
-        # Try to get example
-        example_url = f"https://raw.githubusercontent.com/smart-data-models/dataModel.{domain}/master/{model}/examples/example.json"
-        example_response = requests.get(example_url, timeout=5)
-        example = example_response.json() if example_response.ok else None
-        
-        # Get property details (Smart Data Models use allOf structure)
-        properties = {}
-        if "allOf" in schema and len(schema["allOf"]) > 1:
-            properties = schema["allOf"][1].get("properties", {})
-        else:
-            properties = schema.get("properties", {})
-        
-        # Build comprehensive property list with NGSI-v2 type mapping
-        property_list = []
-        type_mapping = {
-            "string": "Text",
-            "number": "Number",
-            "integer": "Number",
-            "boolean": "Boolean",
-            "array": "StructuredValue",
-            "object": "StructuredValue"
-        }
-        
-        for prop_name, prop_def in properties.items():
-            prop_type = prop_def.get("type", "unknown")
-            ngsi_type = type_mapping.get(prop_type, "Text")
-            
-            # Special handling for geo properties
-            if "geo" in prop_name.lower() or prop_name in ["location", "address"]:
-                ngsi_type = "geo:json" if prop_type == "object" else "Text"
-            
-            property_list.append({
-                "name": prop_name,
-                "schema_type": prop_type,
-                "ngsi_v2_type": ngsi_type,
-                "description": prop_def.get("description", "")[:100]
             })
-        
-        # Generate NGSI-v2 conversion example
-        required_fields = schema.get("required", [])
-        conversion_example = {
-            "id": f"urn:ngsi-ld:{model}:001",
-            "type": model
-        }
-        
-        # Add a few example attributes
-        for prop in property_list[:3]:
-            if prop["name"] not in ["id", "type"]:
-                conversion_example[prop["name"]] = {
-                    "type": prop["ngsi_v2_type"],
-                    "value": "<your_value_here>"
-                }
-        
-        result = {
-            "success": True,
-            "domain": domain,
-            "model": model,
-            "schema": {
-                "title": schema.get("title", ""),
-                "description": schema.get("description", ""),
-                "required": required_fields,
-                "total_properties": len(property_list),
-                "properties": property_list
-            },
-            "ngsi_v2_conversion": {
-                "note": "Convert each property to NGSI-v2 attribute format",
-                "example": conversion_example,
-                "required_fields": required_fields
-            },
-            "official_example": example,
-            "links": {
-                "schema": schema_url,
-                "github": f"https://github.com/smart-data-models/dataModel.{domain}/tree/master/{model}",
-                "spec": f"https://github.com/smart-data-models/dataModel.{domain}/blob/master/{model}/doc/spec.md"
-            }
-        }
-        
-        return json.dumps(result, indent=2)
+        return to_json(result)
     except Exception as e:
-        return json.dumps({"error": str(e), "hint": "Check domain and model names"}, indent=2)
+        return to_json({"error": str(e), "hint": "Check domain and model names"})
 
 
 if __name__ == "__main__":
@@ -846,8 +5619,18 @@ if __name__ == "__main__":
     parser.add_argument("--http", action="store_true", help="Run as HTTP server")
     parser.add_argument("--host", default="127.0.0.1")
     parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--warm-models", action="store_true",
+                        help="Download all Smart Data Models from list_smart_data_model_domains into the cache and exit")
+    parser.add_argument("--models-dir", help="Cache directory for --warm-models (default SDM_CACHE_DIR), e.g. to vendor models")
     args = parser.parse_args()
     
+    if args.warm_models:
+        if args.models_dir:
+            sdm_cache.directory = Path(args.models_dir)
+        summary = asyncio.run(warm_smart_data_models())
+        print(json.dumps(summary, indent=2))
+        sys.exit(1 if not summary["cached"] else 0)
+    
     if args.http:
         mcp.run(transport="http", host=args.host, port=args.port)
     else:
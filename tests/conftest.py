@@ -0,0 +1,53 @@
+"""
+Shared fixtures: one mock FIWARE stack (benchmarks/mock_fiware.py) for the
+whole session, answering for Orion, STH-Comet and the IoT Agent.
+
+server.py reads its configuration at import time, so the environment is
+set here before the first test module imports it.
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / "benchmarks")]
+
+from mock_fiware import make_devices, make_entities, start_mock_server  # noqa: E402
+
+ENTITY_COUNT = 100
+DEVICE_COUNT = 100
+
+_httpd = start_mock_server(entity_count=ENTITY_COUNT, device_count=DEVICE_COUNT)
+_tmp = tempfile.mkdtemp(prefix="fiware-mcp-tests-")
+_port = str(_httpd.server_address[1])
+os.environ.update({
+    "AUTH_TYPE": "none",
+    "CB_HOST": "127.0.0.1",
+    "CB_PORT": _port,
+    "CB_PROTOCOL": "http",
+    "STH_PORT": _port,
+    "IOTA_PORT": _port,
+    "HISTORY_STORE_PATH": os.path.join(_tmp, "sth_history.sqlite"),
+    "IMPORT_DIR": os.path.join(_tmp, "imports"),
+    "HTTP_READ_TIMEOUT": "1",
+    "HTTP_RETRY_BASE": "0.01",
+    "BATCH_RETRY_BASE": "0.01",
+    "BREAKER_FAILURE_THRESHOLD": "1000",
+})
+
+
+@pytest.fixture
+def mock():
+    """The mock's handler class, reset to its initial entities and devices with no faults queued"""
+    handler = _httpd.RequestHandlerClass
+    with handler.lock:
+        handler.entities[:] = make_entities(ENTITY_COUNT)
+        handler.devices.clear()
+        handler.devices.update(make_devices(DEVICE_COUNT))
+        handler.faults.clear()
+    yield handler
+    handler.faults.clear()
@@ -0,0 +1,67 @@
+"""cb_batch_upsert retries and bisection against the mock's /v2/op/update"""
+
+import asyncio
+import json
+
+import server
+
+
+def upsert(**kwargs) -> dict:
+    return json.loads(asyncio.run(server.cb_batch_upsert.fn(**kwargs)))
+
+
+def new_entities(count: int, prefix: str = "New") -> list:
+    return [{"id": f"{prefix}:{i:03d}", "type": "Room", "temperature": 20 + i} for i in range(count)]
+
+
+def stored_ids(mock) -> set:
+    with mock.lock:
+        return {entity["id"] for entity in mock.entities}
+
+
+def test_append_is_retried_after_5xx(mock):
+    mock.faults["/v2/op/update"] = [{"status": 503}]
+    result = upsert(entities=new_entities(5), key_values=True)
+    assert result["success"]
+    assert (result["entities_written"], result["entities_failed"], result["retries"]) == (5, 0, 1)
+    assert {f"New:{i:03d}" for i in range(5)} <= stored_ids(mock)
+
+
+def test_append_strict_applied_then_5xx_is_unknown(mock):
+    mock.faults["/v2/op/update"] = [{"status": 503, "applied": True}]
+    result = upsert(entities=new_entities(3), action_type="appendStrict", key_values=True)
+    assert not result["success"]
+    assert (result["entities_written"], result["entities_failed"], result["retries"]) == (0, 0, 0)
+    assert result["entities_unknown"] == 3
+    assert all(entry["outcome"] == "unknown" for entry in result["unknown"])
+    assert {f"New:{i:03d}" for i in range(3)} <= stored_ids(mock)
+
+
+def test_append_strict_fails_only_existing_ids(mock):
+    entities = new_entities(6) + [{"id": "Room:00001", "type": "Room"}, {"id": "Room:00002", "type": "Room"}]
+    result = upsert(entities=entities, action_type="appendStrict", key_values=True)
+    assert (result["entities_written"], result["entities_failed"], result["requests"]) == (6, 2, 1)
+    assert sorted(error["id"] for error in result["errors"]) == ["Room:00001", "Room:00002"]
+
+
+def test_bad_request_is_bisected_down_to_the_offending_entity(mock):
+    entities = new_entities(8)
+    entities[5]["id"] = "Bad(id)"
+    result = upsert(entities=entities, key_values=True)
+    assert (result["entities_written"], result["entities_failed"]) == (7, 1)
+    assert [error["id"] for error in result["errors"]] == ["Bad(id)"]
+    assert result["errors"][0]["status_code"] == 400
+    assert len(stored_ids(mock) & {entity["id"] for entity in entities}) == 7
+
+
+def test_update_isolates_missing_entities(mock):
+    entities = [{"id": f"Room:{i:05d}", "type": "Room", "temperature": 1} for i in range(6)]
+    entities[1]["id"], entities[4]["id"] = "Missing:1", "Missing:4"
+    result = upsert(entities=entities, action_type="update", key_values=True, batch_size=3)
+    assert (result["entities_written"], result["entities_failed"]) == (4, 2)
+    assert sorted(error["id"] for error in result["errors"]) == ["Missing:1", "Missing:4"]
+
+
+def test_batches_are_split_by_size(mock):
+    result = upsert(entities=new_entities(25), key_values=True, batch_size=10, concurrency=2)
+    assert (result["entities_written"], result["batches"], result["requests"]) == (25, 3, 3)
@@ -0,0 +1,106 @@
+"""aggregate_series against a plain-Python reference, and the STH history store against the mock"""
+
+import asyncio
+import math
+import statistics
+
+import numpy as np
+import pytest
+
+import server
+
+HOUR = 3600
+# Hours 3-4 and 7-8 have no samples, so fill has gaps to resample
+SAMPLES = [(hour * HOUR + minute * 60, float((hour * 7 + minute) % 11))
+           for hour in (0, 1, 2, 5, 6, 9) for minute in range(0, 60, 15 + hour)]
+METHODS = {
+    "count": len,
+    "sum": sum,
+    "mean": statistics.fmean,
+    "std": statistics.pstdev,
+    "min": min,
+    "max": max,
+}
+
+
+def reference(method: str, fill: str = None) -> dict:
+    """Bucket start (seconds) -> expected value, with gaps resampled like fill"""
+    buckets = {}
+    for timestamp, value in SAMPLES:
+        buckets.setdefault(timestamp // HOUR * HOUR, []).append(value)
+    result = {start: METHODS[method](values) for start, values in sorted(buckets.items())}
+    if not fill:
+        return result
+    known = sorted(result)
+    for start in range(known[0], known[-1] + 1, HOUR):
+        if start in result:
+            continue
+        before = max(k for k in known if k < start)
+        after = min(k for k in known if k > start)
+        if method == "count":
+            result[start] = 0
+        elif fill == "null":
+            result[start] = None
+        elif fill == "ffill":
+            result[start] = result[before]
+        else:
+            result[start] = result[before] + (result[after] - result[before]) * (start - before) / (after - before)
+    return dict(sorted(result.items()))
+
+
+def rolling_reference(means: list, window: int) -> list:
+    rolled = []
+    for i in range(len(means)):
+        present = [m for m in means[max(0, i - window + 1):i + 1] if m is not None]
+        rolled.append(statistics.fmean(present) if present else None)
+    return rolled
+
+
+def close(actual, expected) -> bool:
+    if expected is None:
+        return actual is None
+    return actual is not None and math.isclose(actual, expected, rel_tol=1e-5, abs_tol=1e-5)
+
+
+@pytest.mark.parametrize("methods", [["mean"], ["max"], ["count", "min"], ["sum", "std"]])
+@pytest.mark.parametrize("fill", [None, "null", "ffill", "linear"])
+@pytest.mark.parametrize("rolling", [None, 1, 3])
+def test_aggregate_fill_and_rolling(methods, fill, rolling):
+    timestamps = np.array([t for t, _ in SAMPLES], dtype=np.float64)
+    values = np.array([v for _, v in SAMPLES])
+    result = server.aggregate_series(timestamps, values, HOUR, methods=methods, fill=fill, rolling=rolling)
+
+    expected_columns = ["time"] + methods + ([f"rolling_mean_{rolling}"] if rolling and rolling > 1 else [])
+    assert result["columns"] == expected_columns
+    starts = list(reference("count", fill))
+    assert [row[0] for row in result["rows"]] == [server.format_date(server.datetime.fromtimestamp(
+        start, server.timezone.utc)) for start in starts]
+    for position, method in enumerate(methods, start=1):
+        expected = list(reference(method, fill).values())
+        assert all(close(row[position], value) for row, value in zip(result["rows"], expected)), method
+    if rolling and rolling > 1:
+        expected = rolling_reference(list(reference("mean", fill).values()), rolling)
+        assert all(close(row[-1], value) for row, value in zip(result["rows"], expected))
+
+
+def test_aggregate_rejects_bad_arguments():
+    timestamps, values = np.array([0.0, 60.0]), np.array([1.0, 2.0])
+    with pytest.raises(ValueError):
+        server.aggregate_series(timestamps, values, 0, methods=["mean"])
+    with pytest.raises(ValueError):
+        server.aggregate_series(timestamps, values, HOUR, methods=["median"])
+    with pytest.raises(ValueError):
+        server.aggregate_series(timestamps, values, 60, methods=["mean"], fill="spline")
+
+
+def test_history_store_fetches_only_missing_ranges(mock):
+    async def fetch(date_from, date_to):
+        return await server.fetch_stored_range("Room", "Room:00000", "temperature", date_from, date_to,
+                                               "1h", 10000)
+
+    values, fetched = asyncio.run(fetch("2026-01-01T00:00:00.000Z", "2026-01-01T03:00:00.000Z"))
+    assert (len(values), fetched) == (181, 181)
+    values, fetched = asyncio.run(fetch("2026-01-01T01:00:00.000Z", "2026-01-01T04:00:00.000Z"))
+    assert (len(values), fetched) == (181, 60)
+    assert values[0][0] == "2026-01-01T01:00:00.000Z" and values[-1][0] == "2026-01-01T04:00:00.000Z"
+    assert [t for t, _ in values] == sorted({t for t, _ in values})
@@ -0,0 +1,54 @@
+"""IoT Agent bulk registration and listing against the mock's /iot/devices"""
+
+import asyncio
+import json
+
+import server
+
+
+def register(**kwargs) -> dict:
+    return json.loads(asyncio.run(server.iota_register_devices.fn(**kwargs)))
+
+
+def new_devices(count: int) -> list:
+    return [{"device_id": f"new{i:03d}", "entity_name": f"Room:new{i:03d}", "entity_type": "Room"}
+            for i in range(count)]
+
+
+def test_rejected_chunk_is_retried_device_by_device(mock):
+    devices = new_devices(4) + [{"device_id": "sensor00001", "entity_name": "Room:00001", "entity_type": "Room"}]
+    result = register(devices=devices, chunk_size=5)
+    assert result["registered"] == [f"new{i:03d}" for i in range(4)]
+    assert result["existing"] == ["sensor00001"]
+    assert (result["failed_count"], result["unknown_count"], result["requests"]) == (0, 0, 6)
+
+
+def test_chunk_applied_then_5xx_is_unknown(mock):
+    mock.faults["/iot/devices"] = [{"status": 503, "applied": True}]
+    result = register(devices=new_devices(6), chunk_size=3, concurrency=1)
+    assert not result["success"]
+    assert [device["device_id"] for device in result["unknown"]] == ["new000", "new001", "new002"]
+    assert result["registered"] == ["new003", "new004", "new005"]
+    assert (result["existing_count"], result["failed_count"], result["requests"]) == (0, 0, 2)
+    assert {f"new{i:03d}" for i in range(6)} <= set(mock.devices)
+
+
+def test_timed_out_chunk_is_unknown(mock):
+    # Longer than HTTP_READ_TIMEOUT; not applied, so the late request leaves no device behind
+    mock.faults["/iot/devices"] = [{"status": 201, "delay": 1.5}]
+    result = register(devices=new_devices(3), chunk_size=3)
+    assert [device["device_id"] for device in result["unknown"]] == ["new000", "new001", "new002"]
+    assert (result["registered_count"], result["failed_count"], result["requests"]) == (0, 0, 1)
+
+
+def test_list_devices_pages_and_filters(mock):
+    result = json.loads(asyncio.run(server.iota_list_devices.fn(limit=30, offset=10, protocol="IoTA-UL")))
+    assert result["devices_count"] == 30
+    assert all(device["protocol"] == "IoTA-UL" for device in result["devices"])
+    assert [device["device_id"] for device in result["devices"]][:2] == ["sensor00021", "sensor00023"]
+
+
+def test_list_devices_rejects_limit_below_one(mock):
+    for limit in (0, -5):
+        result = json.loads(asyncio.run(server.iota_list_devices.fn(limit=limit)))
+        assert result["success"] is False and "limit" in result["error"]
@@ -0,0 +1,199 @@
+"""EntityMirror indexes and the SpatialIndex, checked against full scans of the same entities"""
+
+import asyncio
+import json
+import random
+
+import numpy as np
+import pytest
+
+import server
+
+TEXTS = ["a", "b", "lab", "Lab", "office", "3", ""]
+INDEXED = ["temp", "name", "flag", "tags", "floor", "meta.level"]
+
+
+def random_value(rng: random.Random, attr: str):
+    if rng.random() < 0.15:
+        return None  # Attribute missing
+    if attr == "temp":
+        return rng.choice([rng.randint(-5, 40), round(rng.uniform(-5, 40), 1)])
+    if attr == "name":
+        return rng.choice(TEXTS)
+    if attr == "flag":
+        return rng.choice([True, False, 0, 1])
+    if attr == "tags":
+        return rng.sample(TEXTS + [1, 2], rng.randint(0, 3))
+    if attr == "floor":
+        return rng.choice([rng.randint(0, 5), str(rng.randint(0, 5))])
+    return {"level": rng.choice([rng.randint(0, 3), "high", None])}
+
+
+def random_entity(rng: random.Random, i: int, modified: int = 0) -> dict:
+    entity = {"id": f"Thing:{i:04d}", "type": rng.choice(["Room", "Lamp"]),
+              "dateModified": f"2026-01-01T00:00:{modified:02d}.000Z"}
+    for attr in ("temp", "name", "flag", "tags", "floor", "meta"):
+        value = random_value(rng, attr)
+        if value is not None:
+            entity[attr] = value
+    return entity
+
+
+def random_literal(rng: random.Random) -> str:
+    return rng.choice([str(rng.randint(-5, 40)), f"{rng.uniform(-5, 40):.1f}", "true", "false",
+                       *(f"'{text}'" for text in TEXTS), "lab", "3"])
+
+
+def random_q(rng: random.Random) -> str:
+    conditions = []
+    for _ in range(rng.randint(1, 3)):
+        attr = rng.choice(INDEXED + ["other"])
+        kind = rng.random()
+        if kind < 0.3:
+            conditions.append(f"{attr}{rng.choice(['==', '!='])}{random_literal(rng)}")
+        elif kind < 0.45:
+            conditions.append(f"{attr}=={random_literal(rng)},{random_literal(rng)}")
+        elif kind < 0.6:
+            low = rng.randint(-5, 30)
+            conditions.append(rng.choice([f"{attr}=={low}..{low + rng.randint(0, 15)}", f"{attr}=='a'..'m'"]))
+        elif kind < 0.9:
+            conditions.append(f"{attr}{rng.choice(['>', '>=', '<', '<='])}{random_literal(rng)}")
+        else:
+            conditions.append(rng.choice([attr, f"!{attr}", f"{attr}~=^[lL]"]))
+    return ";".join(conditions)
+
+
+def full_scan(entities: dict, entity_type: str, q: str) -> set:
+    conditions = server.parse_q(q)
+    return {key for key, entity in entities.items()
+            if (entity_type is None or key[0] == entity_type)
+            and all(server.matches_condition(entity, *condition) for condition in conditions)}
+
+
+def ids(found: list) -> set:
+    return {(entity["type"], entity["id"]) for entity in found}
+
+
+def test_index_lookups_match_a_full_scan():
+    rng = random.Random(3)
+    mirror = server.EntityMirror("test", "/")
+    mirror.add_index("temp")  # Before the load: indexed as entities arrive
+    for i in range(400):
+        mirror.upsert(random_entity(rng, i))
+    for attr in INDEXED[1:]:
+        mirror.add_index(attr)  # After the load: built from the stored entities
+
+    for step in range(300):
+        if step % 3 == 0:
+            # Keep the indexes moving: updates, stale writes that must be ignored, deletions
+            i = rng.randrange(450)
+            if rng.random() < 0.2:
+                mirror.remove(("Room", f"Thing:{i:04d}"))
+                mirror.remove(("Lamp", f"Thing:{i:04d}"))
+            else:
+                mirror.upsert(random_entity(rng, i, modified=rng.randint(0, 59)))
+        q = random_q(rng)
+        entity_type = rng.choice([None, "Room", "Lamp"])
+        found, indexed, _ = mirror.query(entity_type, q=q)
+        assert ids(found) == full_scan(mirror.entities, entity_type, q), q
+        assert len(found) == len(ids(found))
+        lookups = [attr for attr, op, _ in server.parse_q(q) if op in ("==", ">", ">=", "<", "<=")]
+        if all(attr in INDEXED for attr in lookups):
+            assert indexed == len(lookups), q
+
+
+def random_location(rng: random.Random, i: int):
+    lon, lat = rng.uniform(-3.75, -3.65), rng.uniform(40.38, 40.45)
+    kind = i % 10
+    if kind < 6:
+        return {"type": "Point", "coordinates": [lon, lat]}
+    if kind < 7:
+        return f"{lat}, {lon}"  # geo:point
+    if kind < 8:
+        return {"type": "LineString", "coordinates": [[lon, lat], [lon + rng.uniform(-0.02, 0.02), lat + 0.01]]}
+    if kind < 9:
+        size = rng.choice([0.002, 0.01, 2.0])  # 2 degrees is past max_shape_cells
+        return {"type": "Polygon", "coordinates": [[[lon, lat], [lon + size, lat], [lon + size, lat + size],
+                                                    [lon, lat + size], [lon, lat]]]}
+    return None
+
+
+def brute_distance(lon: float, lat: float, shape: dict) -> float:
+    vertices = shape["vertices"]
+    return float(server.haversine_m(lon, lat, vertices[:, 0], vertices[:, 1]).min())
+
+
+def test_spatial_queries_match_a_full_scan():
+    rng = random.Random(4)
+    mirror = server.EntityMirror("test", "/")
+    mirror.set_geo_attribute("Room", "location")
+    locations = {}
+    for i in range(600):
+        location = random_location(rng, i)
+        entity = {"id": f"R{i}", "type": "Room", **({"location": location} if location else {})}
+        mirror.upsert(entity)
+        if location:
+            locations[("Room", f"R{i}")] = location
+    for i in range(0, 600, 7):  # Moved and unlocated entities must leave their old cells
+        key = ("Room", f"R{i}")
+        location = random_location(rng, rng.randrange(10))
+        mirror.upsert({"id": key[1], "type": "Room", **({"location": location} if location else {})})
+        if location:
+            locations[key] = location
+        else:
+            locations.pop(key, None)
+    shapes = {key: server.parse_geometry(location) for key, location in locations.items()}
+
+    for _ in range(20):
+        lon, lat = rng.uniform(-3.76, -3.64), rng.uniform(40.37, 40.46)
+        point = server.query_geometry("point", f"{lat},{lon}")
+        max_distance = rng.choice([50, 500, 3000])
+        found, _, distances = mirror.query("Room", georel=f"near;maxDistance:{max_distance}", shape=point)
+        brute = {key: brute_distance(lon, lat, shape) for key, shape in shapes.items()}
+        expected = {key for key, distance in brute.items() if distance <= max_distance}
+        assert ids(found) == expected
+        for key in expected:
+            assert distances[key] == pytest.approx(brute[key])
+
+        found, _, distances = mirror.query("Room", georel="near", shape=point, want=10)
+        assert set(sorted(brute, key=brute.get)[:10]) <= ids(found)
+
+        lat2, lon2 = lat + rng.uniform(0.005, 0.05), lon + rng.uniform(0.005, 0.05)
+        box = server.query_geometry("box", f"{lat},{lon};{lat2},{lon2}")
+        covered = {key for key, shape in shapes.items()
+                   if server.points_in_polygon(shape["vertices"], box["polygons"][0]).all()}
+        # Points (the boundary included) by their coordinates, lines and polygons by the exact geometry test
+        intersecting = {key for key, shape in shapes.items()
+                        if (lon <= shape["vertices"][0][0] <= lon2 and lat <= shape["vertices"][0][1] <= lat2
+                            if shape["is_point"] else server.shapes_intersect(box, shape))}
+        for georel, expected in (("coveredBy", covered), ("intersects", intersecting),
+                                 ("disjoint", set(shapes) - intersecting)):
+            found, _, _ = mirror.query("Room", georel=georel, shape=box)
+            assert ids(found) == expected, georel
+
+
+def test_mirror_of_mock_entities(mock):
+    rng = random.Random(5)
+    lamps = [{"id": f"Lamp:{i:03d}", "type": "Lamp", "power": rng.randint(0, 100),
+              "status": rng.choice(["on", "off", "broken"]),
+              "location": {"type": "Point", "coordinates": [rng.uniform(-3.75, -3.65), rng.uniform(40.38, 40.45)]}}
+             for i in range(250)]
+    written = json.loads(asyncio.run(server.cb_batch_upsert.fn(entities=lamps, key_values=True, batch_size=100)))
+    assert written["entities_written"] == 250
+    service = "mirror-tests"
+    started = json.loads(asyncio.run(server.cb_mirror_start.fn("Lamp", index_attributes=["power", "status"],
+                                                                 service=service)))
+    try:
+        assert (started["entities"], started["located_entities"]) == (250, 250)
+        for q in ("power>50", "power==10..20;status==on", "status==on,broken", "power<=30;status!=off"):
+            result = json.loads(asyncio.run(server.cb_mirror_query.fn("Lamp", q=q, count_only=True, service=service)))
+            conditions = server.parse_q(q)
+            assert result["count"] == sum(all(server.matches_condition(lamp, *c) for c in conditions) for lamp in lamps)
+        result = json.loads(asyncio.run(server.cb_mirror_query.fn(
+            "Lamp", georel="near;maxDistance:1000", geometry="point", coords="40.41,-3.70", count_only=True,
+            service=service)))
+        distances = server.haversine_m(-3.70, 40.41, np.array([lamp["location"]["coordinates"][0] for lamp in lamps]),
+                                       np.array([lamp["location"]["coordinates"][1] for lamp in lamps]))
+        assert result["count"] == int((distances <= 1000).sum())
+    finally:
+        asyncio.run(server.cb_mirror_stop.fn("Lamp", service=service))
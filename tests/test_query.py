@@ -0,0 +1,20 @@
+"""The NGSI-v2 simple query language as parsed for the mirror"""
+
+import server
+
+
+def test_parse_q_operators():
+    assert server.parse_q("temperature>20;status==on,off;pressure==700..710;!broken;name~=^Ro") == [
+        ("temperature", ">", 20),
+        ("status", "==", ("in", ["on", "off"])),
+        ("pressure", "==", ("range", 700, 710)),
+        ("broken", "absent", None),
+        ("name", "~=", server.re.compile("^Ro")),
+    ]
+
+
+def test_parse_q_keeps_separators_inside_quotes():
+    assert server.parse_q("name=='a,b'") == [("name", "==", ("in", ["a,b"]))]
+    assert server.parse_q("name=='a,b',c,'d'") == [("name", "==", ("in", ["a,b", "c", "d"]))]
+    assert server.parse_q("name!='x;y';level==1") == [("name", "!=", ("in", ["x;y"])), ("level", "==", ("in", [1]))]
+    assert server.parse_q("name=='a..b'") == [("name", "==", ("in", ["a..b"]))]
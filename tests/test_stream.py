@@ -0,0 +1,107 @@
+"""Incremental JSON array parsing and streaming Context Broker lists against the mock"""
+
+import asyncio
+import json
+import random
+
+import pytest
+import requests
+
+import server
+
+ITEMS = [
+    {"id": "Room:1", "type": "Room", "name": {"value": "say \\\"hi\\\" [0] {x}, y: z"}},
+    "caf\u00e9 \u2603 \U0001f600 done",
+    'quote " and backslash \\',
+    12, -3.5, 1e-7, 6.02E23, 0, True, False, None,
+    [], {}, [[1, [2, [3]]], {"a": []}],
+    {"nested": {"values": [1, 2, 3], "text": "]]}}", "empty": ""}},
+]
+DOCUMENTS = [
+    ([], ITEMS),
+    (["devices"], {"count": 2, "skip": {"devices": ["decoy"]}, "devices": ITEMS, "after": [1, 2]}),
+    (["contextResponses", 0, "contextElement", "attributes", 0, "values"],
+     {"contextResponses": [{"contextElement": {"attributes": [{"name": "t", "values": ITEMS}], "id": "x"},
+                            "statusCode": {"code": "200"}}]}),
+]
+
+
+def at(document, path):
+    for key in path:
+        document = document[key]
+    return document
+
+
+def parse(data: bytes, path: list, cuts: list) -> list:
+    parser = server.JsonArrayStream(path)
+    items = []
+    for start, end in zip([0] + cuts, cuts + [len(data)]):
+        items.extend(parser.feed(data[start:end]))
+    parser.close()
+    return items
+
+
+def random_cuts(rng: random.Random, size: int) -> list:
+    return sorted(rng.sample(range(1, size), min(size - 1, rng.randint(1, 40))))
+
+
+def streamed_ids(endpoint: str, page_size: int) -> list:
+    async def collect():
+        return [entity["id"] async for entity, _ in server.stream_entities(endpoint, page_size=page_size)]
+    return asyncio.run(collect())
+
+
+def test_stream_entities_reads_every_page(mock):
+    assert streamed_ids("/v2/entities?type=Room", 7) == [f"Room:{i:05d}" for i in range(100)]
+
+
+def test_stream_entities_honours_the_endpoint_limit(mock):
+    assert streamed_ids("/v2/entities?type=Room&limit=15", 4) == [f"Room:{i:05d}" for i in range(15)]
+    assert streamed_ids("/v2/entities?type=Room&offset=90&limit=20", 4) == [f"Room:{i:05d}" for i in range(90, 100)]
+    assert streamed_ids("/v2/entities?type=Room&limit=3", 1000) == ["Room:00000", "Room:00001", "Room:00002"]
+
+
+@pytest.mark.parametrize("path, document", DOCUMENTS)
+@pytest.mark.parametrize("indent", [None, 2])
+def test_json_array_stream_at_every_chunk_boundary(path, document, indent):
+    data = json.dumps(document, indent=indent, ensure_ascii=False).encode()
+    expected = at(document, path)
+    for cut in range(1, len(data)):
+        assert parse(data, path, [cut]) == expected, cut
+    assert parse(data, path, list(range(1, len(data)))) == expected  # One byte at a time
+
+
+@pytest.mark.parametrize("path, document", DOCUMENTS)
+def test_json_array_stream_random_chunks(path, document):
+    rng = random.Random(1)
+    data = json.dumps(document, separators=(",", ":"), ensure_ascii=rng.random() < 0.5).encode()
+    for _ in range(200):
+        assert parse(data, path, random_cuts(rng, len(data))) == at(document, path)
+
+
+def test_json_array_stream_mock_responses(mock):
+    base = f"http://127.0.0.1:{server.CB_PORT}"
+    rng = random.Random(2)
+    for url, path in [
+        (f"{base}/v2/entities?limit=100", []),
+        (f"{base}/iot/devices?limit=100", ["devices"]),
+        (f"{base}/STH/v1/contextEntities/type/Room/id/Room:00000/attributes/temperature?hLimit=100&hOffset=0",
+         ["contextResponses", 0, "contextElement", "attributes", 0, "values"]),
+    ]:
+        data = requests.get(url).content
+        expected = at(json.loads(data), path)
+        assert len(expected) == 100
+        for _ in range(50):
+            assert parse(data, path, random_cuts(rng, len(data))) == expected
+
+
+def test_json_array_stream_rejects_truncated_and_missing_arrays():
+    data = json.dumps({"devices": ITEMS}).encode()
+    parser = server.JsonArrayStream(["devices"])
+    parser.feed(data[:-5])
+    with pytest.raises(ValueError, match="middle of the array"):
+        parser.close()
+    parser = server.JsonArrayStream(["services"])
+    parser.feed(data)
+    with pytest.raises(ValueError, match="no array"):
+        parser.close()
@@ -0,0 +1,50 @@
+"""Which transport errors count as "never sent", so that POSTs can be retried"""
+
+import socket
+import threading
+
+import httpx
+import pytest
+import requests
+
+import server
+
+
+def closing_port() -> int:
+    """A port that reads one request and closes the connection without answering"""
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def serve():
+        connection, _ = listener.accept()
+        connection.recv(65536)
+        connection.close()
+        listener.close()
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def refused_port() -> int:
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        return listener.getsockname()[1]
+
+
+def error_of(call) -> Exception:
+    with pytest.raises(Exception) as info:
+        call()
+    return info.value
+
+
+def test_refused_connections_are_not_sent():
+    url = f"http://127.0.0.1:{refused_port()}/v2/entities"
+    assert server._not_sent(error_of(lambda: requests.post(url, json={})))
+    assert server._not_sent(error_of(lambda: httpx.post(url, json={})))
+    assert server._not_sent(server.BackendUnavailable("circuit open"))
+
+
+def test_dropped_connections_after_sending_may_have_been_applied():
+    error = error_of(lambda: requests.post(f"http://127.0.0.1:{closing_port()}/v2/op/update", json={}))
+    assert isinstance(error, requests.exceptions.ConnectionError)
+    assert not server._not_sent(error)
+    assert not server._not_sent(error_of(lambda: httpx.post(f"http://127.0.0.1:{closing_port()}/", json={})))
+    assert not server._not_sent(requests.exceptions.ChunkedEncodingError("truncated body"))
+    assert not server._not_sent(requests.exceptions.ReadTimeout("read timed out"))